@@ -0,0 +1,65 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures what it costs each uWSGI process to import the API.
+
+Every uWSGI process imports the app, so import time is paid on every spawn and
+the memory is paid once per process. Each module is imported ``--runs`` times,
+each time in a fresh interpreter, and the median import time and peak RSS are
+reported. The worker's tasks module (which loads pyVmomi) is measured too, as a
+reference for what the API would cost if it pulled vCenter back in.
+
+Usage::
+
+    python benchmarks/startup.py --runs 10
+"""
+import sys
+import argparse
+import statistics
+import subprocess
+
+import ujson
+
+
+MODULES = ('vlab_windows_api.app', 'vlab_windows_api.lib.worker.tasks')
+
+# Runs in a fresh interpreter, so nothing is already imported
+PROBE = """
+import sys, time, json
+start = time.time()
+import {module}
+elapsed = time.time() - start
+# ru_maxrss survives exec(), so it'd report this script's memory instead
+with open('/proc/self/status') as the_file:
+    rss_kb = [int(x.split()[1]) for x in the_file if x.startswith('VmHWM')][0]
+print(json.dumps({{'seconds': elapsed, 'rss_kb': rss_kb, 'modules': len(sys.modules)}}))
+"""
+
+
+def measure(module):
+    """Import a module in a fresh interpreter
+
+    :Returns: Dictionary - import seconds, peak RSS in KB and how many modules were loaded
+
+    :param module: The dotted name of the module to import
+    :type module: String
+    """
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', PROBE.format(module=module)])
+    return ujson.loads(output.decode().strip().split('\n')[-1])
+
+
+def main():
+    """Measure each module, and print a table of the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    print('{:<36}{:>10}{:>10}{:>10}'.format('module', 'seconds', 'RSS (MB)', 'modules'))
+    for module in MODULES:
+        runs = [measure(module) for _ in range(args.runs)]
+        seconds = statistics.median(x['seconds'] for x in runs)
+        rss_mb = statistics.median(x['rss_kb'] for x in runs) / 1024
+        print('{:<36}{:>10.2f}{:>10.1f}{:>10}'.format(module, seconds, rss_mb, runs[0]['modules']))
+
+
+if __name__ == '__main__':
+    main()
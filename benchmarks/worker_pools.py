@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+"""
+Compares the prefork and gevent Celery pools for the worker's I/O bound tasks.
+
+Every task in the worker spends nearly all of its time waiting on vCenter, so
+this benchmark runs a simulated task that makes a few HTTP calls to a local
+server that takes ``--latency`` seconds to answer each one. Each pool runs in
+its own interpreter, with the worker modules (and pyVmomi) imported, and
+reports wall time plus the combined PSS of every process in the pool.
+
+Usage::
+
+    python benchmarks/worker_pools.py --tasks 400 --concurrency 50
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import ujson
+
+
+def _pss_kb(pid):
+    """The proportional set size of a process, so shared pages aren't double counted"""
+    with open('/proc/{}/smaps_rollup'.format(pid)) as the_file:
+        for line in the_file:
+            if line.startswith('Pss:'):
+                return int(line.split()[1])
+    return 0
+
+
+def _simulated_task(args):
+    """Stands in for a task like ``windows.show``; a handful of slow round trips"""
+    import http.client
+    port, calls = args
+    for _ in range(calls):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        conn.getresponse().read()
+        conn.close()
+
+
+def run_pool(mode, port, tasks, concurrency, calls):
+    """Run the simulated tasks in one pool; called in a fresh interpreter"""
+    if mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    # Load what a real worker loads, so memory numbers are realistic
+    from vlab_windows_api.lib.worker import tasks as _
+    work = [(port, calls)] * tasks
+    if mode == 'gevent':
+        from gevent.pool import Pool
+        pool = Pool(concurrency)
+        start = time.time()
+        pool.map(_simulated_task, work)
+        elapsed = time.time() - start
+        pss = _pss_kb(os.getpid())
+    else:
+        import multiprocessing
+        pool = multiprocessing.get_context('fork').Pool(concurrency)
+        start = time.time()
+        pool.map(_simulated_task, work, chunksize=1)
+        elapsed = time.time() - start
+        pss = _pss_kb(os.getpid()) + sum(_pss_kb(x.pid) for x in pool._pool)
+        pool.close()
+    return {'pool': mode, 'seconds': round(elapsed, 2), 'pss_mb': round(pss / 1024, 1)}
+
+
+class _Server(ThreadingHTTPServer):
+    """The default listen backlog of 5 would be the bottleneck"""
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class _SlowHandler(BaseHTTPRequestHandler):
+    """Answers every request after a delay, like a busy vCenter"""
+    latency = 0.1
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    """Run the benchmark for each pool, and print a table of the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tasks', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--calls', type=int, default=5, help='vCenter calls per task')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds per vCenter call')
+    parser.add_argument('--mode', choices=['prefork', 'gevent'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(ujson.dumps(run_pool(args.mode, args.port, args.tasks, args.concurrency, args.calls)))
+        return
+
+    _SlowHandler.latency = args.latency
+    server = _Server(('127.0.0.1', 0), _SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('{} tasks, {} calls each, {}s per call, concurrency {}'.format(args.tasks, args.calls,
+                                                                         args.latency, args.concurrency))
+    print('{:<10}{:>12}{:>12}'.format('pool', 'seconds', 'PSS (MB)'))
+    for mode in ('prefork', 'gevent'):
+        cmd = [sys.executable, '-W', 'ignore', __file__, '--mode', mode,
+               '--port', str(server.server_address[1]), '--tasks', str(args.tasks),
+               '--concurrency', str(args.concurrency), '--calls', str(args.calls)]
+        result = ujson.loads(subprocess.check_output(cmd).decode().strip().split('\n')[-1])
+        print('{pool:<10}{seconds:>12}{pss_mb:>12}'.format(**result))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
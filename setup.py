@@ -15,5 +15,6 @@ setup(name="vlab-windows-api",
       package_files={'vlab_windows_api' : ['app.ini']},
       description="windows",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery'],
+      extras_require={'gevent': ['gevent']},
       )
@@ -52,6 +52,66 @@ class TestWindowsViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_reset_schema(self):
+        """The schema defined for POST on /reset is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.RESET_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_cancel_schema(self):
+        """The schema defined for POST on /cancel is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.CANCEL_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_power_schema(self):
+        """The schema defined for POST on /power is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.POWER_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_network_batch_schema(self):
+        """The schema defined for PUT on /network/batch is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.NETWORK_BATCH_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_reap_schema(self):
+        """The schema defined for POST on /reap is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.REAP_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_history_args_schema(self):
+        """The schema defined for the query params of GET on /history is valid"""
+        try:
+            Draft4Validator.check_schema(windows.WindowsView.HISTORY_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
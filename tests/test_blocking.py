@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in blocking.py
+"""
+import sys
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+try:
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+from vlab_windows_api.lib.worker import blocking
+
+
+class TestBlocking(unittest.TestCase):
+    """A set of test cases for blocking.py"""
+    @patch.object(blocking, '_threadpool')
+    def test_call_prefork(self, fake_threadpool):
+        """``call`` just calls the function when not running under gevent"""
+        fake_threadpool.return_value = None
+
+        output = blocking.call(threading.get_ident)
+
+        self.assertEqual(output, threading.get_ident())
+
+    @patch.object(blocking, '_threadpool')
+    def test_call_gevent(self, fake_threadpool):
+        """``call`` runs the function on gevent's thread pool"""
+        blocking.call(len, 'abc')
+
+        fake_threadpool.return_value.apply.assert_called_with(len, ('abc',), {})
+
+    @unittest.skipIf(ThreadPool is None, 'gevent is not installed')
+    @patch.object(blocking, '_threadpool')
+    def test_call_gevent_thread(self, fake_threadpool):
+        """``call`` returns what the function returned in the other thread"""
+        pool = ThreadPool(1)
+        fake_threadpool.return_value = pool
+        try:
+            output = blocking.call(threading.get_ident)
+        finally:
+            pool.kill()
+
+        self.assertNotEqual(output, threading.get_ident())
+
+    def test_threadpool_no_gevent(self):
+        """``_threadpool`` returns None if gevent was never imported"""
+        with patch.dict(sys.modules, {'gevent': None}):
+            self.assertTrue(blocking._threadpool() is None)
+
+    @patch.object(blocking, '_threadpool')
+    def test_offload(self, fake_threadpool):
+        """``offload`` routes every call of the decorated function through ``call``"""
+        fake_threadpool.return_value = None
+        @blocking.offload
+        def add(a, b):
+            """Adds"""
+            return a + b
+
+        self.assertEqual(add(1, b=2), 3)
+        self.assertEqual(add.__name__, 'add')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in collector.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_windows_api.lib.worker import collector
+
+
+class TestCollector(unittest.TestCase):
+    """A set of test cases for the collector.py module"""
+
+    @staticmethod
+    def _make_page(names, token=None):
+        """Build a fake RetrieveResult object"""
+        page = MagicMock()
+        page.token = token
+        objects = []
+        for name in names:
+            prop = MagicMock()
+            prop.name = 'name'
+            prop.val = name
+            obj_content = MagicMock()
+            obj_content.propSet = [prop]
+            obj_content.obj = name
+            objects.append(obj_content)
+        page.objects = objects
+        return page
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve(self, fake_vmodl):
+        """``retrieve`` yields a dictionary of properties per object"""
+        fake_vcenter = MagicMock()
+        collector_obj = fake_vcenter.content.propertyCollector
+        collector_obj.RetrievePropertiesEx.return_value = self._make_page(['a'])
+
+        output = list(collector.retrieve(fake_vcenter, collector.vim.Network, ['name']))
+        expected = [{'name': 'a', 'obj': 'a'}]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve_pages(self, fake_vmodl):
+        """``retrieve`` follows the continuation token until all objects are returned"""
+        fake_vcenter = MagicMock()
+        collector_obj = fake_vcenter.content.propertyCollector
+        collector_obj.RetrievePropertiesEx.return_value = self._make_page(['a'], token='more')
+        collector_obj.ContinueRetrievePropertiesEx.return_value = self._make_page(['b'])
+
+        output = [x['name'] for x in collector.retrieve(fake_vcenter, collector.vim.Network, ['name'])]
+        expected = ['a', 'b']
+
+        self.assertEqual(output, expected)
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve_destroys_view(self, fake_vmodl):
+        """``retrieve`` cleans up the container view it creates"""
+        fake_vcenter = MagicMock()
+        collector_obj = fake_vcenter.content.propertyCollector
+        collector_obj.RetrievePropertiesEx.return_value = self._make_page([])
+
+        list(collector.retrieve(fake_vcenter, collector.vim.Network, ['name']))
+        view = fake_vcenter.content.viewManager.CreateContainerView.return_value
+
+        self.assertTrue(view.DestroyView.called)
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve_many(self, fake_vmodl):
+        """``retrieve_many`` fetches several types of objects with one view"""
+        fake_vcenter = MagicMock()
+        collector_obj = fake_vcenter.content.propertyCollector
+        collector_obj.RetrievePropertiesEx.return_value = self._make_page(['a', 'b'])
+
+        output = list(collector.retrieve_many(fake_vcenter, {collector.vim.Folder: ['name'],
+                                                             collector.vim.VirtualMachine: ['name']}))
+        _, the_kwargs = fake_vcenter.content.viewManager.CreateContainerView.call_args
+
+        self.assertEqual(len(output), 2)
+        self.assertEqual(the_kwargs['type'], [collector.vim.Folder, collector.vim.VirtualMachine])
+        self.assertEqual(fake_vcenter.content.viewManager.CreateContainerView.call_count, 1)
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve_objects(self, fake_vmodl):
+        """``retrieve_objects`` fetches properties for just the objects given, without a container view"""
+        fake_vcenter = MagicMock()
+        collector_obj = fake_vcenter.content.propertyCollector
+        collector_obj.RetrievePropertiesEx.return_value = self._make_page(['a', 'b'])
+
+        output = list(collector.retrieve_objects(fake_vcenter, collector.vim.Network, ['a', 'b'], ['name']))
+        _, the_kwargs = fake_vmodl.query.PropertyCollector.FilterSpec.call_args
+
+        self.assertEqual(len(output), 2)
+        self.assertEqual(len(the_kwargs['objectSet']), 2)
+        self.assertFalse(fake_vcenter.content.viewManager.CreateContainerView.called)
+
+    @patch.object(collector, 'vmodl')
+    def test_retrieve_objects_none(self, fake_vmodl):
+        """``retrieve_objects`` does not call vCenter when there are no objects"""
+        fake_vcenter = MagicMock()
+
+        output = list(collector.retrieve_objects(fake_vcenter, collector.vim.Network, [], ['name']))
+
+        self.assertEqual(output, [])
+        self.assertFalse(fake_vcenter.content.propertyCollector.RetrievePropertiesEx.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,556 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in deploy.py
+"""
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_windows_api.lib.worker import deploy
+
+
+OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope>
+  <NetworkSection>
+    <Network ovf:name="VM Network">
+    </Network>
+  </NetworkSection>
+</Envelope>
+"""
+
+
+def make_ova(path, disks):
+    """Create a small OVA file for testing"""
+    with tarfile.open(path, 'w') as tar:
+        members = [('Windows.ovf', OVF.encode())] + list(disks.items())
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+class TestOvaImage(unittest.TestCase):
+    """A set of test cases for the OvaImage object"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.ova_path = os.path.join(cls.tmp_dir.name, 'Windows-10.ova')
+        make_ova(cls.ova_path, {'disk1.vmdk': b'a' * 1000, 'disk2.vmdk': b'b' * 700})
+
+    @classmethod
+    def tearDownClass(cls):
+        """Runs once after all test cases"""
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.ova = deploy.OvaImage(self.ova_path)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.ova.close()
+
+    def test_disks(self):
+        """``OvaImage`` - indexes every disk within the OVA"""
+        self.assertEqual(set(self.ova.disks.keys()), {'disk1.vmdk', 'disk2.vmdk'})
+
+    def test_size(self):
+        """``OvaImage`` - size is the combined size of every disk"""
+        self.assertEqual(self.ova.size, 1700)
+
+    def test_disk_space(self):
+        """``OvaImage`` - disk_space uses the populated size from the descriptor, not the compressed VMDKs"""
+        self.ova.ovf = '<DiskSection><Disk ovf:capacity="40" ovf:capacityAllocationUnits="byte * 2^30" ' \
+                       'ovf:diskId="vmdisk1" ovf:populatedSize="9000"/></DiskSection>'
+
+        self.assertEqual(self.ova.disk_space, 9000)
+
+    def test_disk_space_capacity(self):
+        """``OvaImage`` - disk_space falls back to the capacity, in its allocation units"""
+        self.ova.ovf = '<DiskSection><Disk ovf:capacity="40" ovf:capacityAllocationUnits="byte * 2^30" ' \
+                       'ovf:diskId="vmdisk1"/><Disk ovf:capacity="1024" ovf:diskId="vmdisk2"/></DiskSection>'
+
+        self.assertEqual(self.ova.disk_space, 40 * 2 ** 30 + 1024)
+
+    def test_disk_space_no_section(self):
+        """``OvaImage`` - disk_space is the size of the VMDKs if the descriptor doesn't list the disks"""
+        self.assertEqual(self.ova.disk_space, 1700)
+
+    def test_ovf(self):
+        """``OvaImage`` - reads the OVF descriptor"""
+        self.assertEqual(self.ova.ovf, OVF)
+
+    def test_networks(self):
+        """``OvaImage`` - networks returns the names of networks in the OVF"""
+        self.assertEqual(self.ova.networks, ['VM Network'])
+
+    def test_read_into(self):
+        """``OvaImage`` - read_into reads a disk's content via its offset in the OVA"""
+        offset, size = self.ova.disks['disk2.vmdk']
+        buf = memoryview(bytearray(size))
+        read = self.ova.read_into(offset, buf)
+
+        self.assertEqual(read, 700)
+        self.assertEqual(bytes(buf), b'b' * 700)
+
+    def test_read_into_end(self):
+        """``OvaImage`` - read_into stops at the end of the OVA"""
+        buf = memoryview(bytearray(4096))
+        read = self.ova.read_into(os.path.getsize(self.ova_path) - 10, buf)
+
+        self.assertEqual(read, 10)
+
+    def test_read_into_truncated(self):
+        """``OvaImage`` - read_into returns a short read, instead of crashing, when the OVA shrinks while open"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'Windows-10.ova')
+            make_ova(path, {'disk1.vmdk': b'a' * 100000})
+            ova = deploy.OvaImage(path)
+            self.addCleanup(ova.close)
+            offset, size = ova.disks['disk1.vmdk']
+            os.truncate(path, offset + 10)
+
+            read = ova.read_into(offset, memoryview(bytearray(size)))
+
+        self.assertEqual(read, 10)
+
+    def test_read_into_stats(self):
+        """``OvaImage`` - read_into keeps track of how much was read, and how long it took"""
+        offset, size = self.ova.disks['disk1.vmdk']
+        self.ova.read_into(offset, memoryview(bytearray(size)))
+
+        self.assertEqual(self.ova.bytes_read, 1000)
+        self.assertTrue(self.ova.read_seconds >= 0)
+
+    @patch.object(deploy, 'advise')
+    def test_read_into_readahead(self, fake_advise):
+        """``OvaImage`` - read_into asks the kernel to read ahead of the chunk being read"""
+        offset, size = self.ova.disks['disk1.vmdk']
+        self.ova.read_into(offset, memoryview(bytearray(size)))
+        _, start, length, _ = fake_advise.call_args[0]
+
+        self.assertEqual(start, offset + size)
+        self.assertEqual(length, deploy.const.VLAB_WINDOWS_READAHEAD_MB * 1024 * 1024)
+
+    @patch.object(deploy.blocking, 'call')
+    def test_read_into_offloads(self, fake_call):
+        """``OvaImage`` - read_into asks for the read ahead, and reads, off of the gevent hub"""
+        offset, size = self.ova.disks['disk1.vmdk']
+        fake_call.side_effect = lambda func, *args: func(*args)
+
+        self.ova.read_into(offset, memoryview(bytearray(size)))
+        funcs = [x[0][0] for x in fake_call.call_args_list]
+
+        self.assertEqual(funcs, [deploy.advise, deploy._pread_into])
+
+    @patch.object(deploy.blocking, 'call')
+    @patch.object(deploy, 'advise')
+    def test_warm_page_cache_offloads(self, fake_advise, fake_call):
+        """``warm_page_cache`` asks for each chunk off of the gevent hub"""
+        with tempfile.NamedTemporaryFile() as the_file:
+            the_file.write(b'a' * 1024)
+            the_file.flush()
+            deploy.warm_page_cache(the_file.name)
+
+        self.assertTrue(fake_call.call_args[0][0] is fake_advise)
+        self.assertFalse(fake_advise.called)
+
+    def test_checksum(self):
+        """``OvaImage`` - checksum is stable for the same OVA"""
+        other = deploy.OvaImage(self.ova_path)
+        self.addCleanup(other.close)
+
+        self.assertEqual(self.ova.checksum, other.checksum)
+
+    def test_checksum_manifest(self):
+        """``OvaImage`` - checksum is based on the manifest when the OVA has one"""
+        self.ova.manifest = 'SHA256(disk1.vmdk)= abc'
+        first = self.ova.checksum
+        self.ova.manifest = 'SHA256(disk1.vmdk)= def'
+
+        self.assertNotEqual(first, self.ova.checksum)
+
+    def test_missing(self):
+        """``OvaImage`` - raises FileNotFoundError if the OVA does not exist"""
+        with self.assertRaises(FileNotFoundError):
+            deploy.OvaImage(os.path.join(self.tmp_dir.name, 'nope.ova'))
+
+
+class TestPageCache(unittest.TestCase):
+    """A set of test cases for the page cache hints"""
+
+    @patch.object(deploy.os, 'posix_fadvise')
+    def test_advise(self, fake_posix_fadvise):
+        """``advise`` passes the hint to the kernel"""
+        deploy.advise(3, 0, 100, deploy.os.POSIX_FADV_WILLNEED)
+
+        fake_posix_fadvise.assert_called_with(3, 0, 100, deploy.os.POSIX_FADV_WILLNEED)
+
+    @patch.object(deploy.os, 'posix_fadvise')
+    def test_advise_error(self, fake_posix_fadvise):
+        """``advise`` ignores errors, since it's only a hint"""
+        fake_posix_fadvise.side_effect = OSError('testing')
+
+        deploy.advise(3, 0, 100, deploy.os.POSIX_FADV_WILLNEED)
+
+    @patch.object(deploy.os, 'posix_fadvise')
+    def test_advise_unsupported(self, fake_posix_fadvise):
+        """``advise`` does nothing when the platform lacks the hint"""
+        deploy.advise(3, 0, 100, None)
+
+        self.assertFalse(fake_posix_fadvise.called)
+
+    @patch.object(deploy, 'advise')
+    def test_warm_page_cache(self, fake_advise):
+        """``warm_page_cache`` asks the kernel to read the whole file, a chunk at a time"""
+        with tempfile.NamedTemporaryFile() as the_file:
+            the_file.write(b'a' * (3 * 1024 * 1024))
+            the_file.flush()
+            size = deploy.warm_page_cache(the_file.name, chunk_mb=1)
+
+        offsets = [x[0][1] for x in fake_advise.call_args_list]
+
+        self.assertEqual(size, 3 * 1024 * 1024)
+        self.assertEqual(offsets, [0, 1024 * 1024, 2 * 1024 * 1024])
+
+
+class TestUploadDisks(unittest.TestCase):
+    """A set of test cases for the upload_disks function"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.ova_path = os.path.join(cls.tmp_dir.name, 'Windows-10.ova')
+        make_ova(cls.ova_path, {'disk1.vmdk': b'a' * 5000, 'disk2.vmdk': b'b' * 3000})
+
+    @classmethod
+    def tearDownClass(cls):
+        """Runs once after all test cases"""
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.ova = deploy.OvaImage(self.ova_path)
+        self.lease = MagicMock()
+        self.file_items = []
+        device_urls = []
+        for idx, name in enumerate(['disk1.vmdk', 'disk2.vmdk']):
+            file_item = MagicMock()
+            file_item.path = name
+            file_item.deviceId = idx
+            self.file_items.append(file_item)
+            device_url = MagicMock()
+            device_url.importKey = idx
+            device_url.url = 'https://*/nfc/{}/disk-{}.vmdk'.format(idx, idx)
+            device_urls.append(device_url)
+        self.lease.info.deviceUrl = device_urls
+        # retry transient failures without waiting
+        patcher = patch.object(deploy.transient, 'backoff', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.ova.close()
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks(self, fake_pool):
+        """``upload_disks`` sends the content of every disk, then completes the lease"""
+        sent = {}
+        def fake_get(netloc, fresh=False):
+            conn = MagicMock()
+            conn.getresponse.return_value.status = 200
+            def fake_putrequest(method, path):
+                conn.path = path
+            def fake_send(data):
+                sent.setdefault(conn.path, b'')
+                sent[conn.path] += bytes(data)
+            conn.putrequest.side_effect = fake_putrequest
+            conn.send.side_effect = fake_send
+            return conn
+        fake_pool.get.side_effect = fake_get
+
+        deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+        expected = {'/nfc/0/disk-0.vmdk': b'a' * 5000, '/nfc/1/disk-1.vmdk': b'b' * 3000}
+
+        self.assertEqual(sent, expected)
+        self.assertTrue(self.lease.Complete.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_host(self, fake_pool):
+        """``upload_disks`` replaces the '*' in the device URL with the ESXi host"""
+        fake_pool.get.return_value.getresponse.return_value.status = 200
+
+        deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+        netlocs = {x[0][0] for x in fake_pool.get.call_args_list}
+
+        self.assertEqual(netlocs, {'esxi01'})
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_failure(self, fake_pool):
+        """``upload_disks`` aborts the lease if a disk fails to upload"""
+        fake_pool.get.return_value.getresponse.return_value.status = 500
+
+        with self.assertRaises(RuntimeError):
+            deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertTrue(self.lease.Abort.called)
+        self.assertFalse(self.lease.Complete.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_failure_closes(self, fake_pool):
+        """``upload_disks`` does not reuse a connection that failed"""
+        fake_pool.get.return_value.getresponse.return_value.status = 500
+
+        with self.assertRaises(RuntimeError):
+            deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertFalse(fake_pool.put.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_retry(self, fake_pool):
+        """``upload_disks`` sends a disk again after a transient failure, and only that disk"""
+        attempts = []
+        def fake_get(netloc, fresh=False):
+            conn = MagicMock()
+            def fake_putrequest(method, path):
+                attempts.append(path)
+                # the first try of disk-0 gets a dropped connection
+                if attempts.count(path) == 1 and path.endswith('disk-0.vmdk'):
+                    conn.send.side_effect = ConnectionResetError('testing')
+            conn.putrequest.side_effect = fake_putrequest
+            conn.getresponse.return_value.status = 200
+            return conn
+        fake_pool.get.side_effect = fake_get
+
+        deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertEqual(sorted(attempts), ['/nfc/0/disk-0.vmdk', '/nfc/0/disk-0.vmdk', '/nfc/1/disk-1.vmdk'])
+        self.assertTrue(self.lease.Complete.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_no_retry(self, fake_pool):
+        """``upload_disks`` does not retry a failure that would just happen again"""
+        fake_pool.get.return_value.getresponse.return_value.status = 400
+
+        with self.assertRaises(RuntimeError):
+            deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertEqual(fake_pool.get.call_count, 2)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_retries_give_up(self, fake_pool):
+        """``upload_disks`` stops retrying after VLAB_WINDOWS_RETRIES attempts"""
+        fake_pool.get.return_value.getresponse.return_value.status = 503
+
+        with self.assertRaises(deploy.transient.TransientError):
+            deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertTrue(fake_pool.get.call_count <= 2 * (deploy.const.VLAB_WINDOWS_RETRIES + 1))
+
+    @patch.object(deploy, 'PROGRESS_INTERVAL', 0.01)
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_cancelled(self, fake_pool):
+        """``upload_disks`` aborts the lease and raises Cancelled when told to stop"""
+        fake_pool.get.return_value.getresponse.return_value.status = 200
+        fake_pool.get.return_value.send.side_effect = lambda data: deploy.time.sleep(0.05)
+
+        with self.assertRaises(deploy.Cancelled):
+            deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01', should_stop=lambda: True)
+
+        self.assertTrue(self.lease.Abort.called)
+        self.assertFalse(self.lease.Complete.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_stale(self, fake_pool):
+        """``upload_disks`` reconnects once when a pooled connection was closed by ESXi"""
+        stale = MagicMock()
+        stale.send.side_effect = BrokenPipeError('testing')
+        def fake_get(netloc, fresh=False):
+            if not fresh:
+                return stale
+            conn = MagicMock()
+            conn.getresponse.return_value.status = 200
+            return conn
+        fake_pool.get.side_effect = fake_get
+
+        deploy.upload_disks(self.ova, self.file_items, self.lease, 'esxi01')
+
+        self.assertTrue(stale.close.called)
+        self.assertTrue(self.lease.Complete.called)
+
+    @patch.object(deploy, '_pool')
+    def test_upload_disks_stale_once(self, fake_pool):
+        """``upload_disks`` only reconnects once for a dropped connection"""
+        fake_pool.get.return_value.send.side_effect = BrokenPipeError('testing')
+
+        # one disk, so another upload being stopped partway can't skew the count
+        with self.assertRaises(BrokenPipeError):
+            deploy.upload_disks(self.ova, self.file_items[:1], self.lease, 'esxi01')
+
+        fresh = [x[1].get('fresh') for x in fake_pool.get.call_args_list]
+        # every retry tries the pooled connection, then reconnects just once
+        self.assertEqual(fresh, [False, True] * (len(fresh) // 2))
+
+
+class TestConnectionPool(unittest.TestCase):
+    """A suite of test cases for the ``ConnectionPool`` object"""
+    @patch.object(deploy.http.client, 'HTTPSConnection')
+    def test_reuse(self, fake_HTTPSConnection):
+        """``ConnectionPool`` hands back an idle connection to the same host"""
+        pool = deploy.ConnectionPool()
+        conn = MagicMock()
+        pool.put('esxi01', conn)
+
+        self.assertTrue(pool.get('esxi01') is conn)
+
+    @patch.object(deploy.http.client, 'HTTPSConnection')
+    def test_timeout(self, fake_HTTPSConnection):
+        """``ConnectionPool`` makes connections that time out, so a stalled upload can't hang forever"""
+        deploy.ConnectionPool().get('esxi01')
+        _, the_kwargs = fake_HTTPSConnection.call_args
+
+        self.assertEqual(the_kwargs['timeout'], deploy.const.VLAB_WINDOWS_UPLOAD_TIMEOUT)
+
+    @patch.object(deploy.http.client, 'HTTPSConnection')
+    def test_fresh(self, fake_HTTPSConnection):
+        """``ConnectionPool`` makes a new connection when asked for a fresh one"""
+        pool = deploy.ConnectionPool()
+        conn = MagicMock()
+        pool.put('esxi01', conn)
+
+        self.assertTrue(pool.get('esxi01', fresh=True) is fake_HTTPSConnection.return_value)
+
+    @patch.object(deploy.http.client, 'HTTPSConnection')
+    def test_expired(self, fake_HTTPSConnection):
+        """``ConnectionPool`` closes connections that have been idle too long"""
+        pool = deploy.ConnectionPool(max_idle=0)
+        older, newer = MagicMock(), MagicMock()
+        pool.put('esxi01', older)
+        pool.put('esxi01', newer)
+        deploy.time.sleep(0.01)
+
+        conn = pool.get('esxi01')
+
+        self.assertTrue(conn is fake_HTTPSConnection.return_value)
+        self.assertTrue(older.close.called)
+        self.assertTrue(newer.close.called)
+
+
+class TestDeploy(unittest.TestCase):
+    """A set of test cases for the deploy.py module"""
+
+    @patch.object(deploy, 'upload_disks')
+    @patch.object(deploy, '_get_lease')
+    @patch.object(deploy, 'pick_host')
+    @patch.object(deploy, 'pick_datastore')
+    @patch.object(deploy.virtual_machine, 'power')
+    def test_deploy_from_ova(self, fake_power, fake_pick_datastore, fake_pick_host, fake_get_lease, fake_upload_disks):
+        """``deploy_from_ova`` returns the new VM"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.ovf_manager.CreateImportSpec.return_value.error = []
+
+        output = deploy.deploy_from_ova(fake_vcenter, MagicMock(), [], 'bob', 'win10', MagicMock())
+        expected = fake_get_lease.return_value.info.entity
+
+        self.assertTrue(output is expected)
+
+    @patch.object(deploy, 'upload_disks')
+    @patch.object(deploy, '_get_lease')
+    @patch.object(deploy, 'pick_host')
+    @patch.object(deploy, 'pick_datastore')
+    @patch.object(deploy.virtual_machine, 'power')
+    def test_deploy_from_ova_bad_name(self, fake_power, fake_pick_datastore, fake_pick_host, fake_get_lease, fake_upload_disks):
+        """``deploy_from_ova`` raises ValueError if the machine name is not a valid hostname"""
+        with self.assertRaises(ValueError):
+            deploy.deploy_from_ova(MagicMock(), MagicMock(), [], 'bob', 'win_10!', MagicMock())
+
+    @patch.object(deploy, 'upload_disks')
+    @patch.object(deploy, '_get_lease')
+    @patch.object(deploy, 'pick_host')
+    @patch.object(deploy, 'pick_datastore')
+    @patch.object(deploy.virtual_machine, 'power')
+    def test_deploy_from_ova_spec_error(self, fake_power, fake_pick_datastore, fake_pick_host, fake_get_lease, fake_upload_disks):
+        """``deploy_from_ova`` raises DeployFailure if vCenter cannot build an import spec"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.ovf_manager.CreateImportSpec.return_value.error = [MagicMock(msg='testing')]
+
+        with self.assertRaises(deploy.DeployFailure):
+            deploy.deploy_from_ova(fake_vcenter, MagicMock(), [], 'bob', 'win10', MagicMock())
+
+    @patch.object(deploy, 'destroy_partial')
+    @patch.object(deploy, 'upload_disks')
+    @patch.object(deploy, '_get_lease')
+    @patch.object(deploy, 'pick_host')
+    @patch.object(deploy, 'pick_datastore')
+    @patch.object(deploy.virtual_machine, 'power')
+    def test_deploy_from_ova_cancelled(self, fake_power, fake_pick_datastore, fake_pick_host, fake_get_lease,
+                                       fake_upload_disks, fake_destroy_partial):
+        """``deploy_from_ova`` removes the partial VM when the upload is cancelled"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.ovf_manager.CreateImportSpec.return_value.error = []
+        fake_upload_disks.side_effect = deploy.Cancelled('testing')
+
+        with self.assertRaises(deploy.Cancelled):
+            deploy.deploy_from_ova(fake_vcenter, MagicMock(), [], 'bob', 'win10', MagicMock())
+
+        self.assertTrue(fake_destroy_partial.called)
+        self.assertFalse(fake_power.called)
+
+    @patch.object(deploy, 'LEASE_TIMEOUT', 2)
+    @patch.object(deploy.time, 'sleep')
+    def test_get_lease_timeout(self, fake_sleep):
+        """``_get_lease`` aborts a lease that never becomes ready, so the partial VM is removed"""
+        fake_resource_pool = MagicMock()
+        fake_lease = fake_resource_pool.ImportVApp.return_value
+        fake_lease.error = None
+        fake_lease.state = 'initializing'
+
+        with self.assertRaises(deploy.transient.TransientError):
+            deploy._get_lease(fake_resource_pool, MagicMock(), MagicMock(), MagicMock())
+
+        self.assertTrue(fake_lease.Abort.called)
+
+    @patch.object(deploy, 'destroy_partial')
+    def test_abort_lease_fails(self, fake_destroy_partial):
+        """``_abort_lease`` destroys the VM itself when the lease cannot be aborted"""
+        fake_lease = MagicMock()
+        fake_lease.Abort.side_effect = deploy.vmodl.fault.SystemError(reason='testing')
+
+        deploy._abort_lease(fake_lease, 'testing')
+
+        fake_destroy_partial.assert_called_with(fake_lease.info.entity)
+
+    @patch.object(deploy.time, 'sleep')
+    def test_throttle(self, fake_sleep):
+        """``Throttle`` - sleeps once the bandwidth cap is exceeded"""
+        throttle = deploy.Throttle(max_mbps=1)
+        throttle.consume(1024 * 1024)
+        throttle.consume(1024 * 1024)
+
+        self.assertEqual(fake_sleep.call_count, 1)
+
+    @patch.object(deploy.time, 'sleep')
+    def test_throttle_unlimited(self, fake_sleep):
+        """``Throttle`` - never sleeps when there is no bandwidth cap"""
+        throttle = deploy.Throttle(max_mbps=0)
+        throttle.consume(1024 * 1024 * 1024)
+
+        self.assertFalse(fake_sleep.called)
+
+    def test_progress(self):
+        """``Progress`` - percent reflects how much has been sent"""
+        progress = deploy.Progress(total=200)
+        progress.add(50)
+
+        self.assertEqual(progress.percent, 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
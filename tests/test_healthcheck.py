@@ -3,6 +3,7 @@
 A suite of tests for the healthcheck API end point
 """
 import unittest
+from unittest.mock import patch, MagicMock
 
 from flask import Flask
 
@@ -18,6 +19,7 @@ class TestHealthView(unittest.TestCase):
         app = Flask(__name__)
         healthcheck.HealthView.register(app)
         app.config['TESTING'] = True
+        app.celery_app = MagicMock()
         cls.app = app.test_client()
 
     def test_health_check(self):
@@ -28,6 +30,92 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(expected, resp.status_code)
 
+    @patch.object(healthcheck, 'probe')
+    def test_health_check_deep(self, fake_probe):
+        """A deep health check reports on the dependencies of the service"""
+        fake_probe.results.return_value = {'checked': 1, 'age': 2, 'broker': {'ok': True}}
+        resp = self.app.get('/api/1/inf/windows/healthcheck?deep=true')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['deep']['broker'], {'ok': True})
+
+    @patch.object(healthcheck, 'probe')
+    def test_health_check_deep_failure(self, fake_probe):
+        """A deep health check returns HTTP 503 if a dependency is unhealthy"""
+        fake_probe.results.return_value = {'checked': 1, 'age': 2, 'broker': {'ok': False}}
+        resp = self.app.get('/api/1/inf/windows/healthcheck?deep=true')
+
+        self.assertEqual(resp.status_code, 503)
+
+    @patch.object(healthcheck, 'probe')
+    def test_health_check_shallow(self, fake_probe):
+        """A normal health check does not probe dependencies"""
+        self.app.get('/api/1/inf/windows/healthcheck')
+
+        self.assertFalse(fake_probe.results.called)
+
+
+class TestDependencyProbe(unittest.TestCase):
+    """A set of test cases for the DependencyProbe object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.celery_app = MagicMock()
+        self.celery_app.control.inspect.return_value.active_queues.return_value = {
+            'worker1': [{'name': 'celery'}],
+            'worker2': [{'name': 'celery'}],
+        }
+        self.celery_app.send_task.return_value.get.return_value = {
+            'content': {'images': {'ok': True, 'count': 3},
+                        'vcenter': {'ok': True, 'login_ms': 20}},
+        }
+
+    def test_probe(self):
+        """``DependencyProbe`` - probe reports on every dependency"""
+        output = healthcheck.DependencyProbe().probe(self.celery_app)
+        expected = {'broker', 'workers', 'images', 'vcenter', 'checked'}
+
+        self.assertEqual(set(output.keys()), expected)
+
+    def test_probe_workers(self):
+        """``DependencyProbe`` - probe counts the live workers per queue"""
+        output = healthcheck.DependencyProbe().probe(self.celery_app)
+        expected = {'ok': True, 'queues': {'celery': 2}}
+
+        self.assertEqual(output['workers'], expected)
+
+    def test_probe_no_workers(self):
+        """``DependencyProbe`` - probe marks the worker dependencies as failed if no worker responds"""
+        self.celery_app.send_task.return_value.get.side_effect = RuntimeError('timeout')
+        output = healthcheck.DependencyProbe().probe(self.celery_app)
+
+        self.assertFalse(output['vcenter']['ok'])
+        self.assertFalse(output['images']['ok'])
+
+    def test_probe_expires(self):
+        """``DependencyProbe`` - probe sends a task that expires once the probe stops waiting on it"""
+        healthcheck.DependencyProbe(timeout=7).probe(self.celery_app)
+        _, the_kwargs = self.celery_app.send_task.call_args
+
+        self.assertEqual(the_kwargs['expires'], 7)
+
+    def test_probe_broker_down(self):
+        """``DependencyProbe`` - probe marks the broker as failed if it cannot connect"""
+        self.celery_app.connection_for_write.side_effect = OSError('nope')
+        output = healthcheck.DependencyProbe().probe(self.celery_app)
+
+        self.assertFalse(output['broker']['ok'])
+
+    @patch.object(healthcheck.threading, 'Thread')
+    def test_results_cached(self, fake_Thread):
+        """``DependencyProbe`` - results only probes on the first call; the background thread does the rest"""
+        the_probe = healthcheck.DependencyProbe()
+        the_probe.results(self.celery_app)
+        the_probe.results(self.celery_app)
+
+        self.assertEqual(self.celery_app.send_task.call_count, 1)
+        self.assertEqual(fake_Thread.return_value.start.call_count, 1)
+
 
 if __name__ == '__main__':
     unittest.main()
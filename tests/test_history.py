@@ -0,0 +1,135 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in history.py
+"""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_windows_api.lib.worker import history
+
+
+def make_entry(task='create', image='10', outcome='ok', duration=1.0, finished=100, timings=None):
+    """Build a history entry"""
+    return {'finished': finished, 'task': task, 'task_id': 'some-task', 'username': 'bob',
+            'image': image, 'datastore': 'ds1', 'outcome': outcome, 'duration': duration,
+            'queue_wait': None, 'uploaded': 0, 'timings': timings or {}}
+
+
+class TestHistory(unittest.TestCase):
+    """A set of test cases for the history.py module"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(history, 'const')
+        fake_const = patcher.start()
+        fake_const.VLAB_WINDOWS_HISTORY_DB = os.path.join(self.tmp_dir.name, 'history.db')
+        fake_const.VLAB_WINDOWS_HISTORY_DAYS = 0
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_stats_phase(self):
+        """``Stats.phase`` records how long a block of code took"""
+        stats = history.Stats()
+        with stats.phase('upload'):
+            pass
+
+        self.assertEqual(list(stats.params()['timings'].keys()), ['upload'])
+
+    def test_make_entry(self):
+        """``make_entry`` pulls the stats out of the task's response"""
+        retval = {'content': {}, 'error': None, 'params': {'timings': {'upload': 3}, 'uploaded': 10,
+                                                            'datastore': 'ds1', 'queue_wait': 2}}
+
+        output = history.make_entry('windows.create', 'some-task', {'username': 'bob', 'image': '10'},
+                                    retval, 'SUCCESS', 5)
+
+        self.assertEqual(output['task'], 'create')
+        self.assertEqual(output['outcome'], 'ok')
+        self.assertEqual(output['image'], '10')
+        self.assertEqual(output['uploaded'], 10)
+        self.assertEqual(output['timings'], {'upload': 3})
+
+    def test_make_entry_outcome(self):
+        """``make_entry`` tells apart errors, cancels and exceptions"""
+        error = history.make_entry('windows.create', 'a', {}, {'error': 'doh', 'params': {}}, 'SUCCESS', 1)
+        cancelled = history.make_entry('windows.create', 'a', {}, {'error': 'doh', 'params': {'state': 'cancelled'}},
+                                       'SUCCESS', 1)
+        exception = history.make_entry('windows.create', 'a', {}, RuntimeError('doh'), 'FAILURE', 1)
+
+        self.assertEqual([error['outcome'], cancelled['outcome'], exception['outcome']],
+                         ['error', 'cancelled', 'exception'])
+
+    def test_percentiles(self):
+        """``percentiles`` reports the durations by task and image"""
+        history.write([make_entry(duration=x) for x in range(1, 101)])
+        history.write([make_entry(image='7', duration=9), make_entry(task='delete', image='7', duration=2)])
+
+        output = history.percentiles(tasks=['create'])
+
+        self.assertEqual(output['create']['10']['p50'], 50)
+        self.assertEqual(output['create']['10']['p95'], 95)
+        self.assertEqual(output['create']['10']['p99'], 99)
+        self.assertEqual(output['create']['7']['p99'], 9)
+        self.assertTrue('delete' not in output)
+
+    def test_popular_images(self):
+        """``popular_images`` orders images by how often they were created OK"""
+        history.write([make_entry(image='7'), make_entry(image='10'), make_entry(image='10'),
+                       make_entry(image='8', outcome='error'), make_entry(task='delete', image='8'),
+                       make_entry(image='11', finished=1)])
+
+        output = history.popular_images(since=50)
+
+        self.assertEqual(output, ['10', '7'])
+
+    def test_percentiles_window(self):
+        """``percentiles`` only includes tasks that finished within the window"""
+        history.write([make_entry(finished=100, duration=1), make_entry(finished=200, duration=2)])
+
+        output = history.percentiles(since=150, until=250)
+
+        self.assertEqual(output['create']['10']['count'], 1)
+        self.assertEqual(output['create']['10']['p50'], 2)
+
+    def test_percentiles_failed(self):
+        """``percentiles`` counts failed tasks, but leaves them out of the durations"""
+        history.write([make_entry(duration=1), make_entry(outcome='error', duration=500)])
+
+        output = history.percentiles()
+
+        self.assertEqual(output['create']['10']['failed'], 1)
+        self.assertEqual(output['create']['10']['p99'], 1)
+
+    def test_percentiles_timings(self):
+        """``percentiles`` reports the durations of each phase"""
+        history.write([make_entry(timings={'upload': 3.0})])
+
+        output = history.percentiles()
+
+        self.assertEqual(output['create']['10']['timings'], {'upload': {'p50': 3.0, 'p95': 3.0, 'p99': 3.0}})
+
+    def test_record(self):
+        """``record`` writes entries in the background"""
+        history.record(make_entry())
+        history.flush()
+
+        output = history.percentiles()
+
+        self.assertEqual(output['create']['10']['count'], 1)
+
+    def test_prune(self):
+        """``write`` drops entries older than VLAB_WINDOWS_HISTORY_DAYS"""
+        history.const.VLAB_WINDOWS_HISTORY_DAYS = 1
+        with patch.dict(history._writer, {'pruned': 0}):
+            history.write([make_entry(finished=100), make_entry(finished=history.time.time())])
+
+        output = history.percentiles()
+
+        self.assertEqual(output['create']['10']['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
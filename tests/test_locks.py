@@ -0,0 +1,162 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in locks.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_windows_api.lib.worker import history, locks
+
+
+class TestMemoryLeases(unittest.TestCase):
+    """A set of test cases for the MemoryLeases object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.leases = locks.MemoryLeases()
+
+    def test_acquire(self):
+        """``MemoryLeases`` - acquire returns True when the lease is free"""
+        self.assertTrue(self.leases.acquire('bob/win10', 'owner-1', 60))
+
+    def test_acquire_held(self):
+        """``MemoryLeases`` - acquire returns False while someone else holds the lease"""
+        self.leases.acquire('bob/win10', 'owner-1', 60)
+
+        self.assertFalse(self.leases.acquire('bob/win10', 'owner-2', 60))
+
+    def test_acquire_expired(self):
+        """``MemoryLeases`` - acquire ignores a lease that expired"""
+        self.leases.acquire('bob/win10', 'owner-1', -1)
+
+        self.assertTrue(self.leases.acquire('bob/win10', 'owner-2', 60))
+
+    def test_release(self):
+        """``MemoryLeases`` - release frees the lease"""
+        self.leases.acquire('bob/win10', 'owner-1', 60)
+        self.leases.release('bob/win10', 'owner-1')
+
+        self.assertTrue(self.leases.acquire('bob/win10', 'owner-2', 60))
+
+    def test_release_other_owner(self):
+        """``MemoryLeases`` - release does not free a lease someone else holds"""
+        self.leases.acquire('bob/win10', 'owner-1', 60)
+        self.leases.release('bob/win10', 'owner-2')
+
+        self.assertFalse(self.leases.acquire('bob/win10', 'owner-2', 60))
+
+
+class TestHold(unittest.TestCase):
+    """A set of test cases for the ``hold`` function"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.leases = locks.MemoryLeases()
+        backend_patcher = patch.object(locks, 'backend', self.leases)
+        backend_patcher.start()
+        self.addCleanup(backend_patcher.stop)
+        const_patcher = patch.object(locks, 'const')
+        self.fake_const = const_patcher.start()
+        self.fake_const.VLAB_WINDOWS_LOCK_WAIT = 0
+        self.fake_const.VLAB_WINDOWS_LOCK_TTL = 60
+        self.addCleanup(const_patcher.stop)
+
+    def test_hold(self):
+        """``hold`` locks the VM only while the block runs"""
+        with locks.hold('bob', ['win10']):
+            self.assertFalse(self.leases.acquire('bob/win10', 'someone-else', 60))
+
+        self.assertTrue(self.leases.acquire('bob/win10', 'someone-else', 60))
+
+    @patch.object(locks.time, 'sleep')
+    def test_hold_no_wait(self, fake_sleep):
+        """``hold`` gives up right away when told not to wait"""
+        self.fake_const.VLAB_WINDOWS_LOCK_WAIT = 60
+        self.leases.acquire('bob/win10', 'someone-else', 60)
+
+        with self.assertRaises(locks.LockTimeout):
+            with locks.hold('bob', ['win10'], wait=0):
+                pass
+
+        self.assertFalse(fake_sleep.called)
+
+    def test_hold_other_vms(self):
+        """``hold`` does not block changes to other VMs, or other users"""
+        with locks.hold('bob', ['win10']):
+            self.assertTrue(self.leases.acquire('bob/win7', 'someone-else', 60))
+            self.assertTrue(self.leases.acquire('alice/win10', 'someone-else', 60))
+
+    def test_hold_releases_on_error(self):
+        """``hold`` releases the locks when the block raises"""
+        with self.assertRaises(RuntimeError):
+            with locks.hold('bob', ['win10']):
+                raise RuntimeError('testing')
+
+        self.assertTrue(self.leases.acquire('bob/win10', 'someone-else', 60))
+
+    def test_hold_timeout(self):
+        """``hold`` raises LockTimeout when the VM stays locked"""
+        self.leases.acquire('bob/win10', 'someone-else', 60)
+
+        with self.assertRaises(locks.LockTimeout):
+            with locks.hold('bob', ['win10']):
+                pass
+
+    def test_hold_timeout_is_transient(self):
+        """``hold`` - LockTimeout is worth retrying"""
+        self.assertTrue(locks.transient.is_transient(locks.LockTimeout('testing')))
+
+    def test_hold_partial(self):
+        """``hold`` releases the locks it got, when it can't get all of them"""
+        self.leases.acquire('bob/win7', 'someone-else', 60)
+
+        with self.assertRaises(locks.LockTimeout):
+            with locks.hold('bob', ['win10', 'win7']):
+                pass
+
+        self.assertTrue(self.leases.acquire('bob/win10', 'someone-else', 60))
+
+    @patch.object(locks.time, 'sleep')
+    def test_hold_waits(self, fake_sleep):
+        """``hold`` waits for the VM to be unlocked"""
+        self.fake_const.VLAB_WINDOWS_LOCK_WAIT = 60
+        self.leases.acquire('bob/win10', 'someone-else', 60)
+        fake_sleep.side_effect = lambda _: self.leases.release('bob/win10', 'someone-else')
+
+        with locks.hold('bob', ['win10']):
+            pass
+
+        self.assertEqual(fake_sleep.call_count, 1)
+
+    def test_hold_cancelled(self):
+        """``hold`` stops waiting when the task is cancelled"""
+        self.leases.acquire('bob/win10', 'someone-else', 60)
+
+        with self.assertRaises(locks.deploy.Cancelled):
+            with locks.hold('bob', ['win10'], should_stop=lambda: True):
+                pass
+
+    def test_hold_sorted(self):
+        """``hold`` locks VMs in sorted order, so two tasks can't deadlock"""
+        fake_backend = MagicMock()
+        fake_backend.acquire.return_value = True
+
+        with patch.object(locks, 'backend', fake_backend):
+            with locks.hold('bob', ['win7', 'win10', 'win7']):
+                pass
+        names = [x[0][0] for x in fake_backend.acquire.call_args_list]
+
+        self.assertEqual(names, ['bob/win10', 'bob/win7'])
+
+    def test_hold_stats(self):
+        """``hold`` records how long it waited as the lock_wait phase"""
+        stats = history.Stats()
+
+        with locks.hold('bob', ['win10'], stats=stats):
+            pass
+
+        self.assertTrue('lock_wait' in stats.timings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in network_cache.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_windows_api.lib.worker import network_cache
+
+
+class TestNetworkCache(unittest.TestCase):
+    """A set of test cases for the NetworkCache object"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache = network_cache.NetworkCache(ttl=300)
+        self.fake_vcenter = MagicMock()
+        self.networks = [{'name': 'bob_lan', 'obj': network_cache.vim.Network('network-1')},
+                         {'name': 'bob_wan', 'obj': network_cache.vim.dvs.DistributedVirtualPortgroup('dvportgroup-2')}]
+
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_lookup(self, fake_retrieve):
+        """``NetworkCache`` - lookup returns a network bound to the supplied vCenter session"""
+        fake_retrieve.return_value = self.networks
+
+        output = self.cache.lookup(self.fake_vcenter, 'bob_wan')
+
+        self.assertTrue(isinstance(output, network_cache.vim.dvs.DistributedVirtualPortgroup))
+        self.assertEqual(output._moId, 'dvportgroup-2')
+        self.assertTrue(output._stub is self.fake_vcenter._conn._stub)
+
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_lookup_cached(self, fake_retrieve):
+        """``NetworkCache`` - lookup does not traverse vCenter while the mapping is fresh"""
+        fake_retrieve.return_value = self.networks
+
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+        self.cache.lookup(self.fake_vcenter, 'bob_wan')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+
+    @patch.object(network_cache.time, 'time')
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_lookup_expired(self, fake_retrieve, fake_time):
+        """``NetworkCache`` - lookup refreshes the mapping once the TTL expires"""
+        fake_retrieve.return_value = self.networks
+        fake_time.side_effect = [1000, 1000, 1400, 1400]
+
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+
+        self.assertEqual(fake_retrieve.call_count, 2)
+
+    @patch.object(network_cache.time, 'time')
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_lookup_refresh_on_miss(self, fake_retrieve, fake_time):
+        """``NetworkCache`` - lookup refreshes the mapping when a name is not cached"""
+        fake_retrieve.side_effect = [self.networks[:1], self.networks]
+        fake_time.side_effect = [1000, 1000, 1010, 1010]
+
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+        output = self.cache.lookup(self.fake_vcenter, 'bob_wan')
+
+        self.assertEqual(output._moId, 'dvportgroup-2')
+
+    @patch.object(network_cache.time, 'time')
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_lookup_miss_rate_limited(self, fake_retrieve, fake_time):
+        """``NetworkCache`` - lookup does not refresh on every miss"""
+        fake_retrieve.return_value = self.networks
+        fake_time.side_effect = [1000, 1000, 1001]
+
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+        with self.assertRaises(KeyError):
+            self.cache.lookup(self.fake_vcenter, 'bob_nope')
+
+        self.assertEqual(fake_retrieve.call_count, 1)
+
+    @patch.object(network_cache.collector, 'retrieve')
+    def test_invalidate(self, fake_retrieve):
+        """``NetworkCache`` - invalidate forces the next lookup to refresh"""
+        fake_retrieve.return_value = self.networks
+
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+        self.cache.invalidate('bob_lan')
+        self.cache.lookup(self.fake_vcenter, 'bob_lan')
+
+        self.assertEqual(fake_retrieve.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in preflight.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_windows_api.lib.worker import preflight
+
+
+class TestPreflight(unittest.TestCase):
+    """A set of test cases for the preflight.py module"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        patcher = patch.object(preflight, 'const')
+        self.fake_const = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_const.VLAB_WINDOWS_USER_VM_LIMIT = 0
+        self.fake_const.VLAB_WINDOWS_MIN_FREE_GB = 0
+        patcher = patch.object(preflight.deploy, 'OvaImage')
+        self.fake_OvaImage = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_OvaImage.return_value.disk_space = 10 * 1024 ** 3
+        patcher = patch.object(preflight.deploy, 'pick_datastore')
+        self.fake_pick_datastore = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_pick_datastore.return_value.summary.freeSpace = 100 * 1024 ** 3
+        patcher = patch.object(preflight, 'network_cache')
+        self.fake_network_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(preflight, 'collector')
+        self.fake_collector = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_collector.retrieve.return_value = []
+        self.vcenter = MagicMock()
+
+    def _check(self, machine_name='win10'):
+        """Run ``check`` with some typical arguments"""
+        return preflight.check(self.vcenter, 'alice', machine_name, '10', '/images/Windows-10.ova', 'alice_frontend')
+
+    def test_check(self):
+        """``check`` returns what's needed to create the VM"""
+        output = self._check()
+
+        self.assertTrue(output['ova'] is self.fake_OvaImage.return_value)
+        self.assertTrue(output['network'] is self.fake_network_cache.lookup.return_value)
+        self.assertTrue(output['datastore'] is self.fake_pick_datastore.return_value)
+
+    def test_check_bad_image(self):
+        """``check`` reports an image that does not exist"""
+        self.fake_OvaImage.side_effect = FileNotFoundError('testing')
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(the_error.exception.problems, ['Invalid verison of Windows supplied: 10'])
+
+    def test_check_bad_network(self):
+        """``check`` reports a network that does not exist"""
+        self.fake_network_cache.lookup.side_effect = KeyError('alice_frontend')
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(the_error.exception.problems, ['No such network named alice_frontend'])
+
+    def test_check_no_folder(self):
+        """``check`` reports when the user has no folder"""
+        self.vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(the_error.exception.problems, ['No folder found for user alice'])
+
+    def test_check_name_taken(self):
+        """``check`` reports when the user already has a VM with the name"""
+        self.fake_collector.retrieve.return_value = [{'name': 'win10', 'obj': MagicMock()}]
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(the_error.exception.problems, ['You already have a VM named win10'])
+
+    def test_check_vm_limit(self):
+        """``check`` reports when the user is at their limit of Windows VMs"""
+        self.fake_const.VLAB_WINDOWS_USER_VM_LIMIT = 1
+        self.fake_collector.retrieve.return_value = [{'name': 'win7', 'obj': MagicMock(),
+                                                      'config.annotation': ujson.dumps({'component': 'Windows'})},
+                                                     {'name': 'cent', 'obj': MagicMock(),
+                                                      'config.annotation': ujson.dumps({'component': 'CentOS'})}]
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(len(the_error.exception.problems), 1)
+
+    def test_check_space(self):
+        """``check`` reports when the datastore does not have room for the image"""
+        self.fake_pick_datastore.return_value.summary.freeSpace = 5 * 1024 ** 3
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check()
+
+        self.assertEqual(len(the_error.exception.problems), 1)
+
+    def test_check_all_problems(self):
+        """``check`` reports every problem at once, and closes the OVA"""
+        self.fake_network_cache.lookup.side_effect = KeyError('alice_frontend')
+        self.fake_collector.retrieve.return_value = [{'name': 'win_10!', 'obj': MagicMock()}]
+
+        with self.assertRaises(preflight.PreflightError) as the_error:
+            self._check(machine_name='win_10!')
+
+        self.assertEqual(len(the_error.exception.problems), 3)
+        self.assertTrue(self.fake_OvaImage.return_value.close.called)
+
+    def test_preflight_error(self):
+        """``PreflightError`` is a ValueError, so tasks report it like any other bad input"""
+        self.assertTrue(issubclass(preflight.PreflightError, ValueError))
+
+
+if __name__ == '__main__':
+    unittest.main()
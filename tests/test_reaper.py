@@ -0,0 +1,188 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in reaper.py
+"""
+import datetime
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_windows_api.lib.worker import reaper
+
+
+NOW = 100 * reaper.DAY
+FOLDER = reaper.vim.Folder('group-1')
+
+
+def make_vm(name, meta=None, state='poweredOn', guest_id='windows9_64Guest', created_days_ago=1):
+    """Build a fake entry like the ones the PropertyCollector returns"""
+    created = datetime.datetime.fromtimestamp(NOW - created_days_ago * reaper.DAY, tz=datetime.timezone.utc)
+    return {'name': name,
+            'obj': reaper.vim.VirtualMachine('vm-{}'.format(name)),
+            'parent': FOLDER,
+            'config.annotation': ujson.dumps(meta) if meta else '',
+            'config.guestId': guest_id,
+            'config.createDate': created,
+            'runtime.powerState': state,
+            'summary.storage.committed': 100}
+
+
+def windows_meta(created_days_ago):
+    """The meta data of a Windows VM made some days ago"""
+    return {'component': 'Windows', 'version': '10', 'created': NOW - created_days_ago * reaper.DAY}
+
+
+class TestReaper(unittest.TestCase):
+    """A set of test cases for the reaper.py module"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        patcher = patch.object(reaper, 'const')
+        self.fake_const = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_const.VLAB_WINDOWS_REAP_MAX_AGE_DAYS = 30
+        self.fake_const.VLAB_WINDOWS_REAP_IDLE_DAYS = 7
+        self.fake_const.VLAB_WINDOWS_REAP_ORPHAN_HOURS = 6
+        self.fake_const.VLAB_WINDOWS_REAP_BATCH = 2
+        self.fake_const.VLAB_WINDOWS_REAP_BATCH_DELAY = 30
+        patcher = patch.object(reaper, 'store')
+        self.fake_store = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_store.track_idle.return_value = {}
+        self.fake_store.in_progress_creates.return_value = set()
+        patcher = patch.object(reaper, 'collector')
+        self.fake_collector = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(reaper.locks, 'backend', reaper.locks.MemoryLeases())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _find_stale(self, vms):
+        """Run ``find_stale`` against some fake VMs, and return the names and reasons"""
+        self.fake_collector.retrieve_many.return_value = [{'name': 'alice', 'obj': FOLDER}] + vms
+        output = reaper.find_stale(MagicMock(), now=NOW)
+        return {x['name']: x['reason'] for x in output}
+
+    def test_find_stale_age(self):
+        """``find_stale`` picks out VMs older than the max age"""
+        output = self._find_stale([make_vm('old', windows_meta(40)), make_vm('new', windows_meta(1))])
+
+        self.assertEqual(output, {'old': 'age'})
+
+    def test_find_stale_idle(self):
+        """``find_stale`` picks out VMs that have been powered off too long"""
+        self.fake_store.track_idle.return_value = {'vm-idle': NOW - 10 * reaper.DAY,
+                                                   'vm-nap': NOW - reaper.DAY}
+
+        output = self._find_stale([make_vm('idle', windows_meta(1), state='poweredOff'),
+                                   make_vm('nap', windows_meta(1), state='poweredOff')])
+
+        self.assertEqual(output, {'idle': 'idle'})
+
+    def test_find_stale_orphan(self):
+        """``find_stale`` picks out old Windows VMs without any meta data"""
+        output = self._find_stale([make_vm('orphan'),
+                                   make_vm('importing', created_days_ago=0),
+                                   make_vm('other-service', guest_id='centos8_64Guest')])
+
+        self.assertEqual(output, {'orphan': 'orphan'})
+
+    def test_find_stale_ignores_others(self):
+        """``find_stale`` ignores VMs made by other services"""
+        output = self._find_stale([make_vm('cent', {'component': 'CentOS', 'created': 0})])
+
+        self.assertEqual(output, {})
+
+    def test_find_stale_creating(self):
+        """``find_stale`` ignores VMs that are still being created"""
+        self.fake_store.in_progress_creates.return_value = {('alice', 'orphan')}
+
+        output = self._find_stale([make_vm('orphan')])
+
+        self.assertEqual(output, {})
+
+    def test_find_stale_no_parent(self):
+        """``find_stale`` skips VMs that aren't in a folder, like the ones in a vApp"""
+        vm = make_vm('old', windows_meta(4000))
+        del vm['parent']
+
+        self.assertEqual(self._find_stale([vm]), {})
+
+    def test_find_stale_disabled(self):
+        """``find_stale`` - a policy set to zero is disabled"""
+        self.fake_const.VLAB_WINDOWS_REAP_MAX_AGE_DAYS = 0
+        self.fake_const.VLAB_WINDOWS_REAP_ORPHAN_HOURS = 0
+
+        output = self._find_stale([make_vm('old', windows_meta(40)), make_vm('orphan')])
+
+        self.assertEqual(output, {})
+
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper.virtual_machine, 'power')
+    def test_reap_dry_run(self, fake_power, fake_consume_task):
+        """``reap`` does not destroy anything on a dry run"""
+        self.fake_collector.retrieve_many.return_value = [{'name': 'alice', 'obj': FOLDER},
+                                                          make_vm('old', windows_meta(4000))]
+
+        output = reaper.reap(MagicMock(), MagicMock(), dry_run=True)
+
+        self.assertEqual([x['name'] for x in output['stale']], ['old'])
+        self.assertEqual(output['reaped'], [])
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(reaper.time, 'sleep')
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper.virtual_machine, 'power')
+    def test_reap(self, fake_power, fake_consume_task, fake_sleep):
+        """``reap`` destroys the stale VMs in batches, and counts what it reclaimed"""
+        vms = [make_vm('old{}'.format(x), windows_meta(4000)) for x in range(5)]
+        for vm in vms:
+            vm['obj'] = MagicMock()
+            vm['obj']._moId = 'vm-{}'.format(vm['name'])
+        self.fake_collector.retrieve_many.return_value = [{'name': 'alice', 'obj': FOLDER}] + vms
+
+        output = reaper.reap(MagicMock(), MagicMock(), dry_run=False)
+
+        self.assertEqual(len(output['reaped']), 5)
+        self.assertEqual(fake_sleep.call_count, 2)
+        self.assertEqual(self.fake_store.incr_counters.call_count, 5)
+
+    @patch.object(reaper.time, 'sleep')
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper.virtual_machine, 'power')
+    def test_reap_failure(self, fake_power, fake_consume_task, fake_sleep):
+        """``reap`` keeps going when one VM fails to be destroyed"""
+        vms = [make_vm('old{}'.format(x), windows_meta(4000)) for x in range(2)]
+        for vm in vms:
+            vm['obj'] = MagicMock()
+            vm['obj']._moId = 'vm-{}'.format(vm['name'])
+        self.fake_collector.retrieve_many.return_value = [{'name': 'alice', 'obj': FOLDER}] + vms
+        fake_consume_task.side_effect = [RuntimeError('testing'), None]
+
+        output = reaper.reap(MagicMock(), MagicMock(), dry_run=False)
+
+        self.assertEqual(output['reaped'], ['alice/old1'])
+        self.assertEqual(output['failed'], {'alice/old0': 'testing'})
+
+    @patch.object(reaper.time, 'sleep')
+    @patch.object(reaper, 'consume_task')
+    @patch.object(reaper.virtual_machine, 'power')
+    def test_reap_locked(self, fake_power, fake_consume_task, fake_sleep):
+        """``reap`` skips a VM that another task holds the lock for"""
+        vms = [make_vm('old{}'.format(x), windows_meta(4000)) for x in range(2)]
+        for vm in vms:
+            vm['obj'] = MagicMock()
+            vm['obj']._moId = 'vm-{}'.format(vm['name'])
+        self.fake_collector.retrieve_many.return_value = [{'name': 'alice', 'obj': FOLDER}] + vms
+        reaper.locks.backend.acquire('alice/old0', 'another-task', 60)
+
+        output = reaper.reap(MagicMock(), MagicMock(), dry_run=False)
+
+        self.assertEqual(output['reaped'], ['alice/old1'])
+        self.assertEqual(output['skipped'], ['alice/old0'])
+        self.assertFalse(vms[0]['obj'].Destroy_Task.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in reports.py
+"""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import ujson
+
+from vlab_windows_api.lib import reports
+
+
+class TestReports(unittest.TestCase):
+    """A set of test cases for the reports.py module"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(reports, 'const')
+        fake_const = patcher.start()
+        fake_const.VLAB_WINDOWS_REPORTS_DIR = self.tmp_dir.name
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_write(self):
+        """``write`` returns how many rows were written"""
+        count = reports.write('some-task', ({'type': 'vm', 'name': x} for x in ('win7', 'win10')))
+
+        self.assertEqual(count, 2)
+
+    def test_read(self):
+        """``read`` returns every row of a finished report, without the end marker"""
+        reports.write('some-task', [{'type': 'vm', 'name': 'win7'}, {'type': 'vm', 'name': 'win10'}])
+
+        lines = [ujson.loads(x) for x in b''.join(reports.read('some-task')).splitlines()]
+        expected = [{'type': 'vm', 'name': 'win7'}, {'type': 'vm', 'name': 'win10'}]
+
+        self.assertEqual(lines, expected)
+
+    def test_read_chunks(self):
+        """``read`` sends a big report a chunk at a time"""
+        reports.write('some-task', ({'type': 'vm', 'name': 'win{}'.format(x)} for x in range(100)))
+
+        chunks = list(reports.read('some-task', chunk_size=100))
+        lines = b''.join(chunks).splitlines()
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(len(lines), 100)
+
+    def test_write_error(self):
+        """``write`` records a failure as the last row, so readers know the report is incomplete"""
+        def rows():
+            yield {'name': 'win7'}
+            raise RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            reports.write('some-task', rows())
+        lines = [ujson.loads(x) for x in b''.join(reports.read('some-task')).splitlines()]
+
+        self.assertEqual(lines, [{'name': 'win7'}, {'type': 'error', 'error': 'testing'}])
+
+    def test_status(self):
+        """``status`` is 'missing' before a report starts, and 'finished' once it's written"""
+        self.assertEqual(reports.status('some-task'), 'missing')
+        reports.write('some-task', [{'name': 'win7'}])
+
+        self.assertEqual(reports.status('some-task'), 'finished')
+
+    def test_status_writing(self):
+        """``status`` is 'writing' while the worker is still adding rows"""
+        with open(reports.path('some-task'), 'wb') as the_file:
+            the_file.write(b'{"name": "win7"}\n{"name": "wi')
+
+        self.assertEqual(reports.status('some-task'), 'writing')
+
+    @patch.object(reports, 'IDLE_TIMEOUT', 0)
+    def test_status_abandoned(self):
+        """``status`` is 'abandoned' for a report that stopped growing before it finished"""
+        with open(reports.path('some-task'), 'wb') as the_file:
+            the_file.write(b'{"name": "win7"}\n')
+        os.utime(reports.path('some-task'), (1, 1))
+
+        self.assertEqual(reports.status('some-task'), 'abandoned')
+
+    def test_path_invalid(self):
+        """``path`` does not allow an ID that escapes the reports directory"""
+        with self.assertRaises(ValueError):
+            reports.path('../../etc/passwd')
+
+    def test_prune(self):
+        """``write`` deletes old reports"""
+        old = reports.path('old-task')
+        open(old, 'wb').close()
+        os.utime(old, (0, 0))
+
+        reports.write('some-task', [])
+
+        self.assertFalse(os.path.exists(old))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,383 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in staging.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_windows_api.lib.worker import staging
+
+
+def make_stage(name, last_used=None, size=10 * 1024 ** 3):
+    """Build a fake entry like the ones ``list_stages`` returns"""
+    meta = {}
+    if last_used is not None:
+        meta = {'component': staging.STAGE_COMPONENT, 'last_used': last_used}
+    return {'name': name, 'obj': MagicMock(), 'meta': meta, 'size': size}
+
+
+class TestStaging(unittest.TestCase):
+    """A set of test cases for the staging.py module"""
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                              fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` clones an existing stage instead of uploading the OVA"""
+        fake_stage = MagicMock()
+        fake_find_stage.return_value = fake_stage
+
+        output = staging.clone_from_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+        self.assertTrue(output is fake_wait_for_clone.return_value)
+        self.assertTrue(fake_stage.CloneVM_Task.called)
+        self.assertFalse(fake_create_stage.called)
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_miss(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                   fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` stages the image when it's not already staged, then evicts old stages"""
+        fake_find_stage.return_value = None
+
+        staging.clone_from_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+        self.assertTrue(fake_create_stage.return_value.CloneVM_Task.called)
+        self.assertTrue(fake_evict.called)
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_stage_fails(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                          fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` raises StageUnavailable when the image cannot be staged"""
+        fake_find_stage.return_value = None
+        fake_create_stage.side_effect = RuntimeError('DuplicateName')
+
+        with self.assertRaises(staging.StageUnavailable):
+            staging.clone_from_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_clone_fails(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                          fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` raises StageUnavailable when the clone fails without making a VM"""
+        fake_wait_for_clone.side_effect = RuntimeError('testing')
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(staging.StageUnavailable):
+            staging.clone_from_stage(fake_vcenter, MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_clone_leftover(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                             fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` destroys what a failed clone made, and does not allow an OVA import"""
+        fake_the_vm = MagicMock()
+        fake_wait_for_clone.side_effect = [RuntimeError('testing'), None]
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = fake_the_vm
+
+        with self.assertRaises(RuntimeError) as caught:
+            staging.clone_from_stage(fake_vcenter, MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+        self.assertFalse(isinstance(caught.exception, staging.StageUnavailable))
+        self.assertTrue(fake_the_vm.Destroy_Task.called)
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_after_clone(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                          fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` destroys the clone when a later step fails"""
+        fake_change_network.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError) as caught:
+            staging.clone_from_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock())
+
+        self.assertFalse(isinstance(caught.exception, staging.StageUnavailable))
+        self.assertTrue(fake_wait_for_clone.return_value.Destroy_Task.called)
+        self.assertFalse(fake_touch.called)
+
+    @patch.object(staging, '_touch')
+    @patch.object(staging, '_create_stage')
+    @patch.object(staging, 'evict')
+    @patch.object(staging, 'find_stage')
+    @patch.object(staging, 'get_staging_folder')
+    @patch.object(staging.deploy, 'pick_datastore')
+    @patch.object(staging.virtual_machine, 'change_network')
+    @patch.object(staging.virtual_machine, 'power')
+    @patch.object(staging, '_wait_for_clone')
+    @patch.object(staging, 'vim')
+    def test_clone_from_stage_cancelled(self, fake_vim, fake_wait_for_clone, fake_power, fake_change_network, fake_pick_datastore,
+                                        fake_get_staging_folder, fake_find_stage, fake_evict, fake_create_stage, fake_touch):
+        """``clone_from_stage`` stops the clone and destroys what it made when the create is cancelled"""
+        fake_the_vm = MagicMock()
+        fake_wait_for_clone.side_effect = staging.deploy.Cancelled('testing')
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = fake_the_vm
+        fake_task = fake_find_stage.return_value.CloneVM_Task.return_value
+        fake_task.info.completeTime = None
+
+        with self.assertRaises(staging.deploy.Cancelled):
+            staging.clone_from_stage(fake_vcenter, MagicMock(), '10', MagicMock(), 'bob', 'win10', MagicMock(),
+                                     should_stop=lambda: True)
+
+        self.assertTrue(fake_task.CancelTask.called)
+        self.assertTrue(fake_the_vm.Destroy_Task.called)
+
+    @patch.object(staging.time, 'sleep')
+    def test_wait_for_clone_cancelled(self, fake_sleep):
+        """``_wait_for_clone`` stops waiting as soon as the create is cancelled"""
+        fake_task = MagicMock()
+        fake_task.info.completeTime = None
+        cancels = iter([False, True])
+
+        with self.assertRaises(staging.deploy.Cancelled):
+            staging._wait_for_clone(fake_task, lambda: next(cancels))
+
+        self.assertEqual(fake_sleep.call_count, 1)
+
+    def test_wait_for_clone_error(self):
+        """``_wait_for_clone`` raises RuntimeError if the clone fails"""
+        fake_task = MagicMock()
+        fake_task.info.error.msg = 'testing'
+
+        with self.assertRaises(RuntimeError):
+            staging._wait_for_clone(fake_task, lambda: False)
+
+    def test_wait_for_clone(self):
+        """``_wait_for_clone`` returns the new VM once the clone finishes"""
+        fake_task = MagicMock()
+        fake_task.info.error = None
+
+        output = staging._wait_for_clone(fake_task, lambda: False)
+
+        self.assertTrue(output is fake_task.info.result)
+
+    @patch.object(staging.virtual_machine, 'set_meta')
+    @patch.object(staging, '_disconnect')
+    @patch.object(staging, 'const')
+    @patch.object(staging.deploy, 'deploy_from_ova')
+    def test_create_stage(self, fake_deploy_from_ova, fake_const, fake_disconnect, fake_set_meta):
+        """``_create_stage`` imports the OVA with its NICs unplugged"""
+        fake_const.VLAB_WINDOWS_STAGING_NETWORK = ''
+        network_map = MagicMock()
+
+        output = staging._create_stage(MagicMock(), MagicMock(), '10', network_map, 'Windows-10-abc-ds1',
+                                       MagicMock(), MagicMock(), MagicMock())
+        the_args, _ = fake_deploy_from_ova.call_args
+
+        self.assertTrue(output is fake_deploy_from_ova.return_value)
+        self.assertEqual(the_args[2], [network_map])
+        fake_disconnect.assert_called_with(output)
+        self.assertTrue(fake_set_meta.called)
+
+    @patch.object(staging.virtual_machine, 'set_meta')
+    @patch.object(staging, '_disconnect')
+    @patch.object(staging, 'network_cache')
+    @patch.object(staging, 'const')
+    @patch.object(staging.deploy, 'deploy_from_ova')
+    def test_create_stage_neutral(self, fake_deploy_from_ova, fake_const, fake_network_cache, fake_disconnect,
+                                  fake_set_meta):
+        """``_create_stage`` imports the OVA onto ``VLAB_WINDOWS_STAGING_NETWORK`` instead of the user's network"""
+        fake_const.VLAB_WINDOWS_STAGING_NETWORK = 'staging'
+        fake_network_cache.lookup.return_value = staging.vim.Network('network-99')
+        network_map = staging.vim.OvfManager.NetworkMapping(name='VM Network', network=staging.vim.Network('network-1'))
+
+        staging._create_stage(MagicMock(), MagicMock(), '10', network_map, 'Windows-10-abc-ds1',
+                              MagicMock(), MagicMock(), MagicMock())
+        the_args, _ = fake_deploy_from_ova.call_args
+        used_map = the_args[2][0]
+
+        self.assertEqual(used_map.name, 'VM Network')
+        self.assertEqual(used_map.network._moId, 'network-99')
+
+    @patch.object(staging, 'network_cache')
+    @patch.object(staging, 'const')
+    @patch.object(staging.deploy, 'deploy_from_ova')
+    def test_create_stage_no_network(self, fake_deploy_from_ova, fake_const, fake_network_cache):
+        """``_create_stage`` raises RuntimeError, without importing anything, if the staging network does not exist"""
+        fake_const.VLAB_WINDOWS_STAGING_NETWORK = 'staging'
+        fake_network_cache.lookup.side_effect = KeyError('staging')
+
+        with self.assertRaises(RuntimeError):
+            staging._create_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'Windows-10-abc-ds1',
+                                  MagicMock(), MagicMock(), MagicMock())
+
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(staging.virtual_machine, 'set_meta')
+    @patch.object(staging, '_destroy')
+    @patch.object(staging, '_disconnect')
+    @patch.object(staging, 'const')
+    @patch.object(staging.deploy, 'deploy_from_ova')
+    def test_create_stage_disconnect_fails(self, fake_deploy_from_ova, fake_const, fake_disconnect, fake_destroy,
+                                           fake_set_meta):
+        """``_create_stage`` destroys the stage if its NICs cannot be unplugged"""
+        fake_const.VLAB_WINDOWS_STAGING_NETWORK = ''
+        fake_disconnect.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            staging._create_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'Windows-10-abc-ds1',
+                                  MagicMock(), MagicMock(), MagicMock())
+
+        self.assertTrue(fake_destroy.called)
+        self.assertFalse(fake_set_meta.called)
+
+    @patch.object(staging, 'consume_task')
+    def test_disconnect(self, fake_consume_task):
+        """``_disconnect`` unplugs only the NICs of the stage"""
+        nic = staging.vim.vm.device.VirtualVmxnet3()
+        nic.connectable = staging.vim.vm.device.VirtualDevice.ConnectInfo(startConnected=True, connected=True)
+        disk = staging.vim.vm.device.VirtualDisk()
+        fake_stage = MagicMock()
+        fake_stage.config.hardware.device = [nic, disk]
+
+        staging._disconnect(fake_stage)
+        spec = fake_stage.ReconfigVM_Task.call_args[0][0]
+
+        self.assertEqual([x.device for x in spec.deviceChange], [nic])
+        self.assertFalse(nic.connectable.startConnected)
+        self.assertFalse(nic.connectable.connected)
+
+    @patch.object(staging.virtual_machine, 'set_meta')
+    def test_touch(self, fake_set_meta):
+        """``_touch`` ignores failures, since it's only for LRU eviction"""
+        fake_stage = MagicMock()
+        fake_stage.config.annotation = ujson.dumps({'last_used': 1})
+        fake_set_meta.side_effect = RuntimeError('testing')
+        fake_logger = MagicMock()
+
+        staging._touch(fake_stage, fake_logger)
+
+        self.assertTrue(fake_logger.warning.called)
+
+    def test_clone_from_stage_bad_name(self):
+        """``clone_from_stage`` raises ValueError if the machine name is not a valid hostname"""
+        with self.assertRaises(ValueError):
+            staging.clone_from_stage(MagicMock(), MagicMock(), '10', MagicMock(), 'bob', 'win_10!', MagicMock())
+
+    def test_get_stage_name(self):
+        """``get_stage_name`` includes the image, checksum and datastore"""
+        datastore = MagicMock()
+        datastore._moId = 'datastore-12'
+
+        output = staging.get_stage_name('10', 'abcdef0123456789', datastore)
+        expected = 'Windows-10-abcdef012345-datastore-12'
+
+        self.assertEqual(output, expected)
+
+    @patch.object(staging, 'list_stages')
+    def test_find_stage(self, fake_list_stages):
+        """``find_stage`` returns the stage with the matching name"""
+        stage = make_stage('Windows-10-abc-ds1', last_used=1)
+        fake_list_stages.return_value = [make_stage('Windows-7-abc-ds1', last_used=1), stage]
+
+        output = staging.find_stage(MagicMock(), MagicMock(), 'Windows-10-abc-ds1')
+
+        self.assertTrue(output is stage['obj'])
+
+    @patch.object(staging, 'list_stages')
+    def test_find_stage_importing(self, fake_list_stages):
+        """``find_stage`` ignores a stage that has not finished importing"""
+        fake_list_stages.return_value = [make_stage('Windows-10-abc-ds1')]
+
+        output = staging.find_stage(MagicMock(), MagicMock(), 'Windows-10-abc-ds1')
+
+        self.assertTrue(output is None)
+
+    @patch.object(staging, 'collector')
+    def test_list_stages(self, fake_collector):
+        """``list_stages`` parses the meta data of every stage"""
+        fake_collector.retrieve.return_value = [{'name': 'a', 'obj': 'a-obj',
+                                                 'config.annotation': ujson.dumps({'last_used': 3}),
+                                                 'summary.storage.committed': 100},
+                                                {'name': 'b', 'obj': 'b-obj'}]
+
+        output = staging.list_stages(MagicMock(), MagicMock())
+        expected = [{'name': 'a', 'obj': 'a-obj', 'meta': {'last_used': 3}, 'size': 100},
+                    {'name': 'b', 'obj': 'b-obj', 'meta': {}, 'size': 0}]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(staging, 'consume_task')
+    @patch.object(staging, 'const')
+    @patch.object(staging, 'list_stages')
+    def test_evict(self, fake_list_stages, fake_const, fake_consume_task):
+        """``evict`` destroys the least recently used stages until under budget"""
+        fake_const.VLAB_WINDOWS_STAGING_BUDGET_GB = 20
+        fake_list_stages.return_value = [make_stage('new', last_used=300),
+                                         make_stage('old', last_used=100),
+                                         make_stage('mid', last_used=200)]
+
+        output = staging.evict(MagicMock(), MagicMock(), keep='new', logger=MagicMock())
+        expected = ['old']
+
+        self.assertEqual(output, expected)
+
+    @patch.object(staging, 'consume_task')
+    @patch.object(staging, 'const')
+    @patch.object(staging, 'list_stages')
+    def test_evict_keep(self, fake_list_stages, fake_const, fake_consume_task):
+        """``evict`` never destroys the stage it was told to keep, or stages still importing"""
+        fake_const.VLAB_WINDOWS_STAGING_BUDGET_GB = 1
+        fake_list_stages.return_value = [make_stage('new', last_used=1),
+                                         make_stage('importing')]
+
+        output = staging.evict(MagicMock(), MagicMock(), keep='new', logger=MagicMock())
+
+        self.assertEqual(output, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
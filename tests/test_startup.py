@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests that guard how expensive it is to start the API.
+
+Every uWSGI process imports the app, so anything the web tier imports is paid
+for in spawn time and memory for every single process.
+"""
+import sys
+import unittest
+import subprocess
+
+import ujson
+
+
+# Imports the app in a fresh interpreter, and reports which modules it loaded
+PROBE = """
+import sys, json
+import vlab_windows_api.app
+print(json.dumps(list(sys.modules.keys())))
+"""
+
+
+class TestStartup(unittest.TestCase):
+    """A set of test cases for what importing the API loads"""
+    # pyVmomi alone is ~80MB and ~0.5 seconds per process. Checking what's
+    # imported, instead of timing it, catches a regression on any machine.
+    HEAVY_MODULES = ('pyVmomi', 'pyVim', 'pkg_resources', 'gevent',
+                     'vlab_inf_common.vmware', 'vlab_windows_api.lib.worker')
+
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', PROBE])
+        cls.modules = set(ujson.loads(output.decode().strip().split('\n')[-1]))
+
+    def test_no_heavy_imports(self):
+        """The API does not import vCenter/pyVmomi, pkg_resources, or the worker"""
+        loaded = [x for x in self.HEAVY_MODULES if x in self.modules]
+
+        self.assertEqual(loaded, [])
+
+    def test_no_heavy_submodules(self):
+        """The API does not import any part of the heavy packages"""
+        loaded = sorted(x for x in self.modules if x.startswith(tuple('{}.'.format(y) for y in self.HEAVY_MODULES)))
+
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in store.py
+"""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_windows_api.lib.worker import store
+
+
+class TestStore(unittest.TestCase):
+    """A set of test cases for the store.py module"""
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(store, 'const')
+        fake_const = patcher.start()
+        fake_const.VLAB_WINDOWS_STATE_DB = os.path.join(self.tmp_dir.name, 'state.db')
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_acquire_lease(self):
+        """``acquire_lease`` returns True when nobody holds the lease"""
+        self.assertTrue(store.acquire_lease('bob/win10', 'owner-1', 60))
+
+    def test_acquire_lease_held(self):
+        """``acquire_lease`` returns False while someone else holds the lease, and True for the owner"""
+        store.acquire_lease('bob/win10', 'owner-1', 60)
+
+        self.assertFalse(store.acquire_lease('bob/win10', 'owner-2', 60))
+        self.assertTrue(store.acquire_lease('bob/win10', 'owner-1', 60))
+
+    def test_acquire_lease_expired(self):
+        """``acquire_lease`` ignores a lease left by a worker that died"""
+        store.acquire_lease('bob/win10', 'owner-1', -1)
+
+        self.assertTrue(store.acquire_lease('bob/win10', 'owner-2', 60))
+
+    def test_release_lease(self):
+        """``release_lease`` only frees a lease for its owner"""
+        store.acquire_lease('bob/win10', 'owner-1', 60)
+        store.release_lease('bob/win10', 'owner-2')
+        held = not store.acquire_lease('bob/win10', 'owner-2', 60)
+        store.release_lease('bob/win10', 'owner-1')
+
+        self.assertTrue(held)
+        self.assertTrue(store.acquire_lease('bob/win10', 'owner-2', 60))
+
+    def test_acquire_slot(self):
+        """``acquire_slot`` returns True while the user is under their limit"""
+        self.assertTrue(store.acquire_slot('bob', 'task-1', limit=2))
+        self.assertTrue(store.acquire_slot('bob', 'task-2', limit=2))
+
+    def test_acquire_slot_limit(self):
+        """``acquire_slot`` returns False once the user is at their limit"""
+        store.acquire_slot('bob', 'task-1', limit=1)
+
+        self.assertFalse(store.acquire_slot('bob', 'task-2', limit=1))
+
+    def test_acquire_slot_per_user(self):
+        """``acquire_slot`` - one user's creates do not count against another user"""
+        store.acquire_slot('bob', 'task-1', limit=1)
+
+        self.assertTrue(store.acquire_slot('alice', 'task-2', limit=1))
+
+    def test_acquire_slot_no_limit(self):
+        """``acquire_slot`` - a limit of zero means no limit"""
+        for idx in range(10):
+            store.acquire_slot('bob', 'task-{}'.format(idx), limit=0)
+
+        self.assertTrue(store.acquire_slot('bob', 'task-10', limit=0))
+
+    def test_acquire_slot_stale(self):
+        """``acquire_slot`` ignores slots leaked by a worker that died"""
+        with patch.object(store.time, 'time', return_value=1):
+            store.acquire_slot('bob', 'task-1', limit=1)
+
+        self.assertTrue(store.acquire_slot('bob', 'task-2', limit=1))
+
+    def test_release_slot(self):
+        """``release_slot`` frees up the slot for another create"""
+        store.acquire_slot('bob', 'task-1', limit=1)
+        store.release_slot('task-1')
+
+        self.assertTrue(store.acquire_slot('bob', 'task-2', limit=1))
+
+    def test_find_create(self):
+        """``find_create`` returns the task creating a user's VM"""
+        store.register_create('task-1', 'bob', 'win10')
+
+        self.assertEqual(store.find_create('bob', 'win10'), 'task-1')
+        self.assertTrue(store.find_create('alice', 'win10') is None)
+
+    def test_finish_create(self):
+        """``finish_create`` forgets about the create"""
+        store.register_create('task-1', 'bob', 'win10')
+        store.finish_create('task-1')
+
+        self.assertTrue(store.find_create('bob', 'win10') is None)
+
+    def test_cancel_create(self):
+        """``cancel_create`` returns True when the create is in progress"""
+        store.register_create('task-1', 'bob', 'win10')
+
+        self.assertTrue(store.cancel_create('bob', 'task-1'))
+        self.assertTrue(store.is_cancelled('task-1', 'bob'))
+
+    def test_cancel_create_queued(self):
+        """``cancel_create`` - a create cancelled before it started still sees the cancel"""
+        self.assertFalse(store.cancel_create('bob', 'task-1'))
+
+        store.register_create('task-1', 'bob', 'win10')
+
+        self.assertTrue(store.is_cancelled('task-1', 'bob'))
+
+    def test_cancel_create_other_user(self):
+        """``cancel_create`` - a user cannot cancel someone else's create"""
+        store.register_create('task-1', 'bob', 'win10')
+        store.cancel_create('alice', 'task-1')
+
+        self.assertFalse(store.is_cancelled('task-1', 'bob'))
+
+    def test_in_progress_creates(self):
+        """``in_progress_creates`` returns the user and name of every create"""
+        store.register_create('task-1', 'bob', 'win10')
+
+        self.assertEqual(store.in_progress_creates(), {('bob', 'win10')})
+
+    def test_track_idle(self):
+        """``track_idle`` remembers when a VM was first seen powered off"""
+        store.track_idle(['vm-1'], now=100)
+        output = store.track_idle(['vm-1', 'vm-2'], now=200)
+
+        self.assertEqual(output, {'vm-1': 100, 'vm-2': 200})
+
+    def test_track_idle_powered_on(self):
+        """``track_idle`` forgets VMs that were powered back on"""
+        store.track_idle(['vm-1'], now=100)
+        store.track_idle([], now=200)
+        output = store.track_idle(['vm-1'], now=300)
+
+        self.assertEqual(output, {'vm-1': 300})
+
+    def test_counters(self):
+        """``incr_counters`` adds to the counters ``counters`` returns"""
+        store.incr_counters({'reaper.vms': 1, 'reaper.bytes': 100})
+        store.incr_counters({'reaper.vms': 1})
+
+        self.assertEqual(store.counters(), {'reaper.vms': 2, 'reaper.bytes': 100})
+
+    def test_wait_stats(self):
+        """``wait_stats`` reports the mean and max queue wait per user"""
+        store.record_wait('bob', 2.0)
+        store.record_wait('bob', 4.0)
+        store.record_wait('alice', 1.0)
+
+        output = store.wait_stats()
+        expected = {'bob': {'count': 2, 'mean': 3.0, 'max': 4.0},
+                    'alice': {'count': 1, 'mean': 1.0, 'max': 1.0}}
+
+        self.assertEqual(output, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
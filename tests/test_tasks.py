@@ -5,6 +5,8 @@ A suite of tests for the functions in tasks.py
 import unittest
 from unittest.mock import patch, MagicMock
 
+from celery.exceptions import Retry
+
 from vlab_windows_api.lib.worker import tasks
 
 
@@ -13,13 +15,23 @@ class TestTasks(unittest.TestCase):
     @patch.object(tasks, 'vmware')
     def test_show_ok(self, fake_vmware):
         """``show`` returns a dictionary when everything works as expected"""
-        fake_vmware.show_windows.return_value = {'worked': True}
+        fake_vmware.show_windows.return_value = ({'worked': True}, None)
 
         output = tasks.show(username='bob', txn_id='myId')
         expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_show_next_cursor(self, fake_vmware):
+        """``show`` includes the cursor for the next page in the params"""
+        fake_vmware.show_windows.return_value = ({'worked': True}, 'win10')
+
+        output = tasks.show(username='bob', txn_id='myId', limit=1)
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'next_cursor': 'win10'}}
+
+        self.assertEqual(output, expected)
+
     @patch.object(tasks, 'vmware')
     def test_show_value_error(self, fake_vmware):
         """``show`` sets the error in the dictionary to the ValueError message"""
@@ -30,9 +42,11 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'store')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware):
+    def test_create_ok(self, fake_vmware, fake_store):
         """``create`` returns a dictionary when everything works as expected"""
+        fake_store.is_cancelled.return_value = False
         fake_vmware.create_windows.return_value = {'worked': True}
 
         output = tasks.create(username='bob',
@@ -40,13 +54,15 @@ class TestTasks(unittest.TestCase):
                               image='10',
                               network='someLAN',
                               txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'timings': {}}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'store')
     @patch.object(tasks, 'vmware')
-    def test_create_value_error(self, fake_vmware):
+    def test_create_value_error(self, fake_vmware, fake_store):
         """``create`` sets the error in the dictionary to the ValueError message"""
+        fake_store.is_cancelled.return_value = False
         fake_vmware.create_windows.side_effect = [ValueError("testing")]
 
         output = tasks.create(username='bob',
@@ -54,30 +70,438 @@ class TestTasks(unittest.TestCase):
                               image='10',
                               network='someLAN',
                               txn_id='myId')
-        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+        expected = {'content' : {}, 'error': 'testing', 'params': {'timings': {}}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_preflight(self, fake_vmware, fake_store):
+        """``create`` returns every problem the preflight checks found"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = [tasks.preflight.PreflightError(['bad name', 'no room'])]
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId')
+
+        self.assertEqual(output['error'], 'bad name; no room')
+        self.assertEqual(output['params']['problems'], ['bad name', 'no room'])
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_transient(self, fake_vmware, fake_store):
+        """``create`` retries the task after a transient failure"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = [ConnectionResetError('testing')]
+
+        with self.assertRaises(Retry):
+            tasks.create(username='bob',
+                         machine_name='win10',
+                         image='10',
+                         network='someLAN',
+                         txn_id='myId')
+
+        self.assertTrue(fake_store.release_slot.called)
+
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_transient_give_up(self, fake_vmware, fake_store, fake_const):
+        """``create`` reports the error once it has run out of retries"""
+        fake_const.VLAB_WINDOWS_LOG_LEVEL = 'INFO'
+        fake_const.VLAB_WINDOWS_RETRIES = 3
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = [ConnectionResetError('testing')]
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId',
+                              attempt=3)
+
+        self.assertEqual(output['error'], 'Failed after 4 attempts: testing')
+        self.assertEqual(output['params']['attempts'], 4)
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_queue_wait(self, fake_vmware, fake_store):
+        """``create`` reports how long the task waited in the queue"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.return_value = {'worked': True}
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId',
+                              queued_at=tasks.time.time() - 60)
+
+        self.assertTrue(60 <= output['params']['queue_wait'] < 70)
+        self.assertTrue(fake_store.record_wait.called)
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_limit(self, fake_vmware, fake_store):
+        """``create`` requeues the task when the user is at their create limit"""
+        fake_store.is_cancelled.return_value = False
+        fake_store.acquire_slot.return_value = False
+
+        with self.assertRaises(Retry):
+            tasks.create(username='bob',
+                         machine_name='win10',
+                         image='10',
+                         network='someLAN',
+                         txn_id='myId')
+
+        self.assertFalse(fake_vmware.create_windows.called)
+
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_limit_give_up(self, fake_vmware, fake_store, fake_const):
+        """``create`` stops requeuing the task once it has waited VLAB_WINDOWS_FAIRSHARE_MAX_WAIT seconds"""
+        fake_const.VLAB_WINDOWS_LOG_LEVEL = 'INFO'
+        fake_const.VLAB_WINDOWS_FAIRSHARE_DELAY = 5
+        fake_const.VLAB_WINDOWS_FAIRSHARE_MAX_WAIT = 0
+        fake_store.is_cancelled.return_value = False
+        fake_store.acquire_slot.return_value = False
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId')
+
+        self.assertTrue(output['error'].startswith('Gave up after waiting'))
+        self.assertTrue(fake_store.finish_create.called)
+        self.assertFalse(fake_vmware.create_windows.called)
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_releases_slot(self, fake_vmware, fake_store):
+        """``create`` gives back the user's slot even if creating the VM blows up"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = [RuntimeError("testing")]
+
+        with self.assertRaises(RuntimeError):
+            tasks.create(username='bob',
+                         machine_name='win10',
+                         image='10',
+                         network='someLAN',
+                         txn_id='myId')
+
+        self.assertTrue(fake_store.release_slot.called)
+
     @patch.object(tasks, 'vmware')
     def test_delete_ok(self, fake_vmware):
         """``delete`` returns a dictionary when everything works as expected"""
-        fake_vmware.delete_windows.return_value = {'worked': True}
+        fake_vmware.delete_windows.return_value = None
+
+        output = tasks.delete(username='bob', machine_name='win10', txn_id='myId')
+        expected = {'content' : {}, 'error': None, 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_locked(self, fake_vmware):
+        """``delete`` reports an error when another task is changing the VM"""
+        fake_vmware.delete_windows.side_effect = tasks.locks.LockTimeout('bob/win10 is busy')
+
+        output = tasks.delete(username='bob', machine_name='win10', txn_id='myId')
+        expected = {'content' : {}, 'error': 'bob/win10 is busy', 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_modify_network_locked(self, fake_vmware):
+        """``modify_network`` reports an error when another task is changing the VM"""
+        fake_vmware.update_network.side_effect = tasks.locks.LockTimeout('pat/myWindows is busy')
+
+        output = tasks.modify_network(username='pat', machine_name='myWindows',
+                                      new_network='wootTown', txn_id='someTransactionID')
+
+        self.assertEqual(output['error'], 'pat/myWindows is busy')
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_cancelled(self, fake_vmware, fake_store):
+        """``create`` reports a cancelled state when the user cancels the create"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = [tasks.deploy.Cancelled('Create of win10 cancelled')]
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId')
+        expected = {'content' : {}, 'error': 'Create of win10 cancelled', 'params': {'state': 'cancelled', 'timings': {}}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(fake_store.release_slot.called)
+        self.assertTrue(fake_store.finish_create.called)
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_cancelled_queued(self, fake_vmware, fake_store):
+        """``create`` does nothing if it was cancelled before it started"""
+        fake_store.is_cancelled.return_value = True
+
+        output = tasks.create(username='bob',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              txn_id='myId')
+
+        self.assertEqual(output['params'], {'state': 'cancelled'})
+        self.assertFalse(fake_vmware.create_windows.called)
+        self.assertFalse(fake_store.acquire_slot.called)
+
+    @patch.object(tasks, 'vmware')
+    def test_delete_cancels_create(self, fake_vmware):
+        """``delete`` reports the create it cancelled"""
+        fake_vmware.delete_windows.return_value = 'some-task-id'
 
         output = tasks.delete(username='bob', machine_name='win10', txn_id='myId')
-        expected = {'content' : {}, 'error': None, 'params': {}}
+        expected = {'content' : {}, 'error': None, 'params': {'cancelled': 'some-task-id', 'timings': {}}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'store')
+    def test_cancel(self, fake_store):
+        """``cancel`` asks an in-progress create to stop"""
+        fake_store.cancel_create.return_value = True
+
+        output = tasks.cancel(username='bob', create_task_id='some-task-id', txn_id='myId')
+        expected = {'content' : {'task-id': 'some-task-id', 'state': 'cancelling'}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'store')
+    def test_cancel_pending(self, fake_store):
+        """``cancel`` reports a pending state when the create hasn't started yet"""
+        fake_store.cancel_create.return_value = False
+
+        output = tasks.cancel(username='bob', create_task_id='some-task-id', txn_id='myId')
+
+        self.assertEqual(output['content']['state'], 'pending')
+
     @patch.object(tasks, 'vmware')
     def test_delete_value_error(self, fake_vmware):
         """``delete`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.delete_windows.side_effect = [ValueError("testing")]
 
         output = tasks.delete(username='bob', machine_name='win10', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_reset_ok(self, fake_vmware):
+        """``reset`` returns a dictionary when everything works as expected"""
+        fake_vmware.reset_windows.return_value = {'worked': True}
+
+        output = tasks.reset(username='bob', machine_name='win10', txn_id='myId')
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_reset_value_error(self, fake_vmware):
+        """``reset`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.reset_windows.side_effect = [ValueError("testing")]
+
+        output = tasks.reset(username='bob', machine_name='win10', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_power(self, fake_vmware):
+        """``power`` returns a dictionary when everything works as expected"""
+        fake_vmware.power_windows.return_value = {'win10': {'ok': True, 'error': None}}
+
+        output = tasks.power(username='bob', machine_names=['win10'], state='on', txn_id='myId')
+        expected = {'content' : {'win10': {'ok': True, 'error': None}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_power_value_error(self, fake_vmware):
+        """``power`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.power_windows.side_effect = [ValueError("testing")]
+
+        output = tasks.power(username='bob', machine_names=['win10'], state='on', txn_id='myId')
         expected = {'content' : {}, 'error': 'testing', 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_modify_network_batch(self, fake_vmware):
+        """``modify_network_batch`` returns the result for every VM"""
+        fake_vmware.update_network_batch.return_value = {'win10': {'ok': True, 'error': None}}
+
+        output = tasks.modify_network_batch(username='bob', machine_names=None,
+                                            new_network='bob_frontend', txn_id='myId')
+        expected = {'content' : {'win10': {'ok': True, 'error': None}}, 'error': None, 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_modify_network_batch_value_error(self, fake_vmware):
+        """``modify_network_batch`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.update_network_batch.side_effect = [ValueError("testing")]
+
+        output = tasks.modify_network_batch(username='bob', machine_names=None,
+                                            new_network='bob_frontend', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'reports')
+    @patch.object(tasks, 'vmware')
+    def test_inventory(self, fake_vmware, fake_reports):
+        """``inventory`` writes the report for the API to stream, and returns how many rows it has"""
+        fake_reports.write.return_value = 3
+
+        output = tasks.inventory(txn_id='myId')
+        expected = {'content' : {'rows': 3}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(fake_reports.write.call_args[0][1] is fake_vmware.inventory.return_value)
+
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'vmware')
+    def test_reap_default(self, fake_vmware, fake_const):
+        """``reap`` defaults to the configured dry run setting"""
+        fake_const.VLAB_WINDOWS_LOG_LEVEL = 'INFO'
+        fake_const.VLAB_WINDOWS_REAP_DRY_RUN = True
+
+        tasks.reap(txn_id='myId')
+        the_args, _ = fake_vmware.reap_stale.call_args
+
+        self.assertTrue(the_args[1] is True)
+
+    @patch.object(tasks, 'vmware')
+    def test_reap(self, fake_vmware):
+        """``reap`` returns the report on what was reaped"""
+        fake_vmware.reap_stale.return_value = {'reaped': []}
+
+        output = tasks.reap(txn_id='myId', dry_run=False)
+        expected = {'content' : {'reaped': []}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'store')
+    def test_metrics(self, fake_store):
+        """``metrics`` returns the counters and queue wait times"""
+        fake_store.counters.return_value = {'reaper.vms': 1}
+        fake_store.wait_stats.return_value = {}
+
+        output = tasks.metrics(txn_id='myId')
+        expected = {'content' : {'counters': {'reaper.vms': 1}, 'ova_read_mbps': None, 'queue_wait': {}},
+                    'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'store')
+    def test_metrics_read_mbps(self, fake_store):
+        """``metrics`` reports the average speed OVAs were read off disk"""
+        fake_store.counters.return_value = {'ova.bytes_read': 300 * 1024 ** 2, 'ova.read_seconds': 2}
+        fake_store.wait_stats.return_value = {}
+
+        output = tasks.metrics(txn_id='myId')
+
+        self.assertEqual(output['content']['ova_read_mbps'], 150.0)
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_read_counters(self, fake_vmware, fake_store):
+        """``create`` adds how much of the OVA was read, and how long it took, to the counters"""
+        def fake_create(*args, stats=None, **kwargs):
+            stats.info.update({'read_bytes': 1700, 'read_seconds': 0.5})
+            return {}
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.side_effect = fake_create
+
+        tasks.create(username='bob', machine_name='win10', image='10', network='someLAN', txn_id='myId')
+
+        fake_store.incr_counters.assert_called_with({'ova.bytes_read': 1700, 'ova.read_seconds': 0.5})
+
+    @patch.object(tasks, 'store')
+    @patch.object(tasks, 'vmware')
+    def test_create_no_read_counters(self, fake_vmware, fake_store):
+        """``create`` leaves the read counters alone when the OVA wasn't read (i.e. a staged clone)"""
+        fake_store.is_cancelled.return_value = False
+        fake_vmware.create_windows.return_value = {}
+
+        tasks.create(username='bob', machine_name='win10', image='10', network='someLAN', txn_id='myId')
+
+        self.assertFalse(fake_store.incr_counters.called)
+
+    @patch.object(tasks.threading, 'Thread')
+    @patch.object(tasks, 'const')
+    def test_prewarm(self, fake_const, fake_Thread):
+        """``_prewarm`` warms the page cache in the background when the worker starts"""
+        fake_const.VLAB_WINDOWS_PREWARM_GB = 20
+
+        tasks._prewarm()
+
+        self.assertTrue(fake_Thread.return_value.start.called)
+
+    @patch.object(tasks.threading, 'Thread')
+    @patch.object(tasks, 'const')
+    def test_prewarm_disabled(self, fake_const, fake_Thread):
+        """``_prewarm`` does nothing when VLAB_WINDOWS_PREWARM_GB is zero"""
+        fake_const.VLAB_WINDOWS_PREWARM_GB = 0
+
+        tasks._prewarm()
+
+        self.assertFalse(fake_Thread.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'vmware')
+    def test_prewarm_images_error(self, fake_vmware, fake_get_task_logger):
+        """``_prewarm_images`` logs failures instead of raising"""
+        fake_vmware.prewarm_images.side_effect = RuntimeError('testing')
+
+        tasks._prewarm_images()
+
+        self.assertTrue(fake_get_task_logger.return_value.error.called)
+
+    @patch.object(tasks, 'history')
+    def test_task_history(self, fake_history):
+        """``task_history`` returns the percentiles from the history"""
+        fake_history.percentiles.return_value = {'create': {}}
+
+        output = tasks.task_history(txn_id='myId', tasks=['create'])
+        expected = {'content' : {'create': {}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'history')
+    def test_task_finished(self, fake_history):
+        """``_task_finished`` records the task, with its arguments by name"""
+        tasks._task_started(task_id='some-task')
+        tasks._task_finished(task_id='some-task', task=tasks.create, args=['bob', 'win10', '10', 'someLAN', 'myId'],
+                             kwargs={}, retval={'params': {}}, state='SUCCESS')
+
+        the_args, _ = fake_history.make_entry.call_args
+
+        self.assertTrue(fake_history.record.called)
+        self.assertEqual(the_args[2]['image'], '10')
+
+    @patch.object(tasks, 'history')
+    def test_task_finished_retry(self, fake_history):
+        """``_task_finished`` does not record a create that was requeued"""
+        tasks._task_started(task_id='some-task')
+        tasks._task_finished(task_id='some-task', task=tasks.create, args=[], kwargs={}, retval=None, state='RETRY')
+
+        self.assertFalse(fake_history.record.called)
+
     @patch.object(tasks, 'vmware')
     def test_image(self, fake_vmware):
         """``image`` returns a dictionary when everything works as expected"""
@@ -95,7 +519,7 @@ class TestTasks(unittest.TestCase):
                                       machine_name='myWindows',
                                       new_network='wootTown',
                                       txn_id='someTransactionID')
-        expected = {'content': {}, 'error': None, 'params': {}}
+        expected = {'content': {}, 'error': None, 'params': {'timings': {}}}
 
         self.assertEqual(output, expected)
 
@@ -109,7 +533,17 @@ class TestTasks(unittest.TestCase):
                                       new_network='wootTown',
                                       txn_id='someTransactionID')
 
-        expected = {'content': {}, 'error': 'some bad input', 'params': {}}
+        expected = {'content': {}, 'error': 'some bad input', 'params': {'timings': {}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_health(self, fake_vmware):
+        """``health`` returns the worker-side dependency checks"""
+        fake_vmware.check_health.return_value = {'images': {'ok': True}}
+
+        output = tasks.health()
+        expected = {'content': {'images': {'ok': True}}, 'error': None, 'params': {}}
 
         self.assertEqual(output, expected)
 
@@ -0,0 +1,57 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in transient.py
+"""
+import unittest
+from unittest.mock import patch
+
+from vlab_windows_api.lib.worker import transient
+
+
+class TestTransient(unittest.TestCase):
+    """A set of test cases for the transient.py module"""
+
+    def test_is_transient(self):
+        """``is_transient`` is True for dropped connections, and vCenter being unavailable"""
+        errors = [ConnectionResetError('testing'),
+                  transient.socket.timeout('testing'),
+                  transient.http.client.RemoteDisconnected('testing'),
+                  transient.vmodl.fault.HostCommunication(),
+                  transient.vim.fault.NotAuthenticated(),
+                  transient.TransientError('testing')]
+
+        self.assertTrue(all(transient.is_transient(x) for x in errors))
+
+    def test_is_transient_false(self):
+        """``is_transient`` is False for failures that would just happen again"""
+        errors = [ValueError('testing'),
+                  RuntimeError('testing'),
+                  transient.vim.fault.DuplicateName()]
+
+        self.assertFalse(any(transient.is_transient(x) for x in errors))
+
+    @patch.object(transient, 'const')
+    def test_backoff(self, fake_const):
+        """``backoff`` doubles with every attempt"""
+        fake_const.VLAB_WINDOWS_RETRY_BACKOFF = 5
+        fake_const.VLAB_WINDOWS_RETRY_MAX_BACKOFF = 1000
+
+        output = [transient.backoff(x) for x in range(3)]
+
+        self.assertTrue(2.5 <= output[0] <= 5)
+        self.assertTrue(5 <= output[1] <= 10)
+        self.assertTrue(10 <= output[2] <= 20)
+
+    @patch.object(transient, 'const')
+    def test_backoff_max(self, fake_const):
+        """``backoff`` never waits longer than VLAB_WINDOWS_RETRY_MAX_BACKOFF"""
+        fake_const.VLAB_WINDOWS_RETRY_BACKOFF = 5
+        fake_const.VLAB_WINDOWS_RETRY_MAX_BACKOFF = 60
+
+        output = transient.backoff(20)
+
+        self.assertTrue(output <= 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,42 +8,194 @@ from unittest.mock import patch, MagicMock
 from vlab_windows_api.lib.worker import vmware
 
 
+def make_props(name, moid='vm-1'):
+    """Build a fake entry like the ones ``windows_index`` returns, with the properties ``show_windows`` adds"""
+    nic = MagicMock()
+    nic.ipAddress = ['10.1.1.2', 'fe80::1']
+    vm = MagicMock()
+    vm._moId = moid
+    return {'name': name,
+            'obj': vm,
+            'runtime.powerState': 'poweredOn',
+            'guest.net': [nic],
+            'meta': {'component' : "Windows",
+                     'created': 1234,
+                     'version': "10",
+                     'configured': False,
+                     'generation': 1,
+                    }}
+
+
+def fake_preflight(vcenter, username, machine_name, image, ova_path, network):
+    """Stands in for ``preflight.check`` when everything checks out"""
+    ova = vmware.deploy.OvaImage(ova_path)
+    ova.networks = ['someLAN']
+    return {'ova': ova, 'network': vmware.vim.Network('network-1'), 'folder': MagicMock(), 'datastore': MagicMock()}
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
+    def setUp(self):
+        """Runs before every test case"""
+        patcher = patch.object(vmware.locks, 'backend', vmware.locks.MemoryLeases())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, '_vm_networks')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware.virtual_machine, '_get_vm_console_url')
     @patch.object(vmware, 'vCenter')
-    def test_show_windows(self, fake_vCenter, fake_consume_task, fake_get_info):
+    def test_show_windows(self, fake_vCenter, fake_get_vm_console_url, fake_windows_index, fake_vm_networks, fake_collector):
         """``show_windows`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta' : {'component' : "Windows",
-                                                'created': 1234,
-                                                'version': "10",
-                                                'configured': False,
-                                                'generation': 1,
-                                                }}
+        fake_windows_index.return_value = {'win10': make_props('win10')}
+        fake_vm_networks.return_value = {'vm-1': ['someLAN']}
+        fake_get_vm_console_url.return_value = 'https://console'
+
+        output, next_cursor = vmware.show_windows(username='alice')
+        expected = {'win10': {'state': 'poweredOn',
+                              'console': 'https://console',
+                              'ips': ['10.1.1.2'],
+                              'networks': ['someLAN'],
+                              'moid': 'vm-1',
+                              'meta' : {'component' : "Windows",
+                                        'created': 1234,
+                                        'version': "10",
+                                        'configured': False,
+                                        'generation': 1,
+                                        }}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(next_cursor is None)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, '_vm_networks')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware.virtual_machine, '_get_vm_console_url')
+    @patch.object(vmware, 'vCenter')
+    def test_show_windows_fields(self, fake_vCenter, fake_get_vm_console_url, fake_windows_index, fake_vm_networks,
+                                 fake_collector):
+        """``show_windows`` only looks up the fields requested"""
+        fake_windows_index.return_value = {'win10': make_props('win10')}
+
+        output, _ = vmware.show_windows(username='alice', fields=['state'])
+        expected = {'win10': {'state': 'poweredOn'}}
+        path_set = fake_collector.retrieve_objects.call_args[0][3]
+
+        self.assertEqual(output, expected)
+        self.assertEqual(path_set, ['runtime.powerState'])
+        self.assertFalse(fake_get_vm_console_url.called)
+        self.assertFalse(fake_vm_networks.called)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_show_windows_page_only(self, fake_vCenter, fake_windows_index, fake_collector):
+        """``show_windows`` only looks up the properties of the VMs on the page being returned"""
+        win10 = {'name': 'win10', 'obj': MagicMock(_moId='vm-1'), 'meta': {}}
+        win7 = {'name': 'win7', 'obj': MagicMock(_moId='vm-2'), 'meta': {}}
+        fake_windows_index.return_value = {'win10': win10, 'win7': win7}
+        fake_collector.retrieve_objects.return_value = [{'obj': win10['obj'], 'runtime.powerState': 'poweredOff'}]
+
+        output, _ = vmware.show_windows(username='alice', fields=['state'], limit=1)
+        objs = fake_collector.retrieve_objects.call_args[0][2]
+
+        self.assertEqual(output, {'win10': {'state': 'poweredOff'}})
+        self.assertEqual(objs, [win10['obj']])
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_show_windows_no_props(self, fake_vCenter, fake_windows_index, fake_collector):
+        """``show_windows`` skips the property lookup when the fields only need the index"""
+        fake_windows_index.return_value = {'win10': make_props('win10')}
+
+        vmware.show_windows(username='alice', fields=['moid', 'meta'])
+
+        self.assertFalse(fake_collector.retrieve_objects.called)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_show_windows_paging(self, fake_vCenter, fake_windows_index, fake_collector):
+        """``show_windows`` returns a cursor for the next page when there are more VMs"""
+        fake_windows_index.return_value = {x: make_props(x, moid=x) for x in ('c', 'a', 'b')}
+
+        first, cursor = vmware.show_windows(username='alice', fields=['state'], limit=2)
+        second, last_cursor = vmware.show_windows(username='alice', fields=['state'], limit=2, cursor=cursor)
 
-        output = vmware.show_windows(username='alice')
-        expected = {'win10': {'meta' : {'component' : "Windows",
-                                       'created': 1234,
-                                       'version': "10",
-                                       'configured': False,
-                                       'generation': 1,
-                                       }}}
+        self.assertEqual(list(first.keys()), ['a', 'b'])
+        self.assertEqual(list(second.keys()), ['c'])
+        self.assertTrue(last_cursor is None)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_show_windows_name(self, fake_vCenter, fake_windows_index, fake_collector):
+        """``show_windows`` supports filtering VMs by name"""
+        fake_windows_index.return_value = {x: make_props(x, moid=x) for x in ('win10', 'win7', 'server')}
+
+        output, _ = vmware.show_windows(username='alice', fields=['state'], name='win*')
+
+        self.assertEqual(sorted(output.keys()), ['win10', 'win7'])
+
+    @patch.object(vmware, 'collector')
+    def test_windows_index(self, fake_collector):
+        """``windows_index`` only returns VMs with Windows meta data"""
+        fake_collector.retrieve.return_value = [{'name': 'win10', 'config.annotation': '{"component": "Windows"}'},
+                                                {'name': 'cent', 'config.annotation': '{"component": "CentOS"}'},
+                                                {'name': 'new', 'config.annotation': ''},
+                                                {'name': 'failed', 'config.annotation': None}]
+
+        output = vmware.windows_index(MagicMock(), MagicMock())
+        path_set = fake_collector.retrieve.call_args[0][2]
+
+        self.assertEqual(list(output.keys()), ['win10'])
+        self.assertEqual(path_set, ['name', 'config.annotation'])
+
+    @patch.object(vmware, 'collector')
+    def test_vm_networks(self, fake_collector):
+        """``_vm_networks`` maps VMs to the names of the user's networks they're on"""
+        mine = MagicMock(_moId='network-1')
+        theirs = MagicMock(_moId='network-2')
+        vms = [{'obj': MagicMock(_moId='vm-1'), 'network': [mine, theirs]},
+               {'obj': MagicMock(_moId='vm-2'), 'network': [mine]}]
+        fake_collector.retrieve_objects.return_value = [{'obj': mine, 'name': 'alice_frontend'},
+                                                        {'obj': theirs, 'name': 'bob_frontend'}]
+
+        output = vmware._vm_networks(MagicMock(), 'alice', vms)
+        expected = {'vm-1': ['frontend'], 'vm-2': ['frontend']}
 
         self.assertEqual(output, expected)
 
+    @patch.object(vmware, 'collector')
+    def test_vm_networks_unique(self, fake_collector):
+        """``_vm_networks`` looks up each network once, however many of the VMs are on it"""
+        mine = MagicMock(_moId='network-1')
+        vms = [{'obj': MagicMock(_moId='vm-1'), 'network': [mine]},
+               {'obj': MagicMock(_moId='vm-2'), 'network': [mine]}]
+        fake_collector.retrieve_objects.return_value = []
+
+        vmware._vm_networks(MagicMock(), 'alice', vms)
+        objs = fake_collector.retrieve_objects.call_args[0][2]
+
+        self.assertEqual(objs, [mine])
+
+    def test_show_fields(self):
+        """``SHOW_FIELDS`` matches the fields the API accepts"""
+        from vlab_windows_api.lib.views import windows
+
+        self.assertEqual(vmware.SHOW_FIELDS, windows.SHOW_FIELDS)
+
+    @patch.object(vmware, 'store')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_delete_windows(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    def test_delete_windows(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info, fake_store):
         """``delete_windows`` returns None when everything works as expected"""
+        fake_store.find_create.return_value = None
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'win10'
@@ -62,12 +214,14 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(vmware, 'store')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_delete_windows_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    def test_delete_windows_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info, fake_store):
         """``delete_windows`` raises ValueError when unable to find requested vm for deletion"""
+        fake_store.find_create.return_value = None
         fake_logger = MagicMock()
         fake_vm = MagicMock()
         fake_vm.name = 'win10'
@@ -84,19 +238,19 @@ class TestVMware(unittest.TestCase):
         with self.assertRaises(ValueError):
             vmware.delete_windows(username='bob', machine_name='myOtherWinBox', logger=fake_logger)
 
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
     @patch.object(vmware.virtual_machine, 'set_meta')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware.deploy, 'OvaImage')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_create_windows(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta):
+    def test_create_windows(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_OvaImage, fake_set_meta, fake_check, fake_wait_for_ip):
         """``create_windows`` returns a dictionary upon success"""
         fake_logger = MagicMock()
         fake_deploy_from_ova.return_value.name = 'win10'
         fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
         output = vmware.create_windows(username='alice',
                                        machine_name='win10',
@@ -107,43 +261,335 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_create_windows_invalid_network(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
-        """``create_windows`` raises ValueError if supplied with a non-existing network"""
-        fake_logger = MagicMock()
-        fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+    def test_create_windows_stats(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_OvaImage, fake_set_meta, fake_check, fake_wait_for_ip):
+        """``create_windows`` records how long each phase took, and how much was uploaded"""
+        fake_deploy_from_ova.return_value.datastore[0].name = 'ds1'
+        fake_OvaImage.return_value.size = 100
+        fake_OvaImage.return_value.bytes_read = 100
+        fake_OvaImage.return_value.read_seconds = 0.25
+        stats = vmware.history.Stats()
 
-        with self.assertRaises(ValueError):
-            vmware.create_windows(username='alice',
-                                  machine_name='win10',
-                                  image='10',
-                                  network='someOtherLAN',
-                                  logger=fake_logger)
+        vmware.create_windows(username='alice',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              logger=MagicMock(),
+                              stats=stats)
+
+        self.assertEqual(sorted(stats.timings.keys()), ['ip', 'lock_wait', 'power_on', 'preflight', 'snapshot', 'upload'])
+        self.assertEqual(stats.info, {'uploaded': 100, 'read_bytes': 100, 'read_seconds': 0.25, 'datastore': 'ds1'})
+
+    @patch.object(vmware.preflight, 'check')
+    @patch.object(vmware, 'vCenter')
+    @patch.object(vmware.locks, 'const')
+    def test_create_windows_locked(self, fake_locks_const, fake_vCenter, fake_check):
+        """``create_windows`` waits for other changes to the VM before checking if the name is free"""
+        fake_locks_const.VLAB_WINDOWS_LOCK_WAIT = 0
+        fake_locks_const.VLAB_WINDOWS_LOCK_TTL = 60
+        vmware.locks.backend.acquire('alice/win10', 'another-task', 60)
+
+        with self.assertRaises(vmware.locks.LockTimeout):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock())
+
+        self.assertFalse(fake_check.called)
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware, 'store')
+    @patch.object(vmware, 'vCenter')
+    @patch.object(vmware.locks, 'const')
+    def test_delete_windows_locked(self, fake_locks_const, fake_vCenter, fake_store):
+        """``delete_windows`` does not touch a VM that another task is changing"""
+        fake_locks_const.VLAB_WINDOWS_LOCK_WAIT = 0
+        fake_locks_const.VLAB_WINDOWS_LOCK_TTL = 60
+        fake_store.find_create.return_value = None
+        vmware.locks.backend.acquire('bob/win10', 'another-task', 60)
+
+        with self.assertRaises(vmware.locks.LockTimeout):
+            vmware.delete_windows(username='bob', machine_name='win10', logger=MagicMock())
+
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware, 'store')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_windows_cancels_create(self, fake_vCenter, fake_store):
+        """``delete_windows`` cancels an in-progress create of the VM"""
+        fake_store.find_create.return_value = 'some-task-id'
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value.childEntity = []
 
-    @patch.object(vmware, 'Ova')
+        output = vmware.delete_windows(username='alice', machine_name='win10', logger=MagicMock())
+
+        self.assertEqual(output, 'some-task-id')
+        fake_store.cancel_create.assert_called_with('alice', 'some-task-id')
+
+    @patch.object(vmware, 'store')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_create_windows_bad_image(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
-        """``create_windows`` raises ValueError if supplied with a non-existing image/version of Windows to deploy"""
-        fake_logger = MagicMock()
+    def test_delete_windows_cancels_and_deletes(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info, fake_store):
+        """``delete_windows`` still deletes an existing VM when a create of the same name is registered"""
+        fake_store.find_create.return_value = 'some-task-id'
+        fake_vm = MagicMock()
+        fake_vm.name = 'win10'
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value.childEntity = [fake_vm]
+        fake_get_info.return_value = {'meta': {'component': 'Windows'}}
+
+        output = vmware.delete_windows(username='alice', machine_name='win10', logger=MagicMock())
+
+        self.assertEqual(output, 'some-task-id')
+        self.assertTrue(fake_store.cancel_create.called)
+        self.assertTrue(fake_vm.Destroy_Task.called)
+
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware.deploy, 'destroy_partial')
+    @patch.object(vmware, 'take_pristine_snapshot')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_cancelled(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_OvaImage,
+                                      fake_set_meta, fake_power, fake_check, fake_take_pristine_snapshot,
+                                      fake_destroy_partial, fake_wait_for_ip):
+        """``create_windows`` destroys the new VM if the create is cancelled"""
+
+        with self.assertRaises(vmware.deploy.Cancelled):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock(), should_stop=lambda: True)
+
+        self.assertTrue(fake_destroy_partial.called)
+        self.assertFalse(fake_set_meta.called)
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware, '_check_cancelled')
+    def test_wait_for_ip(self, fake_check_cancelled, fake_sleep):
+        """``_wait_for_ip`` returns once the VM has an IP"""
+        fake_vm = MagicMock()
+        fake_nic = MagicMock()
+        fake_nic.ipAddress = ['192.168.1.2']
+        fake_vm.guest.net = [fake_nic]
+
+        vmware._wait_for_ip(fake_vm, lambda: False, MagicMock())
+
+        self.assertFalse(fake_sleep.called)
+
+    @patch.object(vmware.deploy, 'destroy_partial')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.time, 'sleep')
+    def test_wait_for_ip_cancelled(self, fake_sleep, fake_power, fake_destroy_partial):
+        """``_wait_for_ip`` destroys the VM as soon as the create is cancelled, instead of waiting for an IP"""
+        fake_vm = MagicMock()
+        fake_vm.guest.net = []
+        cancels = iter([False, True])
+
+        with self.assertRaises(vmware.deploy.Cancelled):
+            vmware._wait_for_ip(fake_vm, lambda: next(cancels), MagicMock())
+
+        self.assertEqual(fake_sleep.call_count, 1)
+        self.assertTrue(fake_destroy_partial.called)
+
+    @patch.object(vmware.time, 'sleep')
+    def test_wait_for_ip_timeout(self, fake_sleep):
+        """``_wait_for_ip`` raises RuntimeError if the VM never gets an IP"""
+        fake_vm = MagicMock()
+        fake_vm.guest.net = []
+
+        with self.assertRaises(RuntimeError):
+            vmware._wait_for_ip(fake_vm, lambda: False, MagicMock())
+
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware, 'take_pristine_snapshot')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_pristine(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_OvaImage,
+                                     fake_set_meta, fake_power, fake_check, fake_take_pristine_snapshot, fake_wait_for_ip):
+        """``create_windows`` snapshots the new VM before powering it on, and records the snapshot in the meta data"""
+        fake_take_pristine_snapshot.return_value = 'snapshot-1'
+
+        vmware.create_windows(username='alice', machine_name='win10', image='10',
+                              network='someLAN', logger=MagicMock())
+        meta_data = fake_set_meta.call_args[0][1]
+        _, deploy_kwargs = fake_deploy_from_ova.call_args
+
+        self.assertEqual(meta_data['pristine'], 'snapshot-1')
+        self.assertFalse(deploy_kwargs['power_on'])
+        self.assertTrue(fake_power.called)
+
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware, 'take_pristine_snapshot')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_pristine_fails(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_OvaImage,
+                                           fake_set_meta, fake_power, fake_check, fake_take_pristine_snapshot, fake_wait_for_ip):
+        """``create_windows`` still creates the VM if the snapshot fails"""
+        fake_take_pristine_snapshot.side_effect = RuntimeError('testing')
+
+        vmware.create_windows(username='alice', machine_name='win10', image='10',
+                              network='someLAN', logger=MagicMock())
+        meta_data = fake_set_meta.call_args[0][1]
+
+        self.assertFalse('pristine' in meta_data)
+        self.assertTrue(fake_power.called)
+
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.staging, 'clone_from_stage')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_staged(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_OvaImage,
+                                   fake_set_meta, fake_check, fake_clone_from_stage, fake_const, fake_wait_for_ip):
+        """``create_windows`` clones a staged copy of the image when staging is enabled"""
+        fake_const.VLAB_WINDOWS_STAGING_BUDGET_GB = 100
+        fake_const.VLAB_WINDOWS_IMAGES_DIR = '/images'
+        fake_clone_from_stage.return_value.name = 'win10'
         fake_get_info.return_value = {'worked': True}
-        fake_Ova.side_effect = FileNotFoundError('testing')
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.create_windows(username='alice',
+                                       machine_name='win10',
+                                       image='10',
+                                       network='someLAN',
+                                       logger=MagicMock())
+        expected = {'win10': {'worked': True}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, '_wait_for_ip')
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.staging, 'clone_from_stage')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_staged_fallback(self, fake_vCenter, fake_deploy_from_ova, fake_get_info, fake_OvaImage,
+                                            fake_set_meta, fake_check, fake_clone_from_stage, fake_const, fake_wait_for_ip):
+        """``create_windows`` uploads the OVA if the staged image cannot be used"""
+        fake_const.VLAB_WINDOWS_STAGING_BUDGET_GB = 100
+        fake_const.VLAB_WINDOWS_IMAGES_DIR = '/images'
+        fake_clone_from_stage.side_effect = vmware.staging.StageUnavailable('DuplicateName')
+        fake_deploy_from_ova.return_value.name = 'win10'
+
+        vmware.create_windows(username='alice',
+                              machine_name='win10',
+                              image='10',
+                              network='someLAN',
+                              logger=MagicMock())
+
+        self.assertTrue(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.staging, 'clone_from_stage')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_staged_no_fallback(self, fake_vCenter, fake_deploy_from_ova, fake_OvaImage, fake_check,
+                                               fake_clone_from_stage, fake_const):
+        """``create_windows`` does not upload the OVA when the clone made a VM before failing"""
+        fake_const.VLAB_WINDOWS_STAGING_BUDGET_GB = 100
+        fake_const.VLAB_WINDOWS_IMAGES_DIR = '/images'
+        fake_clone_from_stage.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock())
+
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, '_discard')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_upload_fails(self, fake_vCenter, fake_deploy_from_ova, fake_OvaImage, fake_check, fake_discard):
+        """``create_windows`` removes whatever a failed import left behind, so the create can be retried"""
+        fake_deploy_from_ova.side_effect = vmware.transient.TransientError('testing')
+        fake_vcenter = fake_vCenter.return_value.__enter__.return_value
+        leftover = fake_vcenter.content.searchIndex.FindChild.return_value
+
+        with self.assertRaises(vmware.transient.TransientError):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock())
+
+        self.assertTrue(fake_discard.call_args[0][0] is leftover)
+
+    @patch.object(vmware, '_discard')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_upload_fails_nothing_left(self, fake_vCenter, fake_deploy_from_ova, fake_OvaImage, fake_check,
+                                                      fake_discard):
+        """``create_windows`` has nothing to remove when the failed import already cleaned up"""
+        fake_deploy_from_ova.side_effect = vmware.transient.TransientError('testing')
+        fake_vcenter = fake_vCenter.return_value.__enter__.return_value
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(vmware.transient.TransientError):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock())
+
+        self.assertFalse(fake_discard.called)
+
+    @patch.object(vmware, '_discard')
+    @patch.object(vmware, '_finish_create')
+    @patch.object(vmware.preflight, 'check', side_effect=fake_preflight)
+    @patch.object(vmware.deploy, 'OvaImage')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_transient(self, fake_vCenter, fake_deploy_from_ova, fake_OvaImage, fake_check,
+                                      fake_finish_create, fake_discard):
+        """``create_windows`` removes the new VM after a transient failure, so the create can be retried"""
+        fake_finish_create.side_effect = ConnectionResetError('testing')
+
+        with self.assertRaises(ConnectionResetError):
+            vmware.create_windows(username='alice', machine_name='win10', image='10',
+                                  network='someLAN', logger=MagicMock())
+
+        self.assertTrue(fake_discard.called)
+
+    @patch.object(vmware.preflight, 'check')
+    @patch.object(vmware.deploy, 'deploy_from_ova')
+    @patch.object(vmware, 'vCenter')
+    def test_create_windows_preflight(self, fake_vCenter, fake_deploy_from_ova, fake_check):
+        """``create_windows`` raises ValueError, without deploying anything, if the preflight checks fail"""
+        fake_check.side_effect = vmware.preflight.PreflightError(['No such network named someOtherLAN'])
 
         with self.assertRaises(ValueError):
             vmware.create_windows(username='alice',
                                   machine_name='win10',
                                   image='10',
                                   network='someOtherLAN',
-                                  logger=fake_logger)
+                                  logger=MagicMock())
+
+        self.assertFalse(fake_deploy_from_ova.called)
 
     @patch.object(vmware.os, 'listdir')
     def test_list_images(self, fake_listdir):
@@ -171,11 +617,311 @@ class TestVMware(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
+    @patch.object(vmware, '_find_snapshot')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vCenter')
+    def test_reset_windows(self, fake_vCenter, fake_consume_task, fake_get_info, fake_set_meta, fake_power, fake_find_snapshot):
+        """``reset_windows`` reverts to the pristine snapshot and bumps the generation"""
+        fake_vm = MagicMock()
+        fake_vm.name = 'win10'
+        fake_folder = MagicMock()
+        fake_folder.childEntity = [fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_info.return_value = {'meta': {'component' : 'Windows', 'generation': 1,
+                                               'configured': True, 'pristine': 'snapshot-1'}}
+
+        vmware.reset_windows(username='alice', machine_name='win10', logger=MagicMock())
+        meta_data = fake_set_meta.call_args[0][1]
+
+        self.assertTrue(fake_find_snapshot.return_value.RevertToSnapshot_Task.called)
+        self.assertEqual(meta_data['generation'], 2)
+        self.assertFalse(meta_data['configured'])
+        self.assertTrue(fake_power.called)
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_reset_windows_no_snapshot(self, fake_vCenter, fake_get_info):
+        """``reset_windows`` raises ValueError if the VM was made without a pristine snapshot"""
+        fake_vm = MagicMock()
+        fake_vm.name = 'win10'
+        fake_folder = MagicMock()
+        fake_folder.childEntity = [fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_info.return_value = {'meta': {'component' : 'Windows', 'generation': 1}}
+
+        with self.assertRaises(ValueError):
+            vmware.reset_windows(username='alice', machine_name='win10', logger=MagicMock())
+
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vCenter')
+    def test_reset_windows_no_vm(self, fake_vCenter, fake_get_info):
+        """``reset_windows`` raises ValueError if the VM does not exist"""
+        fake_folder = MagicMock()
+        fake_folder.childEntity = []
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+
+        with self.assertRaises(ValueError):
+            vmware.reset_windows(username='alice', machine_name='win10', logger=MagicMock())
+
+    @patch.object(vmware, 'vCenter')
+    @patch.object(vmware.locks, 'const')
+    def test_reset_windows_locked(self, fake_locks_const, fake_vCenter):
+        """``reset_windows`` does not touch a VM that another task is changing"""
+        fake_locks_const.VLAB_WINDOWS_LOCK_WAIT = 0
+        fake_locks_const.VLAB_WINDOWS_LOCK_TTL = 60
+        vmware.locks.backend.acquire('alice/win10', 'another-task', 60)
+
+        with self.assertRaises(vmware.locks.LockTimeout):
+            vmware.reset_windows(username='alice', machine_name='win10', logger=MagicMock())
+
+        self.assertFalse(fake_vCenter.called)
+
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_power_windows(self, fake_vCenter, fake_windows_index, fake_power):
+        """``power_windows`` powers every requested VM, and reports on each one"""
+        fake_windows_index.return_value = {x: make_props(x) for x in ('win10', 'win7')}
+        fake_power.return_value = True
+
+        output = vmware.power_windows('alice', ['win10', 'win7'], 'restart', MagicMock())
+        expected = {'win10': {'ok': True, 'error': None}, 'win7': {'ok': True, 'error': None}}
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_power.call_count, 2)
+
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_power_windows_all(self, fake_vCenter, fake_windows_index, fake_power):
+        """``power_windows`` powers every Windows the user has when no names are supplied"""
+        fake_windows_index.return_value = {x: make_props(x) for x in ('win10', 'win7', 'win8')}
+        fake_power.return_value = True
+
+        output = vmware.power_windows('alice', None, 'off', MagicMock())
+
+        self.assertEqual(sorted(output.keys()), ['win10', 'win7', 'win8'])
+
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_power_windows_partial(self, fake_vCenter, fake_windows_index, fake_power):
+        """``power_windows`` - one VM failing doesn't stop the others"""
+        fake_windows_index.return_value = {x: make_props(x) for x in ('win10', 'win7')}
+        fake_power.side_effect = [False, True]
+
+        output = vmware.power_windows('alice', ['win10', 'win7', 'nope'], 'on', MagicMock())
+        oks = sorted(x['ok'] for x in output.values())
+
+        self.assertEqual(oks, [False, False, True])
+        self.assertFalse(output['nope']['ok'])
+
+    def test_power_windows_bad_state(self):
+        """``power_windows`` raises ValueError for an unknown power state"""
+        with self.assertRaises(ValueError):
+            vmware.power_windows('alice', ['win10'], 'sideways', MagicMock())
+
+    def test_run_batch_concurrent(self):
+        """``_run_batch`` works on the VMs at the same time"""
+        vms = {x: make_props(x) for x in ('a', 'b', 'c', 'd')}
+        barrier = vmware.threading.Barrier(len(vms), timeout=5)
+
+        output = vmware._run_batch(vms, None, lambda vm: barrier.wait())
+        oks = [x['ok'] for x in output.values()]
+
+        self.assertEqual(oks, [True, True, True, True])
+
+    def test_run_batch_any_error(self):
+        """``_run_batch`` reports any error a VM hits as that VM's result, instead of failing the whole batch"""
+        vms = {x: make_props(x) for x in ('a', 'b')}
+        def func(the_vm):
+            if the_vm is vms['a']['obj']:
+                raise ConnectionResetError('testing')
+
+        output = vmware._run_batch(vms, None, func)
+        expected = {'a': {'ok': False, 'error': 'testing'}, 'b': {'ok': True, 'error': None}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_batch_any_error(self, fake_vCenter, fake_windows_index, fake_change_network, fake_network_cache):
+        """``update_network_batch`` still updates the other VMs when one hits an unexpected error"""
+        fake_windows_index.return_value = {x: make_props(x, moid=x) for x in ('win10', 'win7')}
+        def change_network(the_vm, network):
+            if the_vm._moId == 'win10':
+                raise KeyError('testing')
+        fake_change_network.side_effect = change_network
+
+        output = vmware.update_network_batch('alice', None, 'alice_frontend', MagicMock())
+
+        self.assertFalse(output['win10']['ok'])
+        self.assertTrue(output['win7']['ok'])
+
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_batch(self, fake_vCenter, fake_windows_index, fake_change_network, fake_network_cache):
+        """``update_network_batch`` looks up the network once, and updates every VM"""
+        fake_windows_index.return_value = {x: make_props(x) for x in ('win10', 'win7')}
+
+        output = vmware.update_network_batch('alice', None, 'alice_frontend', MagicMock())
+        expected = {'win10': {'ok': True, 'error': None}, 'win7': {'ok': True, 'error': None}}
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_network_cache.lookup.call_count, 1)
+        self.assertEqual(fake_change_network.call_count, 2)
+
+    @patch.object(vmware.locks, 'hold')
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_batch_locks(self, fake_vCenter, fake_windows_index, fake_change_network, fake_network_cache, fake_hold):
+        """``update_network_batch`` locks every VM it updates"""
+        fake_windows_index.return_value = {x: make_props(x) for x in ('win10', 'win7')}
+
+        vmware.update_network_batch('alice', None, 'alice_frontend', MagicMock())
+        username, names = fake_hold.call_args[0]
+
+        self.assertEqual(username, 'alice')
+        self.assertEqual(sorted(names), ['win10', 'win7'])
+
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_batch_no_network(self, fake_vCenter, fake_windows_index, fake_change_network, fake_network_cache):
+        """``update_network_batch`` raises ValueError if the network does not exist"""
+        fake_network_cache.lookup.side_effect = KeyError('alice_frontend')
+
+        with self.assertRaises(ValueError):
+            vmware.update_network_batch('alice', None, 'alice_frontend', MagicMock())
+
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware, 'windows_index')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_batch_stale(self, fake_vCenter, fake_windows_index, fake_change_network, fake_network_cache):
+        """``update_network_batch`` refreshes the cached network and retries the VMs that hit a stale network"""
+        fake_windows_index.return_value = {'win10': make_props('win10')}
+        fake_windows_index.return_value['win10']['obj'].name = 'win10'
+        fake_change_network.side_effect = [vmware.vmodl.fault.ManagedObjectNotFound(), None]
+
+        output = vmware.update_network_batch('alice', ['win10'], 'alice_frontend', MagicMock())
+
+        self.assertEqual(output, {'win10': {'ok': True, 'error': None}})
+        fake_network_cache.invalidate.assert_called_with('alice_frontend')
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'vCenter')
+    def test_inventory(self, fake_vCenter, fake_collector):
+        """``inventory`` yields every Windows VM, then the totals per user and per version"""
+        folder = vmware.vim.Folder('group-1')
+        vm_props = {'parent': folder,
+                    'obj': vmware.vim.VirtualMachine('vm-1'),
+                    'runtime.powerState': 'poweredOn',
+                    'summary.storage.committed': 100,
+                    'summary.storage.uncommitted': 10}
+        folders = [{'name': 'alice', 'obj': folder}]
+        vms = [
+            dict(vm_props, name='win10', **{'config.annotation': '{"component": "Windows", "version": "10", "created": 1}'}),
+            dict(vm_props, name='cent', **{'config.annotation': '{"component": "CentOS", "version": "8", "created": 1}'}),
+            dict(vm_props, name='broken', **{'config.annotation': ''}),
+        ]
+        fake_collector.retrieve.side_effect = [folders, vms]
+
+        output = list(vmware.inventory())
+        expected = [{'type': 'vm', 'user': 'alice', 'name': 'win10', 'version': '10', 'created': 1,
+                     'state': 'poweredOn', 'committed': 100, 'uncommitted': 10},
+                    {'type': 'user', 'user': 'alice', 'count': 1, 'powered_on': 1, 'committed': 100, 'uncommitted': 10},
+                    {'type': 'version', 'version': '10', 'count': 1, 'powered_on': 1, 'committed': 100, 'uncommitted': 10}]
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'vCenter')
+    def test_inventory_no_parent(self, fake_vCenter, fake_collector):
+        """``inventory`` reports a VM with no parent folder (i.e. in a vApp) without a user"""
+        vm = {'obj': vmware.vim.VirtualMachine('vm-1'), 'name': 'win10',
+              'config.annotation': '{"component": "Windows", "version": "10"}'}
+        fake_collector.retrieve.side_effect = [[], [vm]]
+
+        first = next(vmware.inventory())
+
+        self.assertEqual(first['user'], None)
+
+    @patch.object(vmware, 'collector')
+    @patch.object(vmware, 'vCenter')
+    def test_inventory_streams(self, fake_vCenter, fake_collector):
+        """``inventory`` yields each VM before vCenter has returned the rest"""
+        vm = {'parent': vmware.vim.Folder('group-1'), 'obj': vmware.vim.VirtualMachine('vm-1'), 'name': 'win10',
+              'config.annotation': '{"component": "Windows", "version": "10"}'}
+        def more_vms():
+            yield vm
+            raise AssertionError('read past the first VM')
+        fake_collector.retrieve.side_effect = [[], more_vms()]
+
+        first = next(vmware.inventory())
+
+        self.assertEqual(first['name'], 'win10')
+
+    @patch.object(vmware, 'reaper')
+    @patch.object(vmware, 'vCenter')
+    def test_reap_stale(self, fake_vCenter, fake_reaper):
+        """``reap_stale`` passes the dry run setting to the reaper"""
+        vmware.reap_stale(MagicMock(), dry_run=False)
+
+        _, the_kwargs = fake_reaper.reap.call_args
+
+        self.assertFalse(the_kwargs['dry_run'])
+
+    @patch.object(vmware, 'consume_task')
+    def test_take_pristine_snapshot(self, fake_consume_task):
+        """``take_pristine_snapshot`` returns the moId of the new snapshot, without memory"""
+        fake_vm = MagicMock()
+        fake_consume_task.return_value._moId = 'snapshot-1'
+
+        output = vmware.take_pristine_snapshot(fake_vm)
+        _, the_kwargs = fake_vm.CreateSnapshot_Task.call_args
+
+        self.assertEqual(output, 'snapshot-1')
+        self.assertFalse(the_kwargs['memory'])
+
+    def test_find_snapshot(self):
+        """``_find_snapshot`` finds snapshots nested in the snapshot tree"""
+        child = MagicMock()
+        child.snapshot._moId = 'snapshot-2'
+        child.childSnapshotList = []
+        root = MagicMock()
+        root.snapshot._moId = 'snapshot-1'
+        root.childSnapshotList = [child]
+        fake_vm = MagicMock()
+        fake_vm.snapshot.rootSnapshotList = [root]
+
+        output = vmware._find_snapshot(fake_vm, 'snapshot-2')
+
+        self.assertTrue(output is child.snapshot)
+
+    def test_find_snapshot_none(self):
+        """``_find_snapshot`` returns None if the VM has no snapshots"""
+        fake_vm = MagicMock()
+        fake_vm.snapshot = None
+
+        self.assertTrue(vmware._find_snapshot(fake_vm, 'snapshot-1') is None)
+
+    @patch.object(vmware, 'network_cache')
     @patch.object(vmware.virtual_machine, 'change_network')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_update_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network, fake_network_cache):
         """``update_network`` Returns None upon success"""
         fake_logger = MagicMock()
         fake_vm = MagicMock()
@@ -183,7 +929,7 @@ class TestVMware(unittest.TestCase):
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
         fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_network_cache.lookup.side_effect = lambda vcenter, name: {'wootTown' : 'someNetworkObject'}[name]
         fake_get_info.return_value = {'meta': {'component' : 'Windows'}}
 
         result = vmware.update_network(username='pat',
@@ -192,11 +938,12 @@ class TestVMware(unittest.TestCase):
 
         self.assertTrue(result is None)
 
+    @patch.object(vmware, 'network_cache')
     @patch.object(vmware.virtual_machine, 'change_network')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_update_network_no_vm(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network_no_vm(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network, fake_network_cache):
         """``update_network`` Raises ValueError if the supplied VM doesn't exist"""
         fake_logger = MagicMock()
         fake_vm = MagicMock()
@@ -204,7 +951,7 @@ class TestVMware(unittest.TestCase):
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
         fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_network_cache.lookup.side_effect = lambda vcenter, name: {'wootTown' : 'someNetworkObject'}[name]
         fake_get_info.return_value = {'meta': {'component' : 'Windows'}}
 
         with self.assertRaises(ValueError):
@@ -212,11 +959,12 @@ class TestVMware(unittest.TestCase):
                                   machine_name='SomeOtherMachine',
                                   new_network='wootTown')
 
+    @patch.object(vmware, 'network_cache')
     @patch.object(vmware.virtual_machine, 'change_network')
     @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware, 'consume_task')
     @patch.object(vmware, 'vCenter')
-    def test_update_network_no_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    def test_update_network_no_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network, fake_network_cache):
         """``update_network`` Raises ValueError if the supplied new network doesn't exist"""
         fake_logger = MagicMock()
         fake_vm = MagicMock()
@@ -224,7 +972,7 @@ class TestVMware(unittest.TestCase):
         fake_folder = MagicMock()
         fake_folder.childEntity = [fake_vm]
         fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_network_cache.lookup.side_effect = lambda vcenter, name: {'wootTown' : 'someNetworkObject'}[name]
         fake_get_info.return_value = {'meta': {'component' : 'Windows'}}
 
         with self.assertRaises(ValueError):
@@ -232,5 +980,86 @@ class TestVMware(unittest.TestCase):
                                   machine_name='myWindows',
                                   new_network='dohNet')
 
+    @patch.object(vmware, 'network_cache')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vCenter')
+    def test_update_network_stale_cache(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network, fake_network_cache):
+        """``update_network`` Invalidates the cached network, and retries if the network was deleted"""
+        fake_vm = MagicMock()
+        fake_vm.name = 'myWindows'
+        fake_folder = MagicMock()
+        fake_folder.childEntity = [fake_vm]
+        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
+        fake_get_info.return_value = {'meta': {'component' : 'Windows'}}
+        fake_change_network.side_effect = [vmware.vmodl.fault.ManagedObjectNotFound(), None]
+
+        vmware.update_network(username='pat',
+                              machine_name='myWindows',
+                              new_network='wootTown')
+
+        fake_network_cache.invalidate.assert_called_with('wootTown')
+        self.assertEqual(fake_change_network.call_count, 2)
+
+    @patch.dict(vmware._HEALTH, {'checked': 0, 'result': None})
+    @patch.object(vmware.os, 'listdir')
+    @patch.object(vmware, 'vCenter')
+    def test_check_health(self, fake_vCenter, fake_listdir):
+        """``check_health`` reports on the images directory and vCenter"""
+        fake_listdir.return_value = ['Windows-10.ova']
+
+        output = vmware.check_health()
+
+        self.assertEqual(output['images'], {'ok': True, 'count': 1})
+        self.assertTrue(output['vcenter']['ok'])
+
+    @patch.dict(vmware._HEALTH, {'checked': 0, 'result': None})
+    @patch.object(vmware.os, 'listdir')
+    @patch.object(vmware, 'vCenter')
+    def test_check_health_failures(self, fake_vCenter, fake_listdir):
+        """``check_health`` reports failures instead of raising"""
+        fake_listdir.side_effect = FileNotFoundError('/images')
+        fake_vCenter.side_effect = OSError('connection refused')
+
+        output = vmware.check_health()
+
+        self.assertFalse(output['images']['ok'])
+        self.assertFalse(output['vcenter']['ok'])
+
+    @patch.dict(vmware._HEALTH, {'checked': 0, 'result': None})
+    @patch.object(vmware.os, 'listdir')
+    @patch.object(vmware, 'vCenter')
+    def test_check_health_cached(self, fake_vCenter, fake_listdir):
+        """``check_health`` does not log into vCenter on every call"""
+        vmware.check_health()
+        vmware.check_health()
+
+        self.assertEqual(fake_vCenter.call_count, 1)
+
+    @patch.object(vmware.deploy, 'warm_page_cache')
+    @patch.object(vmware.os.path, 'getsize')
+    @patch.object(vmware.history, 'popular_images')
+    @patch.object(vmware, 'const')
+    def test_prewarm_images(self, fake_const, fake_popular_images, fake_getsize, fake_warm_page_cache):
+        """``prewarm_images`` warms the most popular images that fit in VLAB_WINDOWS_PREWARM_GB"""
+        fake_const.VLAB_WINDOWS_PREWARM_GB = 20
+        fake_const.VLAB_WINDOWS_IMAGES_DIR = '/images'
+        fake_popular_images.return_value = ['10', '7', '8', '2012']
+        sizes = {'/images/Windows-10.ova': 12 * 1024 ** 3,
+                 '/images/Windows-7.ova': 10 * 1024 ** 3,
+                 '/images/Windows-8.ova': 6 * 1024 ** 3}
+        def fake_size(path):
+            try:
+                return sizes[path]
+            except KeyError:
+                raise FileNotFoundError(path)
+        fake_getsize.side_effect = fake_size
+
+        output = vmware.prewarm_images(logger=MagicMock())
+
+        self.assertEqual(output, ['10', '8'])
+        fake_warm_page_cache.assert_called_with('/images/Windows-8.ova')
+
 if __name__ == '__main__':
     unittest.main()
@@ -64,6 +64,38 @@ class TestWindowsView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_args(self):
+        """WindowsView - GET on /api/2/inf/windows passes the query params to the task"""
+        self.app.get('/api/2/inf/windows?fields=state,ips&limit=10&cursor=win1&name=win*',
+                     headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+        expected = {'fields': ['state', 'ips'], 'limit': 10, 'cursor': 'win1', 'name': 'win*'}
+
+        self.assertEqual(the_kwargs['kwargs'], expected)
+
+    def test_get_no_args(self):
+        """WindowsView - GET on /api/2/inf/windows leaves the defaults to the worker when no params are supplied"""
+        self.app.get('/api/2/inf/windows', headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(the_kwargs['kwargs'], {})
+
+    def test_get_bad_fields(self):
+        """WindowsView - GET on /api/2/inf/windows returns HTTP 400 for unknown fields"""
+        resp = self.app.get('/api/2/inf/windows?fields=state,nope',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_get_bad_limit(self):
+        """WindowsView - GET on /api/2/inf/windows returns HTTP 400 if the limit is not a positive integer"""
+        resp = self.app.get('/api/2/inf/windows?limit=-1',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
     def test_post_task(self):
         """WindowsView - POST on /api/2/inf/windows returns a task-id"""
         resp = self.app.post('/api/2/inf/windows',
@@ -77,6 +109,241 @@ class TestWindowsView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_post_queued_at(self):
+        """WindowsView - POST on /api/2/inf/windows tells the worker when the task was sent"""
+        self.app.post('/api/2/inf/windows',
+                      headers={'X-Auth': self.token},
+                      json={'network': "someLAN",
+                            'name': "myWindowsClient",
+                            'image': '10'})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertTrue('queued_at' in the_kwargs['kwargs'])
+
+    def test_reset(self):
+        """WindowsView - POST on /api/2/inf/windows/reset returns a task-id"""
+        resp = self.app.post('/api/2/inf/windows/reset',
+                             headers={'X-Auth': self.token},
+                             json={'name': "myWindowsClient"})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_reset_task(self):
+        """WindowsView - POST on /api/2/inf/windows/reset sends the windows.reset task"""
+        self.app.post('/api/2/inf/windows/reset',
+                      headers={'X-Auth': self.token},
+                      json={'name': "myWindowsClient"})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('windows.reset', ['bob', 'myWindowsClient', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_cancel(self):
+        """WindowsView - POST on /api/2/inf/windows/cancel sends the windows.cancel task"""
+        self.app.post('/api/2/inf/windows/cancel',
+                      headers={'X-Auth': self.token},
+                      json={'task-id': "some-task-id"})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('windows.cancel', ['bob', 'some-task-id', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_cancel_bad_body(self):
+        """WindowsView - POST on /api/2/inf/windows/cancel requires a task-id"""
+        resp = self.app.post('/api/2/inf/windows/cancel',
+                             headers={'X-Auth': self.token},
+                             json={'name': "win10"})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_power(self):
+        """WindowsView - POST on /api/2/inf/windows/power sends the windows.power task"""
+        self.app.post('/api/2/inf/windows/power',
+                      headers={'X-Auth': self.token},
+                      json={'names': ['win10', 'win7'], 'state': 'restart'})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('windows.power', ['bob', ['win10', 'win7'], 'restart', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_power_all(self):
+        """WindowsView - POST on /api/2/inf/windows/power supports powering every VM"""
+        self.app.post('/api/2/inf/windows/power',
+                      headers={'X-Auth': self.token},
+                      json={'all': True, 'state': 'off'})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('windows.power', ['bob', None, 'off', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_power_bad_body(self):
+        """WindowsView - POST on /api/2/inf/windows/power requires either names or all, not both"""
+        resp = self.app.post('/api/2/inf/windows/power',
+                             headers={'X-Auth': self.token},
+                             json={'all': True, 'names': ['win10'], 'state': 'off'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_network_batch(self):
+        """WindowsView - PUT on /api/2/inf/windows/network/batch sends the windows.modify_network_batch task"""
+        self.app.put('/api/2/inf/windows/network/batch',
+                     headers={'X-Auth': self.token},
+                     json={'names': ['win10', 'win7'], 'new_network': 'frontend'})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        expected = ('windows.modify_network_batch', ['bob', ['win10', 'win7'], 'bob_frontend', 'noId'])
+
+        self.assertEqual(the_args, expected)
+
+    def test_inventory_not_admin(self):
+        """WindowsView - POST on /api/2/inf/windows/inventory returns HTTP 403 for non-admins"""
+        resp = self.app.post('/api/2/inf/windows/inventory', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(windows, 'const')
+    def test_inventory(self, fake_const):
+        """WindowsView - POST on /api/2/inf/windows/inventory sends the windows.inventory task for admins"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        resp = self.app.post('/api/2/inf/windows/inventory', headers={'X-Auth': self.token})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args, ('windows.inventory', ['noId']))
+
+    @patch.object(windows, 'reports')
+    @patch.object(windows, 'const')
+    def test_inventory_report(self, fake_const, fake_reports):
+        """WindowsView - GET on /api/2/inf/windows/inventory/<task-id> sends the finished report as NDJSON"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        fake_reports.status.return_value = 'finished'
+        fake_reports.read.return_value = iter([b'{"type":"vm","name":"win10","user":"alice"}\n',
+                                                 b'{"type":"user","user":"alice","count":1}\n'])
+
+        resp = self.app.get('/api/2/inf/windows/inventory/asdf', headers={'X-Auth': self.token})
+        lines = [ujson.loads(x) for x in resp.data.decode().splitlines()]
+        expected = [{'type': 'vm', 'name': 'win10', 'user': 'alice'},
+                    {'type': 'user', 'user': 'alice', 'count': 1}]
+
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(lines, expected)
+        fake_reports.read.assert_called_with('asdf')
+
+    @patch.object(windows, 'reports')
+    @patch.object(windows, 'const')
+    def test_inventory_report_pending(self, fake_const, fake_reports):
+        """WindowsView - GET on /api/2/inf/windows/inventory/<task-id> returns HTTP 202 until the report is finished"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        fake_reports.status.return_value = 'writing'
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+
+        resp = self.app.get('/api/2/inf/windows/inventory/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    @patch.object(windows, 'reports')
+    @patch.object(windows, 'const')
+    def test_inventory_report_failed(self, fake_const, fake_reports):
+        """WindowsView - GET on /api/2/inf/windows/inventory/<task-id> returns HTTP 500 when the task failed before starting the report"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        fake_reports.status.return_value = 'missing'
+        self.app.application.celery_app.AsyncResult.return_value.status = 'FAILURE'
+
+        resp = self.app.get('/api/2/inf/windows/inventory/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+
+    @patch.object(windows, 'reports')
+    @patch.object(windows, 'const')
+    def test_inventory_report_abandoned(self, fake_const, fake_reports):
+        """WindowsView - GET on /api/2/inf/windows/inventory/<task-id> returns HTTP 500 when the worker stopped writing the report"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        fake_reports.status.return_value = 'abandoned'
+
+        resp = self.app.get('/api/2/inf/windows/inventory/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 500)
+
+    @patch.object(windows, 'reports')
+    @patch.object(windows, 'const')
+    def test_inventory_report_bad_id(self, fake_const, fake_reports):
+        """WindowsView - GET on /api/2/inf/windows/inventory/<task-id> returns HTTP 400 for an invalid task ID"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        fake_reports.status.side_effect = ValueError('Invalid report ID')
+
+        resp = self.app.get('/api/2/inf/windows/inventory/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_reap_not_admin(self):
+        """WindowsView - POST on /api/2/inf/windows/reap returns HTTP 403 for non-admins"""
+        resp = self.app.post('/api/2/inf/windows/reap', headers={'X-Auth': self.token}, json={})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(windows, 'const')
+    def test_reap(self, fake_const):
+        """WindowsView - POST on /api/2/inf/windows/reap defaults to a dry run"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        self.app.post('/api/2/inf/windows/reap', headers={'X-Auth': self.token}, json={})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(the_args, ('windows.reap', ['noId']))
+        self.assertEqual(the_kwargs['kwargs'], {'dry_run': True})
+
+    def test_metrics_not_admin(self):
+        """WindowsView - GET on /api/2/inf/windows/metrics returns HTTP 403 for non-admins"""
+        resp = self.app.get('/api/2/inf/windows/metrics', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(windows, 'const')
+    def test_metrics(self, fake_const):
+        """WindowsView - GET on /api/2/inf/windows/metrics sends the windows.metrics task"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        resp = self.app.get('/api/2/inf/windows/metrics', headers={'X-Auth': self.token})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(the_args, ('windows.metrics', ['noId']))
+
+    def test_history_not_admin(self):
+        """WindowsView - GET on /api/2/inf/windows/history returns HTTP 403 for non-admins"""
+        resp = self.app.get('/api/2/inf/windows/history', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 403)
+
+    @patch.object(windows, 'const')
+    def test_history(self, fake_const):
+        """WindowsView - GET on /api/2/inf/windows/history passes the query params to the task"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        self.app.get('/api/2/inf/windows/history?tasks=create,delete&since=100',
+                     headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(the_args, ('windows.history', ['noId']))
+        self.assertEqual(the_kwargs['kwargs'], {'tasks': ['create', 'delete'], 'since': 100.0})
+
+    @patch.object(windows, 'const')
+    def test_history_bad_since(self, fake_const):
+        """WindowsView - GET on /api/2/inf/windows/history returns HTTP 400 for a bad timestamp"""
+        fake_const.VLAB_WINDOWS_ADMINS = ['bob']
+        resp = self.app.get('/api/2/inf/windows/history?since=yesterday', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
     def test_post_task_link(self):
         """WindowsView - POST on /api/2/inf/windows sets the Link header"""
         resp = self.app.post('/api/2/inf/windows',
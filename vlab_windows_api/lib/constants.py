@@ -24,6 +24,43 @@ DEFINED = OrderedDict([
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_WINDOWS_IMAGES_DIR', environ.get('VLAB_WINDOWS_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_WINDOWS_NETWORK_CACHE_TTL', int(environ.get('VLAB_WINDOWS_NETWORK_CACHE_TTL', 300))),
+            ('VLAB_WINDOWS_HEALTH_INTERVAL', int(environ.get('VLAB_WINDOWS_HEALTH_INTERVAL', 30))),
+            ('VLAB_WINDOWS_HEALTH_TIMEOUT', int(environ.get('VLAB_WINDOWS_HEALTH_TIMEOUT', 5))),
+            ('VLAB_WINDOWS_UPLOAD_WORKERS', int(environ.get('VLAB_WINDOWS_UPLOAD_WORKERS', 4))),
+            ('VLAB_WINDOWS_UPLOAD_CHUNK_MB', int(environ.get('VLAB_WINDOWS_UPLOAD_CHUNK_MB', 8))),
+            ('VLAB_WINDOWS_READAHEAD_MB', int(environ.get('VLAB_WINDOWS_READAHEAD_MB', 64))),
+            ('VLAB_WINDOWS_PREWARM_GB', int(environ.get('VLAB_WINDOWS_PREWARM_GB', 0))),
+            ('VLAB_WINDOWS_UPLOAD_TIMEOUT', int(environ.get('VLAB_WINDOWS_UPLOAD_TIMEOUT', 300))),
+            ('VLAB_WINDOWS_UPLOAD_MAX_MBPS', int(environ.get('VLAB_WINDOWS_UPLOAD_MAX_MBPS', 0))),
+            ('VLAB_WINDOWS_RETRIES', int(environ.get('VLAB_WINDOWS_RETRIES', 3))),
+            ('VLAB_WINDOWS_RETRY_BACKOFF', int(environ.get('VLAB_WINDOWS_RETRY_BACKOFF', 5))),
+            ('VLAB_WINDOWS_RETRY_MAX_BACKOFF', int(environ.get('VLAB_WINDOWS_RETRY_MAX_BACKOFF', 120))),
+            ('VLAB_WINDOWS_STAGING_DIR', environ.get('VLAB_WINDOWS_STAGING_DIR', 'windows-staging')),
+            ('VLAB_WINDOWS_STAGING_BUDGET_GB', int(environ.get('VLAB_WINDOWS_STAGING_BUDGET_GB', 0))),
+            ('VLAB_WINDOWS_STAGING_NETWORK', environ.get('VLAB_WINDOWS_STAGING_NETWORK', '')),
+            ('VLAB_WINDOWS_STATE_DB', environ.get('VLAB_WINDOWS_STATE_DB', '/tmp/vlab_windows_state.db')),
+            ('VLAB_WINDOWS_USER_CREATE_LIMIT', int(environ.get('VLAB_WINDOWS_USER_CREATE_LIMIT', 3))),
+            ('VLAB_WINDOWS_FAIRSHARE_DELAY', int(environ.get('VLAB_WINDOWS_FAIRSHARE_DELAY', 5))),
+            ('VLAB_WINDOWS_FAIRSHARE_MAX_WAIT', int(environ.get('VLAB_WINDOWS_FAIRSHARE_MAX_WAIT', 3600))),
+            ('VLAB_WINDOWS_CREATE_TIME_LIMIT', int(environ.get('VLAB_WINDOWS_CREATE_TIME_LIMIT', 1800))),
+            ('VLAB_WINDOWS_USER_VM_LIMIT', int(environ.get('VLAB_WINDOWS_USER_VM_LIMIT', 0))),
+            ('VLAB_WINDOWS_MIN_FREE_GB', int(environ.get('VLAB_WINDOWS_MIN_FREE_GB', 10))),
+            ('VLAB_WINDOWS_BATCH_WORKERS', int(environ.get('VLAB_WINDOWS_BATCH_WORKERS', 16))),
+            ('VLAB_WINDOWS_REAP_INTERVAL', int(environ.get('VLAB_WINDOWS_REAP_INTERVAL', 0))),
+            ('VLAB_WINDOWS_REAP_DRY_RUN', environ.get('VLAB_WINDOWS_REAP_DRY_RUN', 'true').lower() == 'true'),
+            ('VLAB_WINDOWS_REAP_MAX_AGE_DAYS', int(environ.get('VLAB_WINDOWS_REAP_MAX_AGE_DAYS', 0))),
+            ('VLAB_WINDOWS_REAP_IDLE_DAYS', int(environ.get('VLAB_WINDOWS_REAP_IDLE_DAYS', 0))),
+            ('VLAB_WINDOWS_REAP_ORPHAN_HOURS', int(environ.get('VLAB_WINDOWS_REAP_ORPHAN_HOURS', 0))),
+            ('VLAB_WINDOWS_REAP_BATCH', int(environ.get('VLAB_WINDOWS_REAP_BATCH', 10))),
+            ('VLAB_WINDOWS_REAP_BATCH_DELAY', int(environ.get('VLAB_WINDOWS_REAP_BATCH_DELAY', 30))),
+            ('VLAB_WINDOWS_HISTORY_DB', environ.get('VLAB_WINDOWS_HISTORY_DB', '/tmp/vlab_windows_history.db')),
+            ('VLAB_WINDOWS_HISTORY_DAYS', int(environ.get('VLAB_WINDOWS_HISTORY_DAYS', 90))),
+            ('VLAB_WINDOWS_LOCK_BACKEND', environ.get('VLAB_WINDOWS_LOCK_BACKEND', 'store')),
+            ('VLAB_WINDOWS_LOCK_WAIT', int(environ.get('VLAB_WINDOWS_LOCK_WAIT', 600))),
+            ('VLAB_WINDOWS_LOCK_TTL', int(environ.get('VLAB_WINDOWS_LOCK_TTL', 7200))),
+            ('VLAB_WINDOWS_REPORTS_DIR', environ.get('VLAB_WINDOWS_REPORTS_DIR', '/tmp/vlab_windows_reports')),
+            ('VLAB_WINDOWS_ADMINS', [x for x in environ.get('VLAB_WINDOWS_ADMINS', '').split(',') if x]),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
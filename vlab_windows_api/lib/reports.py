@@ -0,0 +1,126 @@
+# -*- coding: UTF-8 -*-
+"""
+Reports too big to send as one task result, kept as NDJSON files in
+``VLAB_WINDOWS_REPORTS_DIR``, one per task.
+
+The worker appends rows as it produces them, and the API sends the file once
+it's finished, a chunk at a time, so neither side ever holds the whole report.
+The directory has to be a volume shared by the API and worker containers.
+"""
+import os
+import re
+import time
+
+import ujson
+
+from vlab_windows_api.lib import const
+
+
+END = b'{"type":"end"}\n'
+CHUNK_SIZE = 65536
+# A report that stops growing for this long was abandoned by a worker that died
+IDLE_TIMEOUT = 600
+KEEP = 86400
+_VALID_ID = re.compile(r'^[\w-]+$')
+
+
+def path(report_id):
+    """The file a report is kept in
+
+    :Returns: String
+
+    :Raises: ValueError - for an ID that could escape the reports directory
+
+    :param report_id: The ID of the task that makes the report
+    :type report_id: String
+    """
+    if not _VALID_ID.match(report_id):
+        raise ValueError('Invalid report ID: {}'.format(report_id))
+    return os.path.join(const.VLAB_WINDOWS_REPORTS_DIR, '{}.ndjson'.format(report_id))
+
+
+def status(report_id):
+    """Check how far along a report is
+
+    :Returns: String - ``missing``, ``writing``, ``abandoned`` or ``finished``
+
+    :param report_id: The ID of the task that makes the report
+    :type report_id: String
+    """
+    the_path = path(report_id)
+    try:
+        with open(the_path, 'rb') as the_file:
+            the_file.seek(0, os.SEEK_END)
+            the_file.seek(max(the_file.tell() - len(END), 0))
+            if the_file.read() == END:
+                return 'finished'
+        if time.time() - os.path.getmtime(the_path) > IDLE_TIMEOUT:
+            return 'abandoned'
+    except FileNotFoundError:
+        return 'missing'
+    return 'writing'
+
+
+def write(report_id, rows):
+    """Save the rows of a report as they're produced
+
+    A failure is recorded as a final ``{"type": "error"}`` row, so whoever is
+    reading the report knows it's incomplete.
+
+    :Returns: Integer - how many rows were written
+
+    :param report_id: The ID of the task that makes the report
+    :type report_id: String
+
+    :param rows: The rows of the report
+    :type rows: Iterable of Dictionaries
+    """
+    os.makedirs(const.VLAB_WINDOWS_REPORTS_DIR, exist_ok=True)
+    _prune()
+    count = 0
+    with open(path(report_id), 'wb') as the_file:
+        try:
+            for row in rows:
+                the_file.write(ujson.dumps(row).encode() + b'\n')
+                count += 1
+        except Exception as doh:
+            the_file.write(ujson.dumps({'type': 'error', 'error': '{}'.format(doh)}).encode() + b'\n')
+            raise
+        finally:
+            the_file.write(END)
+    return count
+
+
+def read(report_id, chunk_size=CHUNK_SIZE):
+    """Read a finished report, leaving out the marker at the end
+
+    :Returns: Generator of Bytes - NDJSON lines, a chunk at a time
+
+    :param report_id: The ID of the task that makes the report
+    :type report_id: String
+
+    :param chunk_size: About how many bytes to read at a time
+    :type chunk_size: Integer
+    """
+    with open(path(report_id), 'rb') as the_file:
+        while True:
+            chunk = b''.join(the_file.readlines(chunk_size))
+            if not chunk:
+                return
+            if chunk.endswith(END):
+                chunk = chunk[:-len(END)]
+            if chunk:
+                yield chunk
+
+
+def _prune():
+    """Delete reports older than ``KEEP`` seconds"""
+    cutoff = time.time() - KEEP
+    for name in os.listdir(const.VLAB_WINDOWS_REPORTS_DIR):
+        the_path = os.path.join(const.VLAB_WINDOWS_REPORTS_DIR, name)
+        try:
+            if os.path.getmtime(the_path) < cutoff:
+                os.remove(the_path)
+        except OSError:
+            # i.e. another worker pruned it first
+            pass
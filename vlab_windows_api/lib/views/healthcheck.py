@@ -2,16 +2,122 @@
 """
 Enables Health checks for the power API
 """
-from time import time
-import pkg_resources
+import time
+import threading
+try:
+    from importlib.metadata import version as get_version
+except ImportError:
+    # Python < 3.8
+    import pkg_resources
+
+    def get_version(dist_name):
+        return pkg_resources.get_distribution(dist_name).version
 
 import ujson
-from flask_classy import FlaskView, Response
-from vlab_inf_common.vmware import vCenter
+from flask import current_app
+from flask_classy import FlaskView, Response, request
 
 from vlab_windows_api.lib import const
 
 
+# Looking up the version walks sys.path; it won't change while we're running
+VERSION = get_version('vlab-windows-api')
+
+
+class DependencyProbe(object):
+    """Checks the things the service depends on from a background thread.
+
+    Requests for a deep health check only ever read the most recent results, so
+    a load balancer can hit the end point as often as it likes without adding
+    load to the broker or vCenter.
+
+    :param interval: How many seconds to wait between probes
+    :type interval: Integer
+
+    :param timeout: How many seconds to wait on any one probe
+    :type timeout: Integer
+    """
+    def __init__(self, interval=const.VLAB_WINDOWS_HEALTH_INTERVAL, timeout=const.VLAB_WINDOWS_HEALTH_TIMEOUT):
+        self._interval = interval
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._results = None
+        self._thread = None
+
+    def results(self, celery_app):
+        """Obtain the latest probe results. The first call probes synchronously,
+        and starts the background thread.
+
+        :Returns: Dictionary
+
+        :param celery_app: The object for talking to the broker and workers
+        :type celery_app: celery.Celery
+        """
+        with self._lock:
+            if self._thread is None:
+                self._results = self.probe(celery_app)
+                self._thread = threading.Thread(target=self._run, args=(celery_app,), daemon=True)
+                self._thread.start()
+            results = dict(self._results)
+        results['age'] = round(time.time() - results['checked'], 3)
+        return results
+
+    def _run(self, celery_app):
+        """Loops forever, updating the probe results"""
+        while True:
+            time.sleep(self._interval)
+            results = self.probe(celery_app)
+            with self._lock:
+                self._results = results
+
+    def probe(self, celery_app):
+        """Check the broker, workers, and the dependencies only the workers can reach
+
+        :Returns: Dictionary
+
+        :param celery_app: The object for talking to the broker and workers
+        :type celery_app: celery.Celery
+        """
+        results = {'checked': time.time()}
+        start = time.time()
+        try:
+            with celery_app.connection_for_write() as conn:
+                conn.ensure_connection(max_retries=1, timeout=self._timeout)
+                conn.default_channel
+        except Exception as doh:
+            results['broker'] = {'ok': False, 'error': '{}'.format(doh)}
+        else:
+            results['broker'] = {'ok': True, 'rtt_ms': int((time.time() - start) * 1000)}
+
+        try:
+            active = celery_app.control.inspect(timeout=self._timeout).active_queues() or {}
+        except Exception as doh:
+            results['workers'] = {'ok': False, 'error': '{}'.format(doh)}
+        else:
+            queues = {}
+            for worker_queues in active.values():
+                for queue in worker_queues:
+                    queues.setdefault(queue['name'], 0)
+                    queues[queue['name']] += 1
+            results['workers'] = {'ok': bool(queues), 'queues': queues}
+
+        try:
+            # a probe nobody is waiting on anymore shouldn't run when a worker frees up
+            task = celery_app.send_task('windows.health', expires=self._timeout)
+            worker_results = task.get(timeout=self._timeout)['content']
+        except Exception as doh:
+            error = {'ok': False, 'error': 'No worker responded: {}'.format(doh)}
+            results['images'] = error
+            results['vcenter'] = error
+        else:
+            results['images'] = worker_results['images']
+            results['vcenter'] = worker_results['vcenter']
+        return results
+
+
+probe = DependencyProbe()
+
+
 class HealthView(FlaskView):
     """
     Simple end point to test if the service is alive
@@ -20,10 +126,17 @@ class HealthView(FlaskView):
     trailing_slash = False
 
     def get(self):
-        """End point for health checks"""
+        """End point for health checks. Supply ``?deep=true`` to also report on
+        the broker, workers, images and vCenter.
+        """
         resp = {}
         status = 200
-        resp['version'] = pkg_resources.get_distribution('vlab-windows-api').version
+        resp['version'] = VERSION
+        if request.args.get('deep', '').lower() == 'true':
+            deep = probe.results(current_app.celery_app)
+            resp['deep'] = deep
+            if not all(v['ok'] for v in deep.values() if isinstance(v, dict)):
+                status = 503
         response = Response(ujson.dumps(resp))
         response.status_code = status
         response.headers['Content-Type'] = 'application/json'
@@ -2,18 +2,22 @@
 """
 Defines the RESTful API for deploying Windows desktop clients
 """
+import time
+
 import ujson
 from flask import current_app
 from flask_classy import request, route, Response
 from vlab_inf_common.views import MachineView
-from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_windows_api.lib import const
+from vlab_windows_api.lib import const, reports
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_WINDOWS_LOG_LEVEL)
+# Kept in sync with vlab_windows_api.lib.worker.vmware.SHOW_FIELDS; importing
+# that module would drag pyVmomi into the web tier.
+SHOW_FIELDS = ('state', 'console', 'ips', 'networks', 'moid', 'meta')
 
 
 class WindowsView(MachineView):
@@ -50,22 +54,159 @@ class WindowsView(MachineView):
                      },
                      "required": ["name"]
                     }
+    RESET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                    "description": "Revert a Windows to how it was when it was created",
+                    "type": "object",
+                    "properties": {
+                       "name": {
+                           "description": "The name of the Windows instance to reset",
+                           "type": "string"
+                       }
+                    },
+                    "required": ["name"]
+                   }
+    CANCEL_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "Stop creating a Windows, and destroy whatever was made so far",
+                     "type": "object",
+                     "properties": {
+                        "task-id": {
+                            "description": "The task-id returned when you started creating the Windows",
+                            "type": "string"
+                        }
+                     },
+                     "required": ["task-id"]
+                    }
+    POWER_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                    "description": "Turn on/off/restart many Windows at once",
+                    "type": "object",
+                    "properties": {
+                       "state": {
+                           "description": "The power state to put the Windows instances into",
+                           "type": "string",
+                           "enum": ["on", "off", "restart"]
+                       },
+                       "names": {
+                           "description": "The names of the Windows instances",
+                           "type": "array",
+                           "items": {"type": "string"},
+                           "minItems": 1
+                       },
+                       "all": {
+                           "description": "Set to true to power every Windows instance you own",
+                           "type": "boolean",
+                           "enum": [True]
+                       }
+                    },
+                    "required": ["state"],
+                    "oneOf": [{"required": ["names"]}, {"required": ["all"]}]
+                   }
+    NETWORK_BATCH_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                            "description": "Connect many Windows to a network at once",
+                            "type": "object",
+                            "properties": {
+                               "new_network": {
+                                   "description": "The name of the network to connect the Windows instances to",
+                                   "type": "string"
+                               },
+                               "names": {
+                                   "description": "The names of the Windows instances",
+                                   "type": "array",
+                                   "items": {"type": "string"},
+                                   "minItems": 1
+                               },
+                               "all": {
+                                   "description": "Set to true to update every Windows instance you own",
+                                   "type": "boolean",
+                                   "enum": [True]
+                               }
+                            },
+                            "required": ["new_network"],
+                            "oneOf": [{"required": ["names"]}, {"required": ["all"]}]
+                           }
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the Windows instances you own"
                  }
+    GET_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                       "description": "Limit what's returned about your Windows instances",
+                       "type": "object",
+                       "properties": {
+                          "fields": {
+                              "description": "Comma separated info to return for each instance; any of {}. Default is all of them.".format(', '.join(SHOW_FIELDS)),
+                              "type": "string"
+                          },
+                          "limit": {
+                              "description": "The most instances to return; see the next_cursor param for the next page",
+                              "type": "integer",
+                              "minimum": 1
+                          },
+                          "cursor": {
+                              "description": "The next_cursor param from the prior page of results",
+                              "type": "string"
+                          },
+                          "name": {
+                              "description": "Only return instances with a matching name; supports * and ? wildcards",
+                              "type": "string"
+                          }
+                       }
+                      }
+    INVENTORY_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                        "description": "Admins only. Report on every Windows across all users. POST to start the report, then GET /inventory/<task-id> until it stops returning 202 to get the NDJSON results."
+                       }
+    REAP_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                   "description": "Admins only. Find, and optionally destroy, Windows that are only taking up space",
+                   "type": "object",
+                   "properties": {
+                      "dry_run": {
+                          "description": "Set to false to actually destroy the VMs. Default is true.",
+                          "type": "boolean",
+                          "default": True
+                      }
+                   }
+                  }
+    METRICS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "description": "Admins only. View the reaper counters, how fast OVAs are read off disk, and how long creates wait in the queue per user"
+                     }
+    HISTORY_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                      "description": "Admins only. View the p50/p95/p99 duration of tasks, by image"
+                     }
+    HISTORY_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                           "description": "Limit which tasks are included in the durations",
+                           "type": "object",
+                           "properties": {
+                              "tasks": {
+                                  "description": "Comma separated tasks to report on, like create,delete. Default is all of them.",
+                                  "type": "string"
+                              },
+                              "since": {
+                                  "description": "Only include tasks that finished after this Unix timestamp",
+                                  "type": "number"
+                              },
+                              "until": {
+                                  "description": "Only include tasks that finished before this Unix timestamp",
+                                  "type": "number"
+                              }
+                           }
+                          }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of Windows that can be created"
                     }
 
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
+    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA, get_args=GET_ARGS_SCHEMA)
     def get(self, *args, **kwargs):
         """Display the Windows instances you own"""
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('windows.show', [username, txn_id])
+        try:
+            show_args = _parse_show_args(request.args)
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        task = current_app.celery_app.send_task('windows.show', [username, txn_id], kwargs=show_args)
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -83,7 +224,8 @@ class WindowsView(MachineView):
         machine_name = body['name']
         image = body['image']
         network = '{}_{}'.format(username, body['network'])
-        task = current_app.celery_app.send_task('windows.create', [username, machine_name, image, network, txn_id])
+        task = current_app.celery_app.send_task('windows.create', [username, machine_name, image, network, txn_id],
+                                                kwargs={'queued_at': time.time()})
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -105,6 +247,180 @@ class WindowsView(MachineView):
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @route('/reset', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=RESET_SCHEMA)
+    @describe(post=RESET_SCHEMA)
+    def reset(self, *args, **kwargs):
+        """Revert a Windows to how it was when it was created"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        machine_name = kwargs['body']['name']
+        task = current_app.celery_app.send_task('windows.reset', [username, machine_name, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/cancel', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=CANCEL_SCHEMA)
+    @describe(post=CANCEL_SCHEMA)
+    def cancel(self, *args, **kwargs):
+        """Stop creating a Windows"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        create_task_id = kwargs['body']['task-id']
+        task = current_app.celery_app.send_task('windows.cancel', [username, create_task_id, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/power', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=POWER_SCHEMA)
+    @describe(post=POWER_SCHEMA)
+    def power(self, *args, **kwargs):
+        """Turn on/off/restart many Windows at once"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        # None tells the worker to power every Windows the user has
+        machine_names = body.get('names')
+        task = current_app.celery_app.send_task('windows.power', [username, machine_names, body['state'], txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/network/batch', methods=["PUT"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=NETWORK_BATCH_SCHEMA)
+    @describe(put=NETWORK_BATCH_SCHEMA)
+    def modify_network_batch(self, *args, **kwargs):
+        """Connect many Windows to a network at once"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        body = kwargs['body']
+        new_network = '{}_{}'.format(username, body['new_network'])
+        # None tells the worker to update every Windows the user has
+        machine_names = body.get('names')
+        task = current_app.celery_app.send_task('windows.modify_network_batch',
+                                                [username, machine_names, new_network, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/inventory', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(post=INVENTORY_SCHEMA)
+    def inventory(self, *args, **kwargs):
+        """Start a report on every Windows across all users"""
+        username = kwargs['token']['username']
+        if not _is_admin(username):
+            return ujson.dumps({'error' : 'user {} does not have access'.format(username)}), 403
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        task = current_app.celery_app.send_task('windows.inventory', [txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/inventory/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/inventory/<task_id>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def inventory_report(self, *args, **kwargs):
+        """Send the finished report on every Windows as NDJSON; 202 while the worker is still writing it"""
+        username = kwargs['token']['username']
+        if not _is_admin(username):
+            return ujson.dumps({'error' : 'user {} does not have access'.format(username)}), 403
+        task_id = kwargs['task_id']
+        try:
+            status = reports.status(task_id)
+        except ValueError as doh:
+            return ujson.dumps({'error' : '{}'.format(doh)}), 400
+        if status == 'abandoned':
+            return ujson.dumps({'user' : username, 'error': 'Report stopped before it finished'}), 500
+        elif status != 'finished':
+            # Waiting here would tie up an API process for as long as the report takes
+            result = current_app.celery_app.AsyncResult(task_id)
+            resp_data = {'user' : username, 'content': {'status': result.status}}
+            if result.status == 'FAILURE':
+                return ujson.dumps(resp_data), 500
+            return ujson.dumps(resp_data), 202
+        return Response(reports.read(task_id), mimetype='application/x-ndjson')
+
+    @route('/reap', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=REAP_SCHEMA)
+    @describe(post=REAP_SCHEMA)
+    def reap(self, *args, **kwargs):
+        """Find, and optionally destroy, Windows that are only taking up space"""
+        username = kwargs['token']['username']
+        if not _is_admin(username):
+            return ujson.dumps({'error' : 'user {} does not have access'.format(username)}), 403
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        dry_run = kwargs['body'].get('dry_run', True)
+        task = current_app.celery_app.send_task('windows.reap', [txn_id], kwargs={'dry_run': dry_run})
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/metrics', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get=METRICS_SCHEMA)
+    def metrics(self, *args, **kwargs):
+        """View the reaper counters, how fast OVAs are read off disk, and how long creates wait in the queue per user"""
+        username = kwargs['token']['username']
+        if not _is_admin(username):
+            return ujson.dumps({'error' : 'user {} does not have access'.format(username)}), 403
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        task = current_app.celery_app.send_task('windows.metrics', [txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/history', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get=HISTORY_SCHEMA, get_args=HISTORY_ARGS_SCHEMA)
+    def history(self, *args, **kwargs):
+        """View the p50/p95/p99 duration of tasks, by image"""
+        username = kwargs['token']['username']
+        if not _is_admin(username):
+            return ujson.dumps({'error' : 'user {} does not have access'.format(username)}), 403
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        try:
+            history_args = _parse_history_args(request.args)
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        task = current_app.celery_app.send_task('windows.history', [txn_id], kwargs=history_args)
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
     @route('/image', methods=["GET"])
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @describe(get=IMAGES_SCHEMA)
@@ -119,3 +435,73 @@ class WindowsView(MachineView):
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
+
+
+def _parse_show_args(args):
+    """Convert the query params of a GET into the keyword arguments for the ``windows.show`` task.
+
+    Only supplied params are included, so the worker defaults apply otherwise.
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if a param is invalid
+
+    :param args: The query params of the request
+    :type args: werkzeug.datastructures.MultiDict
+    """
+    show_args = {}
+    if args.get('fields'):
+        fields = [x.strip() for x in args['fields'].split(',') if x.strip()]
+        unknown = [x for x in fields if x not in SHOW_FIELDS]
+        if unknown:
+            raise ValueError('Unknown fields: {}. Valid fields are: {}'.format(', '.join(unknown), ', '.join(SHOW_FIELDS)))
+        show_args['fields'] = fields
+    if args.get('limit'):
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValueError('Param limit must be a positive integer, supplied: {}'.format(args['limit']))
+        show_args['limit'] = limit
+    for param in ('cursor', 'name'):
+        if args.get(param):
+            show_args[param] = args[param]
+    return show_args
+
+
+def _parse_history_args(args):
+    """Convert the query params of a GET on /history into the keyword arguments
+    for the ``windows.history`` task.
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if a param is invalid
+
+    :param args: The query params of the request
+    :type args: werkzeug.datastructures.MultiDict
+    """
+    history_args = {}
+    if args.get('tasks'):
+        history_args['tasks'] = [x.strip() for x in args['tasks'].split(',') if x.strip()]
+    for param in ('since', 'until'):
+        if args.get(param):
+            try:
+                history_args[param] = float(args[param])
+            except ValueError:
+                raise ValueError('Param {} must be a Unix timestamp, supplied: {}'.format(param, args[param]))
+    return history_args
+
+
+def _is_admin(username):
+    """Check if a user can use the admin-only end points.
+
+    This isn't done with ``requires(username=...)`` because it also lets in any
+    token with the right version when the username doesn't match.
+
+    :Returns: Boolean
+
+    :param username: The user making the request
+    :type username: String
+    """
+    return username in const.VLAB_WINDOWS_ADMINS
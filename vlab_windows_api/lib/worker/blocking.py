@@ -0,0 +1,55 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeps blocking disk and SQLite I/O from stalling the ``gevent`` pool.
+
+Under ``gevent`` every task runs in one OS thread, and monkey patching only
+makes sockets cooperative. A read from a slow disk, or a SQLite call waiting
+on another process's lock, would freeze every task on the worker until it
+returned. ``call`` runs those on gevent's pool of native threads instead, and
+just calls the function under ``prefork``.
+"""
+import sys
+import functools
+
+
+def _threadpool():
+    """Find gevent's native thread pool, if the worker is running under gevent
+
+    :Returns: gevent.threadpool.ThreadPool or None
+    """
+    # Only look if something already imported gevent; prefork workers never load it
+    gevent = sys.modules.get('gevent')
+    if gevent is None:
+        return None
+    from gevent import monkey
+    if not monkey.is_module_patched('socket'):
+        return None
+    return gevent.get_hub().threadpool
+
+
+def call(func, *args, **kwargs):
+    """Run a function that blocks on I/O, without blocking other greenlets
+
+    :Returns: Whatever ``func`` returns
+
+    :param func: The function to run
+    :type func: Callable
+    """
+    pool = _threadpool()
+    if pool is None:
+        return func(*args, **kwargs)
+    return pool.apply(func, args, kwargs)
+
+
+def offload(func):
+    """Decorate a function so that it always runs via ``call``
+
+    :Returns: Function
+
+    :param func: The function that blocks on I/O
+    :type func: Callable
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return call(func, *args, **kwargs)
+    return wrapper
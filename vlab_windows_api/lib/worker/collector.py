@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk lookups of vCenter objects via the PropertyCollector.
+
+Accessing an attribute on a pyVmomi object is a round-trip to vCenter, so walking
+a list of objects and reading ``.name`` off each one costs one SOAP call per
+object. The functions here fetch the requested properties for *every* matching
+object in a handful of calls instead.
+"""
+from pyVmomi import vim, vmodl
+
+
+def retrieve(vcenter, vimtype, path_set, root=None, page_size=1000):
+    """Obtain properties for every object of a given type below ``root``
+
+    :Returns: Generator of Dictionaries; property path -> value, and the key
+              ``obj`` for the managed object itself. Properties that are not
+              set on an object are absent from its dictionary.
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param vimtype: The category of object to find
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param path_set: The property paths to fetch, i.e. ``['name', 'runtime.powerState']``
+    :type path_set: List
+
+    :param root: The object to search under. Defaults to the vCenter root folder.
+    :type root: vim.ManagedEntity
+
+    :param page_size: How many objects vCenter should return per call
+    :type page_size: Integer
+    """
+    return retrieve_many(vcenter, {vimtype: path_set}, root=root, page_size=page_size)
+
+
+def retrieve_many(vcenter, specs, root=None, page_size=1000):
+    """Like ``retrieve``, but for several types of objects in a single traversal
+
+    :Returns: Generator of Dictionaries; property path -> value, and the key
+              ``obj`` for the managed object itself.
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param specs: The category of object -> the property paths to fetch for it
+    :type specs: Dictionary
+
+    :param root: The object to search under. Defaults to the vCenter root folder.
+    :type root: vim.ManagedEntity
+
+    :param page_size: How many objects vCenter should return per call
+    :type page_size: Integer
+    """
+    content = vcenter.content
+    if root is None:
+        root = content.rootFolder
+    view = content.viewManager.CreateContainerView(container=root,
+                                                   type=list(specs.keys()),
+                                                   recursive=True)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView',
+                                                                path='view',
+                                                                skip=False,
+                                                                type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=path_set, all=False)
+                      for vimtype, path_set in specs.items()]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+        for props in _collect(vcenter, filter_spec, page_size):
+            yield props
+    finally:
+        view.DestroyView()
+
+
+def retrieve_objects(vcenter, vimtype, objs, path_set, page_size=1000):
+    """Like ``retrieve``, but for a known list of objects instead of everything below a folder
+
+    :Returns: Generator of Dictionaries; property path -> value, and the key
+              ``obj`` for the managed object itself.
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param vimtype: The category of the objects
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param objs: The objects to fetch properties for
+    :type objs: List
+
+    :param path_set: The property paths to fetch, i.e. ``['name', 'runtime.powerState']``
+    :type path_set: List
+
+    :param page_size: How many objects vCenter should return per call
+    :type page_size: Integer
+    """
+    if not objs:
+        return
+    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=x, skip=False) for x in objs]
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=path_set, all=False)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[prop_spec])
+    for props in _collect(vcenter, filter_spec, page_size):
+        yield props
+
+
+def _collect(vcenter, filter_spec, page_size):
+    """Run a PropertyCollector query, following the continuation token until every object is returned
+
+    :Returns: Generator of Dictionaries
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param filter_spec: What to collect
+    :type filter_spec: vmodl.query.PropertyCollector.FilterSpec
+
+    :param page_size: How many objects vCenter should return per call
+    :type page_size: Integer
+    """
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    collector = vcenter.content.propertyCollector
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    while result:
+        for obj_content in result.objects:
+            props = {x.name: x.val for x in obj_content.propSet}
+            props['obj'] = obj_content.obj
+            yield props
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
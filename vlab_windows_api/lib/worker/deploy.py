@@ -0,0 +1,722 @@
+# -*- coding: UTF-8 -*-
+"""
+Deploys new VMs from an OVA, uploading all of the OVA's disks in parallel.
+
+``vlab_inf_common`` uploads disks one after another over a single HTTP stream,
+which leaves multi-disk Windows images spending most of their create time in a
+single-threaded copy. Here every disk gets its own (pooled) HTTPS connection,
+and disk content is read straight from the tar member offsets into a reusable
+buffer instead of going through ``tarfile``.
+"""
+import os
+import re
+import time
+import hashlib
+import random
+import tarfile
+import threading
+import http.client
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+from pyVmomi import vim, vmodl
+from vlab_inf_common.ssl_context import get_context
+from vlab_inf_common.vmware import virtual_machine, consume_task
+from vlab_inf_common.vmware.exceptions import DeployFailure
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import blocking, transient
+
+
+HOSTNAME_REGEX = r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$'
+PROGRESS_INTERVAL = 5
+LEASE_TIMEOUT = 300
+POOL_MAX_IDLE = 30
+STALE_ERRORS = (BrokenPipeError, ConnectionResetError, http.client.RemoteDisconnected)
+
+
+class Cancelled(Exception):
+    """The user cancelled the create while it was in progress"""
+    pass
+
+
+class OvaImage(object):
+    """An OVA file on local disk, indexed so its disks can be read concurrently.
+
+    The file is read with positional reads plus readahead hints, so the kernel
+    streams it off disk in large requests. It's deliberately not memory mapped; if
+    an image on the share is truncated or replaced mid-create, a mapped read past
+    the new end kills the worker with SIGBUS, instead of raising an error.
+
+    :param path: The location of the OVA file
+    :type path: String
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ovf = None
+        self.manifest = None
+        self.disks = {}
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.name.endswith('.vmdk'):
+                    self.disks[member.name] = (member.offset_data, member.size)
+                elif member.name.endswith('.ovf'):
+                    self.ovf = tar.extractfile(member).read().decode()
+                elif member.name.endswith('.mf'):
+                    self.manifest = tar.extractfile(member).read().decode()
+        self._fd = os.open(path, os.O_RDONLY)
+        for offset, size in self.disks.values():
+            advise(self._fd, offset, size, getattr(os, 'POSIX_FADV_SEQUENTIAL', None))
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    @property
+    def networks(self):
+        """The names of the networks the OVA's VM is configured with"""
+        ntwks = re.findall(r'Network ovf:name=[\w\ \"]{1,50}', self.ovf)
+        return [x.split('=')[1].replace('"', '') for x in ntwks]
+
+    @property
+    def size(self):
+        """The combined size of every disk within the OVA, in bytes"""
+        return sum(x[1] for x in self.disks.values())
+
+    @property
+    def disk_space(self):
+        """How much datastore space the imported disks will use, in bytes.
+
+        The VMDKs in an OVA are compressed, so ``size`` understates it. This
+        comes from the descriptor's ``<Disk>`` elements instead; the populated
+        size when it's given (disks are imported thin), otherwise the capacity.
+        """
+        total = 0
+        disks = re.findall(r'<(?:ovf:)?Disk\s[^>]*>', self.ovf or '')
+        for disk in disks:
+            attrs = dict(re.findall(r'(?:ovf:)?(\w+)="([^"]*)"', disk))
+            if attrs.get('populatedSize'):
+                total += int(attrs['populatedSize'])
+            else:
+                total += int(attrs.get('capacity', 0)) * _allocation_units(attrs.get('capacityAllocationUnits', 'byte'))
+        if not disks:
+            return self.size
+        return total
+
+    @property
+    def checksum(self):
+        """A SHA256 that changes whenever the content of the OVA changes.
+
+        OVAs normally include a manifest with the checksum of every file, so
+        hashing that is as good as hashing the whole (multi-GB) OVA. Without a
+        manifest, fall back to the descriptor, disk sizes and modified time.
+        """
+        if self.manifest:
+            source = self.manifest
+        else:
+            disks = sorted('{}:{}'.format(k, v[1]) for k, v in self.disks.items())
+            source = '{}{}{}'.format(self.ovf, disks, os.stat(self.path).st_mtime)
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def read_into(self, offset, buffer):
+        """Fill a buffer with the OVA's content, starting at a given offset.
+
+        Uses positional reads, so any number of threads can read at once. The
+        kernel is asked to start reading the next ``VLAB_WINDOWS_READAHEAD_MB``
+        so the disk is busy while this chunk is being uploaded.
+
+        :Returns: Integer - the number of bytes read
+
+        :param offset: Where in the OVA file to start reading from
+        :type offset: Integer
+
+        :param buffer: The object to read into
+        :type buffer: memoryview
+        """
+        start = time.time()
+        # WILLNEED can block while the kernel queues the reads
+        blocking.call(advise, self._fd, offset + len(buffer), const.VLAB_WINDOWS_READAHEAD_MB * 1024 * 1024,
+                      getattr(os, 'POSIX_FADV_WILLNEED', None))
+        read = blocking.call(_pread_into, self._fd, buffer, offset)
+        with self._stats_lock:
+            self.bytes_read += read
+            self.read_seconds += time.time() - start
+        return read
+
+    def close(self):
+        """Release the file handle to the OVA"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _allocation_units(units):
+    """Convert an OVF allocation unit, like ``byte * 2^30``, into a number of bytes
+
+    :Returns: Integer
+
+    :param units: The value of a ``capacityAllocationUnits`` attribute
+    :type units: String
+    """
+    multiplier = 1
+    for factor in units.replace('byte', '').split('*'):
+        factor = factor.strip()
+        if '^' in factor:
+            base, exponent = factor.split('^')
+            multiplier *= int(base) ** int(exponent)
+        elif factor:
+            multiplier *= int(factor)
+    return multiplier
+
+
+def _pread_into(fd, buffer, offset):
+    """Like ``os.preadv``, which isn't available before Python 3.7
+
+    :Returns: Integer - the number of bytes read
+
+    :param fd: The open file to read from
+    :type fd: Integer
+
+    :param buffer: The object to read into
+    :type buffer: memoryview
+
+    :param offset: Where in the file to start reading from
+    :type offset: Integer
+    """
+    data = os.pread(fd, len(buffer), offset)
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def advise(fd, offset, length, advice):
+    """Tell the kernel how part of a file will be read. Does nothing on platforms
+    without ``posix_fadvise``, since it's only ever a hint.
+
+    :Returns: None
+
+    :param fd: The open file
+    :type fd: Integer
+
+    :param offset: Where the range starts
+    :type offset: Integer
+
+    :param length: How many bytes the range covers
+    :type length: Integer
+
+    :param advice: One of the ``os.POSIX_FADV_*`` constants
+    :type advice: Integer
+    """
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+
+def warm_page_cache(path, chunk_mb=64):
+    """Have the kernel read a whole file into the page cache, in the background
+
+    :Returns: Integer - the size of the file, in bytes
+
+    :param path: The file to read
+    :type path: String
+
+    :param chunk_mb: How much to ask for at a time, so other work isn't starved
+    :type chunk_mb: Integer
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        chunk = chunk_mb * 1024 * 1024
+        for offset in range(0, size, chunk):
+            # WILLNEED can block while the kernel queues the reads
+            blocking.call(advise, fd, offset, chunk, getattr(os, 'POSIX_FADV_WILLNEED', None))
+    finally:
+        os.close(fd)
+    return size
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTPS connections around so uploads to the same ESXi host
+    don't pay for a new TLS handshake every time.
+
+    ESXi closes connections that sit idle, so any connection that's been idle
+    for ``max_idle`` seconds is closed instead of reused.
+
+    :param max_idle: The most seconds a connection can sit idle, and still be reused
+    :type max_idle: Integer
+    """
+    def __init__(self, max_idle=POOL_MAX_IDLE):
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, netloc, fresh=False):
+        """Obtain a connection to a host
+
+        :Returns: http.client.HTTPSConnection
+
+        :param netloc: The host (and optionally port) to connect to
+        :type netloc: String
+
+        :param fresh: Set to True to always make a new connection
+        :type fresh: Boolean
+        """
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(netloc, [])
+            if idle and not fresh:
+                # the most recently used is last, so if it's expired they all are
+                conn, returned = idle.pop()
+                if time.time() - returned > self._max_idle:
+                    expired = [conn] + [x for x, _ in idle]
+                    idle.clear()
+                    conn = None
+        for stale in expired:
+            stale.close()
+        if conn is None:
+            # without a timeout, an ESXi host that stops reading would hang the upload (and any cancel) forever
+            conn = http.client.HTTPSConnection(netloc, context=get_context(), timeout=const.VLAB_WINDOWS_UPLOAD_TIMEOUT)
+        return conn
+
+    def put(self, netloc, conn):
+        """Return a healthy connection so another upload can use it
+
+        :Returns: None
+
+        :param netloc: The host the connection is to
+        :type netloc: String
+
+        :param conn: The connection
+        :type conn: http.client.HTTPSConnection
+        """
+        with self._lock:
+            self._idle.setdefault(netloc, []).append((conn, time.time()))
+
+
+class Throttle(object):
+    """Caps the combined throughput of every thread sharing this object.
+
+    :param max_mbps: The most MB/s to allow. Zero means "no limit".
+    :type max_mbps: Integer
+    """
+    def __init__(self, max_mbps=const.VLAB_WINDOWS_UPLOAD_MAX_MBPS):
+        self._rate = max_mbps * 1024 * 1024
+        self._lock = threading.Lock()
+        self._allowance = self._rate
+        self._last = time.time()
+
+    def consume(self, amount):
+        """Block until sending ``amount`` more bytes stays under the limit
+
+        :Returns: None
+
+        :param amount: The number of bytes about to be sent
+        :type amount: Integer
+        """
+        if not self._rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self._rate, self._allowance + (now - self._last) * self._rate)
+            self._last = now
+            self._allowance -= amount
+            deficit = -self._allowance
+        if deficit > 0:
+            time.sleep(deficit / self._rate)
+
+
+class Progress(object):
+    """Thread safe tally of how much of an upload is complete
+
+    :param total: The number of bytes to upload
+    :type total: Integer
+    """
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        """Record that more bytes have been sent"""
+        with self._lock:
+            self.sent += amount
+
+    @property
+    def percent(self):
+        """How complete the upload is, as an integer between 0 and 100"""
+        if not self.total:
+            return 100
+        return min(100, int(100 * self.sent / self.total))
+
+
+_pool = ConnectionPool()
+
+
+def deploy_from_ova(vcenter, ova, network_map, username, machine_name, logger, power_on=True,
+                    folder=None, datastore=None, should_stop=None):
+    """Create a new VM from an OVA, uploading its disks in parallel.
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param ova: The OVA to deploy
+    :type ova: OvaImage
+
+    :param network_map: The mapping of networks defined in the OVA with what's
+                        available in vCenter.
+    :type network_map: List of vim.OvfManager.NetworkMapping
+
+    :param username: The name of the user deploying a new VM
+    :type username: String
+
+    :param machine_name: The unique name to give the new VM
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param power_on: Set to True to have the VM powered on after deployment
+    :type power_on: Boolean
+
+    :param folder: Where to create the VM. Defaults to the user's folder.
+    :type folder: vim.Folder
+
+    :param datastore: Where to store the VM. Defaults to a random datastore.
+    :type datastore: vim.Datastore
+
+    :param should_stop: Polled during the upload; return True to cancel the deploy.
+    :type should_stop: Function
+    """
+    if not re.match(HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+    if folder is None:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    if datastore is None:
+        datastore = pick_datastore(vcenter)
+    resource_pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    host = pick_host(vcenter)
+    spec_params = vim.OvfManager.CreateImportSpecParams(entityName=machine_name,
+                                                        diskProvisioning='thin',
+                                                        networkMapping=network_map)
+    spec = vcenter.ovf_manager.CreateImportSpec(ovfDescriptor=ova.ovf,
+                                                resourcePool=resource_pool,
+                                                datastore=datastore,
+                                                cisp=spec_params)
+    if spec.error:
+        raise DeployFailure(spec.error[0].msg)
+    lease = _get_lease(resource_pool, spec.importSpec, folder, host)
+    the_vm = lease.info.entity
+    logger.debug('Uploading {} disks'.format(len(spec.fileItem)))
+    try:
+        upload_disks(ova, spec.fileItem, lease, host.name, should_stop=should_stop)
+    except Cancelled:
+        logger.info('Deploy of {} cancelled, removing partial VM'.format(machine_name))
+        destroy_partial(the_vm)
+        raise
+    logger.debug('OVA deployed successfully')
+    if power_on:
+        logger.debug("Powering on {}'s new VM {}".format(username, machine_name))
+        virtual_machine.power(the_vm, state='on')
+    return the_vm
+
+
+def pick_datastore(vcenter):
+    """Choose which datastore a new VM should live on
+
+    :Returns: vim.Datastore
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    datastore = vcenter.datastores[random.choice(const.INF_VCENTER_DATASTORE.split(','))]
+    if isinstance(datastore, vim.StoragePod):
+        datastore = random.choice(datastore.childEntity)
+    return datastore
+
+
+def pick_host(vcenter):
+    """Choose which ESXi host a new VM should be created on
+
+    :Returns: vim.HostSystem
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    hosts = [x for x in vcenter.host_systems.values() if not x.runtime.inMaintenanceMode]
+    return random.choice(hosts)
+
+
+def destroy_partial(the_vm):
+    """Delete a VM that was only partly created
+
+    :Returns: None
+
+    :param the_vm: The VM to delete
+    :type the_vm: vim.VirtualMachine
+    """
+    try:
+        consume_task(the_vm.Destroy_Task())
+    except vmodl.fault.ManagedObjectNotFound:
+        # vCenter removes the VM itself when an import lease is aborted
+        pass
+
+
+def upload_disks(ova, file_items, lease, host_name, should_stop=None):
+    """Upload every disk an import spec needs at the same time, then complete the lease.
+
+    :Returns: None
+
+    :param ova: The OVA being deployed
+    :type ova: OvaImage
+
+    :param file_items: The files the import spec requires
+    :type file_items: List of vim.OvfManager.FileItem
+
+    :param lease: A ready-to-use lease for importing a VM
+    :type lease: vim.HttpNfcLease
+
+    :param host_name: The ESXi host the VM is being imported to
+    :type host_name: String
+
+    :param should_stop: Polled along with the progress updates; return True to cancel the upload.
+    :type should_stop: Function
+    """
+    file_items = [x for x in file_items if x.path in ova.disks]
+    progress = Progress(sum(ova.disks[x.path][1] for x in file_items))
+    throttle = Throttle()
+    done = threading.Event()
+    cancelled = threading.Event()
+    chimer = threading.Thread(target=_chime_progress, args=(lease, progress, done, should_stop, cancelled),
+                              daemon=True)
+    chimer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=const.VLAB_WINDOWS_UPLOAD_WORKERS) as executor:
+            futures = []
+            for file_item in file_items:
+                url = _get_device_url(lease, file_item, host_name)
+                futures.append(executor.submit(_upload_disk_retrying, ova, file_item.path, url, progress, throttle, done))
+            finished, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in finished:
+                if future.exception():
+                    # stop the other uploads; no point in finishing them
+                    done.set()
+                    if cancelled.is_set():
+                        raise Cancelled('Upload cancelled')
+                    raise future.exception()
+        if cancelled.is_set():
+            # the cancel came in as the last chunk was sent
+            raise Cancelled('Upload cancelled')
+        lease.Progress(100)
+        lease.Complete()
+    except vmodl.MethodFault as doh:
+        lease.Abort(doh)
+        raise
+    except Exception as doh:
+        lease.Abort(vmodl.fault.SystemError(reason='{}'.format(doh)))
+        raise
+    finally:
+        done.set()
+
+
+def _upload_disk_retrying(ova, disk_name, url, progress, throttle, stop):
+    """Upload a disk, trying again after a transient failure like a dropped connection.
+
+    Disks that already finished are never sent again. ESXi takes each disk in a
+    single POST, so the disk that failed starts over from its first byte.
+
+    :Returns: None
+
+    :param ova: The OVA being deployed
+    :type ova: OvaImage
+
+    :param disk_name: The name of the VMDK within the OVA
+    :type disk_name: String
+
+    :param url: Where to upload the disk to
+    :type url: String
+
+    :param progress: Tracks how much of the whole OVA has been sent
+    :type progress: Progress
+
+    :param throttle: Caps the upload bandwidth
+    :type throttle: Throttle
+
+    :param stop: Set when the upload should be abandoned
+    :type stop: threading.Event
+    """
+    attempt = 0
+    while True:
+        try:
+            return _upload_disk(ova, disk_name, url, progress, throttle, stop)
+        except Exception as doh:
+            if stop.is_set() or attempt >= const.VLAB_WINDOWS_RETRIES or not transient.is_transient(doh):
+                raise
+            # waiting on the event means a cancel doesn't sit out the backoff
+            if stop.wait(transient.backoff(attempt)):
+                raise
+            attempt += 1
+
+
+def _upload_disk(ova, disk_name, url, progress, throttle, stop):
+    """Stream a single disk from the OVA to ESXi
+
+    :Returns: None
+
+    :param ova: The OVA being deployed
+    :type ova: OvaImage
+
+    :param disk_name: The name of the VMDK within the OVA
+    :type disk_name: String
+
+    :param url: Where to upload the disk to
+    :type url: String
+
+    :param progress: Tracks how much of the whole OVA has been sent
+    :type progress: Progress
+
+    :param throttle: Caps the upload bandwidth
+    :type throttle: Throttle
+
+    :param stop: Set when the upload should be abandoned
+    :type stop: threading.Event
+    """
+    offset, size = ova.disks[disk_name]
+    parsed = urlparse(url)
+    path = '{}?{}'.format(parsed.path, parsed.query) if parsed.query else parsed.path
+    buf = memoryview(bytearray(const.VLAB_WINDOWS_UPLOAD_CHUNK_MB * 1024 * 1024))
+    for fresh in (False, True):
+        conn = _pool.get(parsed.netloc, fresh=fresh)
+        sent = 0
+        try:
+            conn.putrequest('POST', path)
+            conn.putheader('Content-Length', str(size))
+            conn.putheader('Content-Type', 'application/x-vnd.vmware-streamVmdk')
+            conn.endheaders()
+            while sent < size:
+                if stop.is_set():
+                    raise RuntimeError('Upload of {} abandoned'.format(disk_name))
+                chunk = buf[:min(len(buf), size - sent)]
+                read = ova.read_into(offset + sent, chunk)
+                if not read:
+                    raise RuntimeError('Unexpected end of OVA while reading {}'.format(disk_name))
+                throttle.consume(read)
+                conn.send(chunk[:read])
+                sent += read
+                progress.add(read)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status not in (200, 201):
+                error = 'Upload of {} failed: HTTP {} {}'.format(disk_name, resp.status, resp.reason)
+                if resp.status >= 500:
+                    raise transient.TransientError(error)
+                raise RuntimeError(error)
+        except STALE_ERRORS:
+            conn.close()
+            progress.add(-sent)
+            if sent or fresh:
+                raise
+            # ESXi closed the pooled connection before any of the disk was sent;
+            # reconnect once, without counting it as a failed attempt
+            continue
+        except Exception:
+            conn.close()
+            # the disk starts over if it's retried
+            progress.add(-sent)
+            raise
+        else:
+            _pool.put(parsed.netloc, conn)
+            return
+
+
+def _get_device_url(lease, file_item, host_name):
+    """Obtain the URL to upload a specific disk to
+
+    :Returns: String
+
+    :param lease: The lease for importing the VM
+    :type lease: vim.HttpNfcLease
+
+    :param file_item: The disk to upload
+    :type file_item: vim.OvfManager.FileItem
+
+    :param host_name: The ESXi host the VM is being imported to
+    :type host_name: String
+    """
+    for device_url in lease.info.deviceUrl:
+        if device_url.importKey == file_item.deviceId:
+            # ESXi uses '*' when it doesn't know what name we use to reach it
+            return device_url.url.replace('*', host_name)
+    error = "Failed to find deviceUrl for file {}".format(file_item.path)
+    raise RuntimeError(error)
+
+
+def _chime_progress(lease, progress, done, should_stop=None, cancelled=None):
+    """Report upload progress until told to stop. This also keeps the lease from timing out,
+    and checks if the upload should be cancelled."""
+    while not done.wait(PROGRESS_INTERVAL):
+        if should_stop is not None and should_stop():
+            cancelled.set()
+            done.set()
+            break
+        try:
+            lease.Progress(progress.percent)
+        except vmodl.fault.ManagedObjectNotFound:
+            # race between the upload completing, and the chime
+            break
+
+
+def _get_lease(resource_pool, import_spec, folder, host):
+    """Obtain an import lease that's ready to be used
+
+    :Returns: vim.HttpNfcLease
+
+    :param resource_pool: The resource pool the new VM will be part of
+    :type resource_pool: vim.ResourcePool
+
+    :param import_spec: The configuration of the new VM
+    :type import_spec: vim.ImportSpec
+
+    :param folder: The folder to store the new VM in
+    :type folder: vim.Folder
+
+    :param host: The ESXi host to upload the OVA to
+    :type host: vim.HostSystem
+    """
+    lease = resource_pool.ImportVApp(import_spec, folder=folder, host=host)
+    for _ in range(LEASE_TIMEOUT):
+        if lease.error:
+            raise DeployFailure(lease.error.msg)
+        elif lease.state != 'ready':
+            time.sleep(1)
+        else:
+            break
+    else:
+        error = 'Deploy lease not usable after {} seconds'.format(LEASE_TIMEOUT)
+        # otherwise the half imported VM holds the name, and the retry fails preflight
+        _abort_lease(lease, error)
+        raise transient.TransientError(error)
+    return lease
+
+
+def _abort_lease(lease, reason):
+    """Give up on an import lease, making sure the half imported VM is removed
+
+    :Returns: None
+
+    :param lease: The lease to abort
+    :type lease: vim.HttpNfcLease
+
+    :param reason: Why the lease is being aborted
+    :type reason: String
+    """
+    try:
+        lease.Abort(vmodl.fault.SystemError(reason=reason))
+    except vmodl.MethodFault:
+        info = lease.info
+        if info is not None and info.entity is not None:
+            destroy_partial(info.entity)
@@ -0,0 +1,326 @@
+# -*- coding: UTF-8 -*-
+"""
+A record of every task the worker runs, kept in an append-only SQLite database
+at ``VLAB_WINDOWS_HISTORY_DB``. Task results only live in the ``rpc://``
+backend until they're retrieved, so this is what durations get analyzed from.
+
+Tasks never wait on the database; ``record`` just puts the entry on a queue,
+and a background thread writes the queue out in batches.
+
+Usage::
+
+    python -m vlab_windows_api.lib.worker.history --task create --task delete --hours 24
+"""
+import os
+import sys
+import time
+import queue
+import atexit
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import blocking
+
+
+PERCENTILES = (50, 95, 99)
+# How many entries to write per transaction, and to hold while the database is unavailable
+BATCH_SIZE = 500
+MAX_QUEUED = 10000
+PRUNE_INTERVAL = 3600
+COLUMNS = ('finished', 'task', 'task_id', 'username', 'image', 'datastore', 'outcome',
+           'duration', 'queue_wait', 'uploaded', 'timings')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    finished REAL NOT NULL,
+    task TEXT NOT NULL,
+    task_id TEXT,
+    username TEXT,
+    image TEXT,
+    datastore TEXT,
+    outcome TEXT NOT NULL,
+    duration REAL NOT NULL,
+    queue_wait REAL,
+    uploaded INTEGER,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_task_finished ON tasks (task, finished);
+"""
+
+_queue = queue.Queue(maxsize=MAX_QUEUED)
+_writer = {'pid': None, 'thread': None, 'pruned': 0}
+_writer_lock = threading.Lock()
+
+
+class Stats(object):
+    """How long each phase of a task took, plus anything else worth keeping in its history"""
+    def __init__(self):
+        self.timings = {}
+        self.info = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block of code. Timing the same phase again adds to it."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(self.timings.get(name, 0) + time.time() - start, 3)
+
+    def params(self):
+        """The stats, to include in the ``params`` of a task's response
+
+        :Returns: Dictionary
+        """
+        return dict(self.info, timings=self.timings)
+
+
+def make_entry(task_name, task_id, call_args, retval, state, duration):
+    """Build the history entry for a task that finished
+
+    :Returns: Dictionary
+
+    :param task_name: The name of the task, like ``windows.create``
+    :type task_name: String
+
+    :param task_id: The ID of the task
+    :type task_id: String
+
+    :param call_args: The arguments the task was called with, by name
+    :type call_args: Dictionary
+
+    :param retval: What the task returned, or the exception it raised
+    :type retval: Object
+
+    :param state: The final state of the task, like SUCCESS or FAILURE
+    :type state: String
+
+    :param duration: How many seconds the task ran for
+    :type duration: Float
+    """
+    params = {}
+    if state != 'SUCCESS':
+        outcome = 'exception'
+    else:
+        params = retval.get('params', {})
+        if params.get('state') == 'cancelled':
+            outcome = 'cancelled'
+        elif retval.get('error'):
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+    return {'finished': time.time(),
+            'task': task_name.split('.', 1)[-1],
+            'task_id': task_id,
+            'username': call_args.get('username'),
+            'image': params.get('image', call_args.get('image')),
+            'datastore': params.get('datastore'),
+            'outcome': outcome,
+            'duration': round(duration, 3),
+            'queue_wait': params.get('queue_wait'),
+            'uploaded': params.get('uploaded'),
+            'timings': params.get('timings', {})}
+
+
+def record(entry):
+    """Save an entry to the history, without waiting on the database
+
+    :Returns: None
+
+    :param entry: What ``make_entry`` returned
+    :type entry: Dictionary
+    """
+    _ensure_writer()
+    try:
+        _queue.put_nowait(entry)
+    except queue.Full:
+        # The database has been unavailable for a while; losing history beats blocking tasks
+        pass
+
+
+def flush(timeout=5):
+    """Wait for the queued entries to be written
+
+    :Returns: None
+
+    :param timeout: The most seconds to wait
+    :type timeout: Integer
+    """
+    deadline = time.time() + timeout
+    while _queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def _ensure_writer():
+    """Start the thread that writes entries, once per process (the prefork pool forks after import)"""
+    with _writer_lock:
+        if _writer['pid'] != os.getpid():
+            thread = threading.Thread(target=_write_forever, daemon=True)
+            thread.start()
+            _writer['pid'] = os.getpid()
+            _writer['thread'] = thread
+            atexit.register(flush)
+
+
+def _write_forever():
+    """Write out queued entries in batches; runs in a daemon thread"""
+    while True:
+        entries = [_queue.get()]
+        while len(entries) < BATCH_SIZE:
+            try:
+                entries.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            write(entries)
+        except sqlite3.Error as doh:
+            sys.stderr.write('Unable to write {} history entries: {}\n'.format(len(entries), doh))
+        finally:
+            for _ in entries:
+                _queue.task_done()
+
+
+@contextmanager
+def _connect():
+    """Open the database, creating the table if needed, and commit on success"""
+    directory = os.path.dirname(const.VLAB_WINDOWS_HISTORY_DB)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(const.VLAB_WINDOWS_HISTORY_DB, timeout=30)
+    try:
+        conn.executescript(SCHEMA)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+@blocking.offload
+def write(entries):
+    """Append entries to the history, and drop any older than ``VLAB_WINDOWS_HISTORY_DAYS``
+
+    :Returns: None
+
+    :param entries: What ``make_entry`` returned for each task
+    :type entries: List
+    """
+    rows = []
+    for entry in entries:
+        row = dict(entry, timings=ujson.dumps(entry.get('timings') or {}))
+        rows.append(tuple(row.get(x) for x in COLUMNS))
+    sql = 'INSERT INTO tasks ({}) VALUES ({})'.format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+    with _connect() as conn:
+        conn.executemany(sql, rows)
+        now = time.time()
+        if const.VLAB_WINDOWS_HISTORY_DAYS and now - _writer['pruned'] > PRUNE_INTERVAL:
+            conn.execute('DELETE FROM tasks WHERE finished < ?', (now - const.VLAB_WINDOWS_HISTORY_DAYS * 86400,))
+            _writer['pruned'] = now
+
+
+@blocking.offload
+def percentiles(tasks=None, since=None, until=None):
+    """Report the p50/p95/p99 durations of tasks, by image
+
+    Tasks that didn't finish OK are counted, but left out of the durations.
+
+    :Returns: Dictionary - task -> image -> stats
+
+    :param tasks: Only report on these tasks, like ``['create', 'delete']``. Default is all of them.
+    :type tasks: List
+
+    :param since: Only report on tasks that finished after this Unix timestamp
+    :type since: Float
+
+    :param until: Only report on tasks that finished before this Unix timestamp
+    :type until: Float
+    """
+    sql = 'SELECT task, image, outcome, duration, timings FROM tasks WHERE finished >= ? AND finished <= ?'
+    params = [since or 0, until or time.time()]
+    if tasks:
+        sql += ' AND task IN ({})'.format(', '.join('?' * len(tasks)))
+        params.extend(tasks)
+    groups = {}
+    with _connect() as conn:
+        for task, image, outcome, duration, timings in conn.execute(sql, params):
+            group = groups.setdefault(task, {}).setdefault(image or 'unknown', {'count': 0, 'failed': 0,
+                                                                                 'durations': [], 'timings': {}})
+            group['count'] += 1
+            if outcome != 'ok':
+                group['failed'] += 1
+                continue
+            group['durations'].append(duration)
+            for phase, seconds in ujson.loads(timings or '{}').items():
+                group['timings'].setdefault(phase, []).append(seconds)
+    report = {}
+    for task, images in groups.items():
+        for image, group in images.items():
+            stats = {'count': group['count'], 'failed': group['failed']}
+            stats.update(_percentiles(group['durations']))
+            stats['timings'] = {x: _percentiles(y) for x, y in group['timings'].items()}
+            report.setdefault(task, {})[image] = stats
+    return report
+
+
+@blocking.offload
+def popular_images(since=None):
+    """Find which images get created the most
+
+    :Returns: List - the images, most created first
+
+    :param since: Only count creates that finished after this Unix timestamp
+    :type since: Float
+    """
+    sql = """SELECT image FROM tasks WHERE task = 'create' AND outcome = 'ok' AND image IS NOT NULL AND finished >= ?
+             GROUP BY image ORDER BY COUNT(*) DESC"""
+    with _connect() as conn:
+        return [x[0] for x in conn.execute(sql, (since or 0,))]
+
+
+def _percentiles(values):
+    """Compute the nearest-rank ``PERCENTILES`` of some values
+
+    :Returns: Dictionary - like ``{'p50': 1.0, 'p95': 2.0, 'p99': 3.0}``
+
+    :param values: The numbers to compute the percentiles of
+    :type values: List
+    """
+    values = sorted(values)
+    answer = {}
+    for pct in PERCENTILES:
+        if values:
+            # nearest-rank; the smallest value with at least pct% of values at or below it
+            rank = max(int(-(-pct * len(values) // 100)), 1)
+            answer['p{}'.format(pct)] = values[rank - 1]
+        else:
+            answer['p{}'.format(pct)] = None
+    return answer
+
+
+def main():
+    """Print a report from the history database on this worker"""
+    parser = argparse.ArgumentParser(description='Report the p50/p95/p99 duration of tasks, by image')
+    parser.add_argument('--task', action='append', help='Only report on this task, like "create". Repeatable.')
+    parser.add_argument('--hours', type=float, help='Only report on the last this many hours')
+    args = parser.parse_args()
+    since = time.time() - args.hours * 3600 if args.hours else None
+    report = percentiles(tasks=args.task, since=since)
+    print('{:<16}{:<16}{:>8}{:>8}{:>10}{:>10}{:>10}'.format('task', 'image', 'count', 'failed', 'p50', 'p95', 'p99'))
+    for task, images in sorted(report.items()):
+        for image, stats in sorted(images.items()):
+            print('{:<16}{:<16}{:>8}{:>8}{:>10}{:>10}{:>10}'.format(task, image, stats['count'], stats['failed'],
+                                                                    *[_fmt(stats['p{}'.format(x)]) for x in PERCENTILES]))
+
+
+def _fmt(seconds):
+    """Format a duration for the CLI report"""
+    if seconds is None:
+        return '-'
+    return '{:.1f}'.format(seconds)
+
+
+if __name__ == '__main__':
+    main()
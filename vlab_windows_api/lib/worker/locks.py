@@ -0,0 +1,166 @@
+# -*- coding: UTF-8 -*-
+"""
+Leases that serialize changes to the same VM.
+
+Creates, deletes and network changes take a lease on ``<username>/<machine name>``
+before touching vCenter, so two tasks can't both decide a name is free and both
+upload the OVA. Changes to different VMs (and different users) never wait on
+each other. A lease expires after ``VLAB_WINDOWS_LOCK_TTL`` seconds, so a worker
+that dies holding one doesn't lock the VM forever.
+
+``VLAB_WINDOWS_LOCK_BACKEND`` picks where the leases are kept:
+
+- ``store`` (default) - in ``VLAB_WINDOWS_STATE_DB``, so it works across every
+  worker container that shares the file
+- ``memory`` - in the worker process; only safe with a single worker process,
+  like one ``gevent`` worker
+"""
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import deploy, store, transient
+
+
+POLL_INTERVAL = 0.5
+
+
+class LockTimeout(transient.TransientError):
+    """Raised when a VM stays locked longer than ``VLAB_WINDOWS_LOCK_WAIT`` seconds"""
+    pass
+
+
+class StoreLeases(object):
+    """Leases kept in the state database, shared by every worker process"""
+    def acquire(self, name, owner, ttl):
+        """Claim a lease without waiting; see ``store.acquire_lease``"""
+        return store.acquire_lease(name, owner, ttl)
+
+    def release(self, name, owner):
+        """Give back a lease; see ``store.release_lease``"""
+        store.release_lease(name, owner)
+
+
+class MemoryLeases(object):
+    """Leases kept in this process only"""
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, name, owner, ttl):
+        """Claim a lease without waiting
+
+        :Returns: Boolean
+
+        :param name: What the lease is for, like ``alice/win10``
+        :type name: String
+
+        :param owner: A unique ID for whoever is claiming the lease
+        :type owner: String
+
+        :param ttl: How many seconds until the lease expires
+        :type ttl: Integer
+        """
+        now = time.time()
+        with self._lock:
+            held_by, expires = self._leases.get(name, (None, 0))
+            if held_by not in (None, owner) and expires > now:
+                return False
+            self._leases[name] = (owner, now + ttl)
+        return True
+
+    def release(self, name, owner):
+        """Give back a lease
+
+        :Returns: None
+
+        :param name: What the lease is for
+        :type name: String
+
+        :param owner: The ID the lease was claimed with
+        :type owner: String
+        """
+        with self._lock:
+            if self._leases.get(name, (None, 0))[0] == owner:
+                del self._leases[name]
+
+
+BACKENDS = {'store': StoreLeases, 'memory': MemoryLeases}
+backend = BACKENDS[const.VLAB_WINDOWS_LOCK_BACKEND]()
+
+
+@contextmanager
+def hold(username, machine_names, stats=None, should_stop=None, wait=None):
+    """Lock some of a user's VMs for the duration of a block of code
+
+    VMs are locked in sorted order, so two tasks changing the same VMs can't
+    deadlock. Time spent waiting is recorded as the ``lock_wait`` phase.
+
+    :Raises: LockTimeout, vlab_windows_api.lib.worker.deploy.Cancelled
+
+    :param username: The user who owns the VMs
+    :type username: String
+
+    :param machine_names: The names of the VMs to lock
+    :type machine_names: List
+
+    :param stats: Records how long it took to get the locks
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+
+    :param should_stop: Polled while waiting; return True to give up and cancel.
+    :type should_stop: Function
+
+    :param wait: How many seconds to wait for the locks. Defaults to ``VLAB_WINDOWS_LOCK_WAIT``.
+    :type wait: Integer
+    """
+    if wait is None:
+        wait = const.VLAB_WINDOWS_LOCK_WAIT
+    owner = uuid.uuid4().hex
+    names = ['{}/{}'.format(username, x) for x in sorted(set(machine_names))]
+    held = []
+    try:
+        if stats is None:
+            _acquire(names, owner, held, should_stop, wait)
+        else:
+            with stats.phase('lock_wait'):
+                _acquire(names, owner, held, should_stop, wait)
+        yield
+    finally:
+        for name in held:
+            backend.release(name, owner)
+
+
+def _acquire(names, owner, held, should_stop, wait):
+    """Wait for every lease, adding each one to ``held`` once it's claimed
+
+    :Returns: None
+
+    :Raises: LockTimeout, vlab_windows_api.lib.worker.deploy.Cancelled
+
+    :param names: The leases to claim, in the order to claim them
+    :type names: List
+
+    :param owner: A unique ID for whoever is claiming the leases
+    :type owner: String
+
+    :param held: Where to put each lease that's claimed, so it can be released
+    :type held: List
+
+    :param should_stop: Polled while waiting; return True to give up
+    :type should_stop: Function
+
+    :param wait: How many seconds to wait, in total, for every lease
+    :type wait: Integer
+    """
+    deadline = time.time() + wait
+    for name in names:
+        while not backend.acquire(name, owner, const.VLAB_WINDOWS_LOCK_TTL):
+            if should_stop is not None and should_stop():
+                raise deploy.Cancelled('Cancelled while waiting on {}'.format(name))
+            if time.time() >= deadline:
+                error = '{} is busy; another task has been changing it for over {} seconds'
+                raise LockTimeout(error.format(name, wait))
+            time.sleep(POLL_INTERVAL)
+        held.append(name)
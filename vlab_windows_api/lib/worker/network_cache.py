@@ -0,0 +1,87 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process cache that maps network names to their managed object reference.
+
+Resolving a network via ``vCenter.networks`` enumerates every portgroup in the
+datacenter, and every user has their own networks, so that's a big traversal
+for every task. Network names rarely change, so the mapping is cached for
+``VLAB_WINDOWS_NETWORK_CACHE_TTL`` seconds, and refreshed early if a lookup
+misses (i.e. someone just created a new network).
+
+Only the type and moId are cached; pyVmomi objects are bound to the session
+that created them, and every task uses its own session.
+"""
+import time
+import threading
+
+from pyVmomi import vim
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import collector
+
+
+class NetworkCache(object):
+    """Thread safe mapping of network name -> managed object reference
+
+    :param ttl: How many seconds a mapping is trusted before being refreshed
+    :type ttl: Integer
+
+    :param miss_interval: The minimum number of seconds between refreshes caused
+                          by a lookup miss. Prevents a bogus name from triggering
+                          a full refresh on every call.
+    :type miss_interval: Integer
+    """
+    def __init__(self, ttl=const.VLAB_WINDOWS_NETWORK_CACHE_TTL, miss_interval=5):
+        self._ttl = ttl
+        self._miss_interval = miss_interval
+        self._lock = threading.Lock()
+        self._networks = {}
+        self._refreshed = 0
+
+    def lookup(self, vcenter, name):
+        """Find a network by name
+
+        :Returns: vim.Network
+
+        :Raises: KeyError if no such network exists
+
+        :param vcenter: An established connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+        :param name: The name of the network
+        :type name: String
+        """
+        with self._lock:
+            age = time.time() - self._refreshed
+            if age > self._ttl:
+                self._refresh(vcenter)
+            elif name not in self._networks and age > self._miss_interval:
+                self._refresh(vcenter)
+            net_type, mo_id = self._networks[name]
+        return net_type(mo_id, vcenter._conn._stub)
+
+    def invalidate(self, name=None):
+        """Forget a cached network, forcing the next lookup to refresh the mapping.
+
+        :Returns: None
+
+        :param name: The network to forget. If not supplied, the whole cache is dropped.
+        :type name: String
+        """
+        with self._lock:
+            if name is None:
+                self._networks = {}
+            else:
+                self._networks.pop(name, None)
+            self._refreshed = 0
+
+    def _refresh(self, vcenter):
+        """Rebuild the name -> moref mapping; caller must hold the lock"""
+        networks = {}
+        for props in collector.retrieve(vcenter, vim.Network, ['name']):
+            networks[props['name']] = (type(props['obj']), props['obj']._moId)
+        self._networks = networks
+        self._refreshed = time.time()
+
+
+network_cache = NetworkCache()
@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+"""
+Checks that a create can succeed before any of the OVA is uploaded.
+
+Without this, a duplicate name or a full datastore is only discovered once
+``deploy_from_ova`` has streamed gigabytes to ESXi. Every check here is either
+local, cached, or a single bulk call to vCenter, and every problem found is
+reported at once so the user doesn't have to fix them one create at a time.
+"""
+import re
+
+import ujson
+from pyVmomi import vim
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import collector, deploy
+from vlab_windows_api.lib.worker.network_cache import network_cache
+
+
+class PreflightError(ValueError):
+    """Raised when a create cannot succeed
+
+    :param problems: Everything that's wrong with the create
+    :type problems: List
+    """
+    def __init__(self, problems):
+        super(PreflightError, self).__init__('; '.join(problems))
+        self.problems = problems
+
+
+def check(vcenter, username, machine_name, image, ova_path, network):
+    """Make sure a new Windows can be created, and look up what's needed to create it
+
+    :Returns: Dictionary - the ``ova``, ``network``, ``folder`` and ``datastore`` to use
+
+    :Raises: PreflightError
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The name of the user who wants to create a new Windows
+    :type username: String
+
+    :param machine_name: The name of the new instance of Windows
+    :type machine_name: String
+
+    :param image: The image/version of Windows to create
+    :type image: String
+
+    :param ova_path: Where the OVA of the image should be
+    :type ova_path: String
+
+    :param network: The name of the network to connect the new Windows instance up to
+    :type network: String
+    """
+    problems = []
+    found = {'ova': None, 'network': None, 'folder': None, 'datastore': None}
+    if not re.match(deploy.HOSTNAME_REGEX, machine_name):
+        problems.append('Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name))
+    try:
+        found['ova'] = deploy.OvaImage(ova_path)
+    except FileNotFoundError:
+        problems.append('Invalid verison of Windows supplied: {}'.format(image))
+    try:
+        found['network'] = network_cache.lookup(vcenter, network)
+    except KeyError:
+        problems.append('No such network named {}'.format(network))
+    found['folder'] = _user_folder(vcenter, username)
+    if found['folder'] is None:
+        problems.append('No folder found for user {}'.format(username))
+    else:
+        problems += _check_folder(vcenter, found['folder'], machine_name)
+    found['datastore'] = deploy.pick_datastore(vcenter)
+    if found['ova'] is not None:
+        problems += _check_space(found['datastore'], found['ova'].disk_space)
+    if problems:
+        if found['ova'] is not None:
+            found['ova'].close()
+        raise PreflightError(problems)
+    return found
+
+
+def _user_folder(vcenter, username):
+    """Find a user's folder with one call, instead of reading the name of every folder
+
+    :Returns: vim.Folder or None
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The user who owns the folder
+    :type username: String
+    """
+    top_dir = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+    return vcenter.content.searchIndex.FindChild(entity=top_dir, name=username)
+
+
+def _check_folder(vcenter, folder, machine_name):
+    """Look for a VM that already has the name, and if the user is at their VM limit
+
+    :Returns: List - the problems found
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+
+    :param machine_name: The name of the new instance of Windows
+    :type machine_name: String
+    """
+    problems = []
+    windows_count = 0
+    for props in collector.retrieve(vcenter, vim.VirtualMachine, ['name', 'config.annotation'], root=folder):
+        if props.get('name') == machine_name:
+            problems.append('You already have a VM named {}'.format(machine_name))
+        try:
+            meta = ujson.loads(props.get('config.annotation', ''))
+        except (ValueError, TypeError):
+            continue
+        if isinstance(meta, dict) and meta.get('component') == 'Windows':
+            windows_count += 1
+    limit = const.VLAB_WINDOWS_USER_VM_LIMIT
+    if limit and windows_count >= limit:
+        problems.append('You already have {} Windows VMs, the most you can have is {}'.format(windows_count, limit))
+    return problems
+
+
+def _check_space(datastore, needed):
+    """Make sure the datastore has room for the image's disks, plus ``VLAB_WINDOWS_MIN_FREE_GB``
+
+    :Returns: List - the problems found
+
+    :param datastore: Where the new VM will be stored
+    :type datastore: vim.Datastore
+
+    :param needed: The size of the image's disks, in bytes
+    :type needed: Integer
+    """
+    needed += const.VLAB_WINDOWS_MIN_FREE_GB * 1024 ** 3
+    # one call for the whole summary, instead of one per property
+    summary = datastore.summary
+    if summary.freeSpace < needed:
+        return ['Datastore {} only has {:.1f} GB free, {:.1f} GB needed'.format(summary.name,
+                                                                                summary.freeSpace / 1024 ** 3,
+                                                                                needed / 1024 ** 3)]
+    return []
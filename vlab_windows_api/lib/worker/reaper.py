@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+"""
+Finds Windows VMs that are only taking up space, and destroys them.
+
+A VM is stale when any of these (each disabled when set to zero) apply:
+
+- ``VLAB_WINDOWS_REAP_MAX_AGE_DAYS`` - it was created more than this many days ago
+- ``VLAB_WINDOWS_REAP_IDLE_DAYS`` - it has been powered off for this many days
+- ``VLAB_WINDOWS_REAP_ORPHAN_HOURS`` - it's a Windows VM without any meta data
+  (i.e. a failed create) that's older than this many hours
+
+vSphere doesn't record when a VM was powered off, so the reaper remembers the
+first scan that saw each VM off. Every scan is one PropertyCollector traversal
+of ``INF_VCENTER_TOP_LVL_DIR``.
+"""
+import time
+
+import ujson
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import collector, locks, store
+
+
+DAY = 86400
+HOUR = 3600
+VM_PROPERTIES = ['name', 'parent', 'config.annotation', 'config.guestId', 'config.createDate',
+                 'runtime.powerState', 'summary.storage.committed']
+
+
+def find_stale(vcenter, now=None):
+    """Scan every user's VMs, and pick out the stale ones
+
+    :Returns: List of Dictionaries - the user, name, reason, size and VM object
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param now: The time to measure ages from. Defaults to the current time.
+    :type now: Float
+    """
+    if now is None:
+        now = time.time()
+    folders = {}
+    vms = []
+    top_dir = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+    specs = {vim.Folder: ['name'], vim.VirtualMachine: VM_PROPERTIES}
+    for props in collector.retrieve_many(vcenter, specs, root=top_dir):
+        if isinstance(props['obj'], vim.Folder):
+            folders[props['obj']._moId] = props['name']
+        else:
+            vms.append(props)
+    idle_since = store.track_idle([x['obj']._moId for x in vms if x.get('runtime.powerState') == 'poweredOff'], now)
+    creating = store.in_progress_creates()
+    stale = []
+    for props in vms:
+        parent = props.get('parent')
+        user = folders.get(parent._moId) if parent else None
+        if user is None or (user, props['name']) in creating:
+            # not in a user's folder (or in a vApp), or still being created
+            continue
+        reason = _get_reason(props, idle_since.get(props['obj']._moId), now)
+        if reason:
+            stale.append({'user': user,
+                          'name': props['name'],
+                          'reason': reason,
+                          'size': props.get('summary.storage.committed', 0),
+                          'obj': props['obj']})
+    return stale
+
+
+def _get_reason(props, idle_since, now):
+    """Decide if a VM is stale
+
+    :Returns: String or None - why the VM is stale
+
+    :param props: The properties of the VM
+    :type props: Dictionary
+
+    :param idle_since: When the VM was first seen powered off, if it is
+    :type idle_since: Float
+
+    :param now: The time to measure ages from
+    :type now: Float
+    """
+    try:
+        meta = ujson.loads(props.get('config.annotation', ''))
+    except (ValueError, TypeError):
+        meta = None
+    if not isinstance(meta, dict):
+        # Other services share the user folders, so only claim VMs that look like ours
+        is_windows = props.get('config.guestId', '').lower().startswith('win')
+        created = props.get('config.createDate')
+        if const.VLAB_WINDOWS_REAP_ORPHAN_HOURS and is_windows and created:
+            if now - created.timestamp() > const.VLAB_WINDOWS_REAP_ORPHAN_HOURS * HOUR:
+                return 'orphan'
+        return None
+    if meta.get('component') != 'Windows':
+        return None
+    if const.VLAB_WINDOWS_REAP_MAX_AGE_DAYS and now - meta.get('created', now) > const.VLAB_WINDOWS_REAP_MAX_AGE_DAYS * DAY:
+        return 'age'
+    if const.VLAB_WINDOWS_REAP_IDLE_DAYS and idle_since and now - idle_since > const.VLAB_WINDOWS_REAP_IDLE_DAYS * DAY:
+        return 'idle'
+    return None
+
+
+def reap(vcenter, logger, dry_run=True):
+    """Destroy the stale VMs, a batch at a time
+
+    :Returns: Dictionary
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param dry_run: Set to False to actually destroy the VMs
+    :type dry_run: Boolean
+    """
+    stale = find_stale(vcenter)
+    report = {'dry_run': dry_run,
+              'stale': [{k: v for k, v in x.items() if k != 'obj'} for x in stale],
+              'reaped': [],
+              'skipped': [],
+              'failed': {}}
+    if dry_run:
+        logger.info('Found {} stale VMs; dry run, so none destroyed'.format(len(stale)))
+        return report
+    batch_size = const.VLAB_WINDOWS_REAP_BATCH
+    for idx in range(0, len(stale), batch_size):
+        if idx:
+            # Don't flood vCenter (or the datastores) with deletes
+            time.sleep(const.VLAB_WINDOWS_REAP_BATCH_DELAY)
+        for vm in stale[idx:idx + batch_size]:
+            label = '{}/{}'.format(vm['user'], vm['name'])
+            try:
+                # Don't wait; a VM another task is changing isn't stale
+                with locks.hold(vm['user'], [vm['name']], wait=0):
+                    logger.info('Reaping {} VM {}'.format(vm['reason'], label))
+                    virtual_machine.power(vm['obj'], state='off')
+                    consume_task(vm['obj'].Destroy_Task())
+            except locks.LockTimeout:
+                logger.info('Skipping {}; another task is changing it'.format(label))
+                report['skipped'].append(label)
+                continue
+            except (RuntimeError, vmodl.MethodFault) as doh:
+                logger.error('Failed to reap {}: {}'.format(label, doh))
+                report['failed'][label] = '{}'.format(doh)
+                continue
+            report['reaped'].append(label)
+            store.incr_counters({'reaper.vms': 1,
+                                 'reaper.bytes': vm['size'],
+                                 'reaper.{}'.format(vm['reason']): 1})
+    return report
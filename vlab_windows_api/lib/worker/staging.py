@@ -0,0 +1,409 @@
+# -*- coding: UTF-8 -*-
+"""
+Keeps a copy of each Windows image on the datastores, so new VMs can be made
+with a datastore-side clone instead of uploading the whole OVA again.
+
+The first create of an image on a datastore imports the OVA as a powered-off
+"stage" VM in ``VLAB_WINDOWS_STAGING_DIR``; every create after that clones the
+stage. Stages are keyed by the OVA checksum, so replacing an image on disk
+results in a new stage. When the stages use more than
+``VLAB_WINDOWS_STAGING_BUDGET_GB`` the least recently used ones are destroyed.
+
+Stages are shared by every user, so they're imported onto
+``VLAB_WINDOWS_STAGING_NETWORK`` (if set) and their NICs are left unplugged;
+each clone is moved to its owner's network.
+"""
+import re
+import time
+
+import ujson
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import collector, deploy
+from vlab_windows_api.lib.worker.network_cache import network_cache
+
+
+STAGE_COMPONENT = 'WindowsStage'
+CLONE_TIMEOUT = 1800
+
+
+class StageUnavailable(RuntimeError):
+    """Raised when the staged image can't be used, and no VM was made for the user.
+    It's always safe to import the OVA instead."""
+    pass
+
+
+def clone_from_stage(vcenter, ova, image, network_map, username, machine_name, logger, power_on=True,
+                     folder=None, datastore=None, should_stop=None):
+    """Create a new VM by cloning the staged copy of an image, staging it first if needed.
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: StageUnavailable, RuntimeError, vmodl.MethodFault, vlab_windows_api.lib.worker.deploy.Cancelled
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param ova: The OVA of the image
+    :type ova: vlab_windows_api.lib.worker.deploy.OvaImage
+
+    :param image: The image/version of Windows
+    :type image: String
+
+    :param network_map: The network to connect the new VM to
+    :type network_map: vim.OvfManager.NetworkMapping
+
+    :param username: The name of the user deploying a new VM
+    :type username: String
+
+    :param machine_name: The unique name to give the new VM
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param power_on: Set to True to have the VM powered on after deployment
+    :type power_on: Boolean
+
+    :param folder: Where to create the VM. Defaults to the user's folder.
+    :type folder: vim.Folder
+
+    :param datastore: Where to store the VM. Defaults to a random datastore.
+    :type datastore: vim.Datastore
+
+    :param should_stop: Polled while the clone runs; return True to cancel it
+    :type should_stop: Function
+    """
+    if not re.match(deploy.HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+    if datastore is None:
+        datastore = deploy.pick_datastore(vcenter)
+    if folder is None:
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    try:
+        staging_folder = get_staging_folder(vcenter)
+        stage_name = get_stage_name(image, ova.checksum, datastore)
+        the_stage = find_stage(vcenter, staging_folder, stage_name)
+        if the_stage is None:
+            logger.info('Staging image {} on datastore {}'.format(image, datastore.name))
+            the_stage = _create_stage(vcenter, ova, image, network_map, stage_name,
+                                      staging_folder, datastore, logger)
+            evict(vcenter, staging_folder, keep=stage_name, logger=logger)
+    except (RuntimeError, vmodl.MethodFault) as doh:
+        # i.e. another worker is staging the same image right now
+        raise StageUnavailable('Unable to stage image {}: {}'.format(image, doh))
+    the_vm = _clone(vcenter, the_stage, folder, machine_name, datastore, logger, should_stop)
+    try:
+        virtual_machine.change_network(the_vm, network_map.network)
+        if power_on:
+            logger.debug("Powering on {}'s new VM {}".format(username, machine_name))
+            virtual_machine.power(the_vm, state='on')
+    except Exception:
+        # otherwise the clone is left in the user's folder, holding the name
+        _destroy(the_vm, logger)
+        raise
+    _touch(the_stage, logger)
+    return the_vm
+
+
+def _clone(vcenter, the_stage, folder, machine_name, datastore, logger, should_stop=None):
+    """Clone a stage into a new VM
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: StageUnavailable when no VM was made, RuntimeError when one might have been,
+             vlab_windows_api.lib.worker.deploy.Cancelled when the create was cancelled
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_stage: The staged image to clone
+    :type the_stage: vim.VirtualMachine
+
+    :param folder: Where to create the VM
+    :type folder: vim.Folder
+
+    :param machine_name: The unique name to give the new VM
+    :type machine_name: String
+
+    :param datastore: Where to store the VM
+    :type datastore: vim.Datastore
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param should_stop: Polled while the clone runs; return True to cancel it
+    :type should_stop: Function
+    """
+    relocate = vim.vm.RelocateSpec(pool=vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL],
+                                   datastore=datastore)
+    spec = vim.vm.CloneSpec(location=relocate, powerOn=False, template=False)
+    logger.debug('Cloning {} to {}'.format(the_stage.name, machine_name))
+    try:
+        task = the_stage.CloneVM_Task(folder=folder, name=machine_name, spec=spec)
+    except vmodl.MethodFault as doh:
+        raise StageUnavailable('Unable to clone {}: {}'.format(the_stage.name, doh))
+    cancelled = None
+    try:
+        return _wait_for_clone(task, should_stop)
+    except deploy.Cancelled as doh:
+        cancelled = error = doh
+    except RuntimeError as doh:
+        error = doh
+    if task.info.completeTime is None:
+        # timed out or cancelled; stop the clone so it can't finish after the OVA import starts
+        try:
+            task.CancelTask()
+        except vmodl.MethodFault:
+            pass
+    the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+    if cancelled is not None:
+        if the_vm is not None:
+            _destroy(the_vm, logger)
+        raise cancelled
+    if the_vm is None:
+        raise StageUnavailable('Unable to clone {}: {}'.format(the_stage.name, error))
+    _destroy(the_vm, logger)
+    raise RuntimeError('Clone of {} failed: {}'.format(the_stage.name, error))
+
+
+def _wait_for_clone(task, should_stop):
+    """Like ``consume_task``, but stops waiting as soon as the create is cancelled
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: RuntimeError, vlab_windows_api.lib.worker.deploy.Cancelled
+
+    :param task: The clone task
+    :type task: vim.Task
+
+    :param should_stop: Return True to cancel the clone
+    :type should_stop: Function
+    """
+    for _ in range(CLONE_TIMEOUT):
+        if task.info.completeTime:
+            break
+        if should_stop is not None and should_stop():
+            raise deploy.Cancelled('Create cancelled while cloning')
+        time.sleep(1)
+    else:
+        raise RuntimeError('Timeout of {} seconds exceeded for task {}'.format(CLONE_TIMEOUT, task))
+    if task.info.error:
+        raise RuntimeError(task.info.error.msg)
+    return task.info.result
+
+
+def _destroy(the_vm, logger):
+    """Best effort removal of a clone that failed partway through
+
+    :Returns: None
+
+    :param the_vm: The clone to remove
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        virtual_machine.power(the_vm, state='off')
+        deploy.destroy_partial(the_vm)
+    except Exception as doh:
+        # the reaper picks up orphans
+        logger.warning('Unable to remove failed clone: {}'.format(doh))
+
+
+def get_staging_folder(vcenter):
+    """Obtain the folder that holds the staged images, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+    """
+    try:
+        return vcenter.get_vm_folder(const.VLAB_WINDOWS_STAGING_DIR)
+    except FileNotFoundError:
+        vcenter.create_vm_folder(const.VLAB_WINDOWS_STAGING_DIR)
+        return vcenter.get_vm_folder(const.VLAB_WINDOWS_STAGING_DIR)
+
+
+def get_stage_name(image, checksum, datastore):
+    """The name of the VM that holds an image on a given datastore
+
+    :Returns: String
+
+    :param image: The image/version of Windows
+    :type image: String
+
+    :param checksum: The checksum of the image's OVA
+    :type checksum: String
+
+    :param datastore: The datastore the stage lives on
+    :type datastore: vim.Datastore
+    """
+    return 'Windows-{}-{}-{}'.format(image, checksum[:12], datastore._moId)
+
+
+def find_stage(vcenter, staging_folder, stage_name):
+    """Locate a staged image. Stages that are still being imported are ignored.
+
+    :Returns: vim.VirtualMachine or None
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param staging_folder: The folder that holds the stages
+    :type staging_folder: vim.Folder
+
+    :param stage_name: The name of the stage to find
+    :type stage_name: String
+    """
+    for stage in list_stages(vcenter, staging_folder):
+        if stage['name'] == stage_name and stage['meta'].get('component') == STAGE_COMPONENT:
+            return stage['obj']
+    return None
+
+
+def list_stages(vcenter, staging_folder):
+    """Obtain the name, meta data and size of every VM in the staging folder
+
+    :Returns: List of Dictionaries
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param staging_folder: The folder that holds the stages
+    :type staging_folder: vim.Folder
+    """
+    stages = []
+    path_set = ['name', 'config.annotation', 'summary.storage.committed']
+    for props in collector.retrieve(vcenter, vim.VirtualMachine, path_set, root=staging_folder):
+        try:
+            meta = ujson.loads(props.get('config.annotation', ''))
+        except (ValueError, TypeError):
+            meta = {}
+        stages.append({'name': props['name'],
+                       'obj': props['obj'],
+                       'meta': meta,
+                       'size': props.get('summary.storage.committed', 0)})
+    return stages
+
+
+def evict(vcenter, staging_folder, keep, logger):
+    """Destroy the least recently used stages until they fit within the budget
+
+    :Returns: List - the names of the stages destroyed
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param staging_folder: The folder that holds the stages
+    :type staging_folder: vim.Folder
+
+    :param keep: The name of a stage that must not be evicted
+    :type keep: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    budget = const.VLAB_WINDOWS_STAGING_BUDGET_GB * 1024 ** 3
+    stages = list_stages(vcenter, staging_folder)
+    total = sum(x['size'] for x in stages)
+    # Stages without meta data might still be importing, so leave those alone
+    candidates = [x for x in stages if x['name'] != keep and x['meta'].get('component') == STAGE_COMPONENT]
+    candidates.sort(key=lambda x: x['meta']['last_used'])
+    evicted = []
+    for stage in candidates:
+        if total <= budget:
+            break
+        logger.info('Evicting staged image {}'.format(stage['name']))
+        try:
+            consume_task(stage['obj'].Destroy_Task())
+        except RuntimeError as doh:
+            logger.error('Failed to evict {}: {}'.format(stage['name'], doh))
+            continue
+        total -= stage['size']
+        evicted.append(stage['name'])
+    return evicted
+
+
+def _create_stage(vcenter, ova, image, network_map, stage_name, staging_folder, datastore, logger):
+    """Import an OVA as a stage, off of the network of the user who happened to stage it"""
+    the_stage = deploy.deploy_from_ova(vcenter, ova, [_stage_network_map(vcenter, network_map)], None,
+                                       stage_name, logger, power_on=False, folder=staging_folder,
+                                       datastore=datastore)
+    try:
+        _disconnect(the_stage)
+    except Exception:
+        # without meta data it'd never be used or evicted, just take up space
+        _destroy(the_stage, logger)
+        raise
+    now = time.time()
+    meta_data = {'component': STAGE_COMPONENT,
+                 'created': now,
+                 'version': image,
+                 'configured': False,
+                 'generation': 1,
+                 'checksum': ova.checksum,
+                 'last_used': now,
+                }
+    virtual_machine.set_meta(the_stage, meta_data)
+    return the_stage
+
+
+def _stage_network_map(vcenter, network_map):
+    """Map the OVA's network to ``VLAB_WINDOWS_STAGING_NETWORK``, if it's set
+
+    :Returns: vim.OvfManager.NetworkMapping
+
+    :Raises: RuntimeError if the staging network does not exist
+
+    :param vcenter: The vCenter object
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param network_map: The mapping for the user's network
+    :type network_map: vim.OvfManager.NetworkMapping
+    """
+    if not const.VLAB_WINDOWS_STAGING_NETWORK:
+        return network_map
+    try:
+        network = network_cache.lookup(vcenter, const.VLAB_WINDOWS_STAGING_NETWORK)
+    except KeyError:
+        raise RuntimeError('No such network named {}'.format(const.VLAB_WINDOWS_STAGING_NETWORK))
+    neutral = vim.OvfManager.NetworkMapping()
+    neutral.name = network_map.name
+    neutral.network = network
+    return neutral
+
+
+def _disconnect(the_stage):
+    """Unplug every NIC of a stage, so it's never on anyone's network
+
+    :Returns: None
+
+    :param the_stage: The newly imported stage
+    :type the_stage: vim.VirtualMachine
+    """
+    changes = []
+    for device in the_stage.config.hardware.device:
+        if isinstance(device, vim.vm.device.VirtualEthernetCard):
+            device.connectable.startConnected = False
+            device.connectable.connected = False
+            changes.append(vim.vm.device.VirtualDeviceSpec(operation=vim.vm.device.VirtualDeviceSpec.Operation.edit,
+                                                           device=device))
+    if changes:
+        consume_task(the_stage.ReconfigVM_Task(vim.vm.ConfigSpec(deviceChange=changes)))
+
+
+def _touch(the_stage, logger):
+    """Record that a stage was just used, for LRU eviction. It's only bookkeeping,
+    so failures (i.e. another create is cloning the stage) are logged and ignored."""
+    try:
+        meta_data = ujson.loads(the_stage.config.annotation)
+        meta_data['last_used'] = time.time()
+        virtual_machine.set_meta(the_stage, meta_data)
+    except (RuntimeError, ValueError, TypeError, vmodl.MethodFault) as doh:
+        logger.warning('Unable to update last use of stage {}: {}'.format(the_stage.name, doh))
@@ -0,0 +1,352 @@
+# -*- coding: UTF-8 -*-
+"""
+State the worker processes need to share, kept in a small SQLite database at
+``VLAB_WINDOWS_STATE_DB``.
+
+Every function opens its own connection, so it's safe to call from any thread
+or greenlet; SQLite handles the locking between processes. Under the ``gevent``
+pool they run on a native thread, so waiting on that lock doesn't stall other tasks.
+"""
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+
+from vlab_windows_api.lib import const
+from vlab_windows_api.lib.worker import blocking
+
+
+# A slot held longer than this was leaked by a worker that died mid-task; the
+# margin covers the time between claiming the slot and the time limit starting
+SLOT_TIMEOUT = const.VLAB_WINDOWS_CREATE_TIME_LIMIT + 300
+LOCK_WAIT = 30
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS create_slots (
+    task_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    acquired REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS create_slots_username ON create_slots (username);
+CREATE TABLE IF NOT EXISTS creates (
+    task_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    machine_name TEXT NOT NULL,
+    registered REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cancels (
+    task_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    requested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idle (
+    mo_id TEXT PRIMARY KEY,
+    since REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue_waits (
+    username TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    max REAL NOT NULL
+);
+"""
+
+
+@contextmanager
+def _connect():
+    """Open the database, creating the tables if needed, and commit on success"""
+    directory = os.path.dirname(const.VLAB_WINDOWS_STATE_DB)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(const.VLAB_WINDOWS_STATE_DB, timeout=LOCK_WAIT, isolation_level=None)
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+
+@blocking.offload
+def acquire_slot(username, task_id, limit):
+    """Claim one of a user's slots for creating a VM
+
+    :Returns: Boolean - False if the user already has ``limit`` creates running
+
+    :param username: The user creating a VM
+    :type username: String
+
+    :param task_id: The ID of the task that's creating the VM
+    :type task_id: String
+
+    :param limit: How many creates a user can run at once. Zero means no limit.
+    :type limit: Integer
+    """
+    with _connect() as conn:
+        conn.execute('DELETE FROM create_slots WHERE acquired < ?', (time.time() - SLOT_TIMEOUT,))
+        if limit:
+            held = conn.execute('SELECT COUNT(*) FROM create_slots WHERE username = ? AND task_id != ?',
+                                (username, task_id)).fetchone()[0]
+            if held >= limit:
+                return False
+        conn.execute('INSERT OR REPLACE INTO create_slots (task_id, username, acquired) VALUES (?, ?, ?)',
+                     (task_id, username, time.time()))
+    return True
+
+
+@blocking.offload
+def release_slot(task_id):
+    """Give back the slot a task claimed with ``acquire_slot``
+
+    :Returns: None
+
+    :param task_id: The ID of the task that claimed the slot
+    :type task_id: String
+    """
+    with _connect() as conn:
+        conn.execute('DELETE FROM create_slots WHERE task_id = ?', (task_id,))
+
+
+@blocking.offload
+def register_create(task_id, username, machine_name):
+    """Record that a create is in progress, so it can be found and cancelled by name
+
+    :Returns: None
+
+    :param task_id: The ID of the task that's creating the VM
+    :type task_id: String
+
+    :param username: The user creating a VM
+    :type username: String
+
+    :param machine_name: The name of the new VM
+    :type machine_name: String
+    """
+    with _connect() as conn:
+        cutoff = time.time() - SLOT_TIMEOUT
+        conn.execute('DELETE FROM creates WHERE registered < ?', (cutoff,))
+        conn.execute('DELETE FROM cancels WHERE requested < ?', (cutoff,))
+        conn.execute('INSERT OR IGNORE INTO creates (task_id, username, machine_name, registered) VALUES (?, ?, ?, ?)',
+                     (task_id, username, machine_name, time.time()))
+
+
+@blocking.offload
+def finish_create(task_id):
+    """Forget about a create, and any request to cancel it
+
+    :Returns: None
+
+    :param task_id: The ID of the task that was creating the VM
+    :type task_id: String
+    """
+    with _connect() as conn:
+        conn.execute('DELETE FROM creates WHERE task_id = ?', (task_id,))
+        conn.execute('DELETE FROM cancels WHERE task_id = ?', (task_id,))
+
+
+@blocking.offload
+def find_create(username, machine_name):
+    """Locate an in-progress create of a user's VM
+
+    :Returns: String or None - the ID of the task creating the VM
+
+    :param username: The user creating the VM
+    :type username: String
+
+    :param machine_name: The name of the new VM
+    :type machine_name: String
+    """
+    with _connect() as conn:
+        row = conn.execute('SELECT task_id FROM creates WHERE username = ? AND machine_name = ?',
+                           (username, machine_name)).fetchone()
+    if row:
+        return row[0]
+    return None
+
+
+@blocking.offload
+def cancel_create(username, task_id):
+    """Ask a create to stop. The request is kept even if the task hasn't started
+    yet, and only ever applies to a create made by the same user.
+
+    :Returns: Boolean - True if the create is in progress right now
+
+    :param username: The user who made the create
+    :type username: String
+
+    :param task_id: The ID of the create task
+    :type task_id: String
+    """
+    with _connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO cancels (task_id, username, requested) VALUES (?, ?, ?)',
+                     (task_id, username, time.time()))
+        row = conn.execute('SELECT 1 FROM creates WHERE task_id = ? AND username = ?',
+                           (task_id, username)).fetchone()
+    return row is not None
+
+
+@blocking.offload
+def is_cancelled(task_id, username):
+    """Check if a user asked for their create to stop
+
+    :Returns: Boolean
+
+    :param task_id: The ID of the create task
+    :type task_id: String
+
+    :param username: The user who made the create
+    :type username: String
+    """
+    with _connect() as conn:
+        row = conn.execute('SELECT 1 FROM cancels WHERE task_id = ? AND username = ?',
+                           (task_id, username)).fetchone()
+    return row is not None
+
+
+@blocking.offload
+def acquire_lease(name, owner, ttl):
+    """Claim a lease, unless someone else holds it. Claiming a lease you already
+    hold extends it.
+
+    :Returns: Boolean
+
+    :param name: What the lease is for, like ``alice/win10``
+    :type name: String
+
+    :param owner: A unique ID for whoever is claiming the lease
+    :type owner: String
+
+    :param ttl: How many seconds until the lease expires, in case the owner dies holding it
+    :type ttl: Integer
+    """
+    now = time.time()
+    with _connect() as conn:
+        conn.execute('DELETE FROM leases WHERE name = ? AND expires < ?', (name, now))
+        row = conn.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()
+        if row and row[0] != owner:
+            return False
+        conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)',
+                     (name, owner, now + ttl))
+    return True
+
+
+@blocking.offload
+def release_lease(name, owner):
+    """Give back a lease claimed with ``acquire_lease``
+
+    :Returns: None
+
+    :param name: What the lease is for
+    :type name: String
+
+    :param owner: The ID the lease was claimed with
+    :type owner: String
+    """
+    with _connect() as conn:
+        conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+
+@blocking.offload
+def in_progress_creates():
+    """Obtain every create that's in progress
+
+    :Returns: Set of Tuples - (username, machine_name)
+    """
+    with _connect() as conn:
+        return set(conn.execute('SELECT username, machine_name FROM creates'))
+
+
+@blocking.offload
+def track_idle(powered_off, now):
+    """Remember when each VM was first seen powered off
+
+    :Returns: Dictionary - VM moId -> when it was first seen powered off
+
+    :param powered_off: The moIds of every VM that's powered off right now
+    :type powered_off: List
+
+    :param now: The current time
+    :type now: Float
+    """
+    with _connect() as conn:
+        conn.execute('CREATE TEMP TABLE seen (mo_id TEXT PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO seen (mo_id) VALUES (?)', ((x,) for x in powered_off))
+        # VMs that were powered on, or deleted, since the last scan
+        conn.execute('DELETE FROM idle WHERE mo_id NOT IN (SELECT mo_id FROM seen)')
+        conn.execute('INSERT OR IGNORE INTO idle (mo_id, since) SELECT mo_id, ? FROM seen', (now,))
+        idle = dict(conn.execute('SELECT mo_id, since FROM idle'))
+        conn.execute('DROP TABLE seen')
+    return idle
+
+
+@blocking.offload
+def incr_counters(amounts):
+    """Add to some counters
+
+    :Returns: None
+
+    :param amounts: The name of the counter -> how much to add to it
+    :type amounts: Dictionary
+    """
+    with _connect() as conn:
+        # not an upsert; that needs SQLite 3.24, newer than some supported Pythons ship with
+        conn.executemany('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', [(x,) for x in amounts])
+        conn.executemany('UPDATE counters SET value = value + ? WHERE name = ?',
+                         [(y, x) for x, y in amounts.items()])
+
+
+@blocking.offload
+def counters():
+    """Obtain the value of every counter
+
+    :Returns: Dictionary
+    """
+    with _connect() as conn:
+        return dict(conn.execute('SELECT name, value FROM counters'))
+
+
+@blocking.offload
+def record_wait(username, seconds):
+    """Add to the running totals of how long a user's creates waited to start
+
+    :Returns: None
+
+    :param username: The user who created a VM
+    :type username: String
+
+    :param seconds: How long the create waited before it started
+    :type seconds: Float
+    """
+    with _connect() as conn:
+        # not an upsert; that needs SQLite 3.24, newer than some supported Pythons ship with
+        conn.execute('INSERT OR IGNORE INTO queue_waits (username, count, total, max) VALUES (?, 0, 0, 0)',
+                     (username,))
+        conn.execute('UPDATE queue_waits SET count = count + 1, total = total + ?, max = MAX(max, ?) WHERE username = ?',
+                     (seconds, seconds, username))
+
+
+@blocking.offload
+def wait_stats():
+    """Obtain how long each user's creates have waited to start
+
+    :Returns: Dictionary - username -> {'count': Integer, 'mean': Float, 'max': Float}
+    """
+    stats = {}
+    with _connect() as conn:
+        for username, count, total, longest in conn.execute('SELECT username, count, total, max FROM queue_waits'):
+            stats[username] = {'count': count, 'mean': total / count, 'max': longest}
+    return stats
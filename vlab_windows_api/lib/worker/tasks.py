@@ -2,17 +2,35 @@
 """
 Entry point logic for available backend worker tasks
 """
+import time
+import inspect
+import threading
+
 from celery import Celery
+from celery.signals import task_prerun, task_postrun, worker_ready
 from vlab_api_common import get_task_logger
 
-from vlab_windows_api.lib import const
-from vlab_windows_api.lib.worker import vmware
+from vlab_windows_api.lib import const, reports
+from vlab_windows_api.lib.worker import deploy, history, locks, preflight, store, transient, vmware
 
 app = Celery('windows', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+# With the gevent pool, concurrency is in the hundreds; the default multiplier
+# of 4 would have one worker hoard a huge backlog of tasks other workers could run.
+app.conf.worker_prefetch_multiplier = 1
+if const.VLAB_WINDOWS_REAP_INTERVAL:
+    # Needs ``celery beat`` running; see the README
+    app.conf.beat_schedule = {'reap-stale-windows': {'task': 'windows.reap',
+                                                     'schedule': const.VLAB_WINDOWS_REAP_INTERVAL,
+                                                     'args': ['reaper'],
+                                                     # nothing ever reads the result of a scheduled reap
+                                                     'options': {'ignore_result': True}}}
+# Polled constantly, so it'd drown out everything else in the history
+NOT_RECORDED = ('windows.health',)
+_started = {}
 
 
 @app.task(name='windows.show', bind=True)
-def show(self, username, txn_id):
+def show(self, username, txn_id, fields=None, limit=None, cursor=None, name=None):
     """Obtain basic information about Windows
 
     :Returns: Dictionary
@@ -22,25 +40,46 @@ def show(self, username, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param fields: The info to return for each VM. Defaults to everything.
+    :type fields: List
+
+    :param limit: The most VMs to return
+    :type limit: Integer
+
+    :param cursor: The ``next_cursor`` param from a prior page of results
+    :type cursor: String
+
+    :param name: Only return VMs whose name matches this (shell-style) pattern
+    :type name: String
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_windows(username)
+        info, next_cursor = vmware.show_windows(username, fields=fields, limit=limit, cursor=cursor, name=name)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
         resp['content'] = info
+        if next_cursor:
+            resp['params']['next_cursor'] = next_cursor
     return resp
 
 
-@app.task(name='windows.create', bind=True)
-def create(self, username, machine_name, image, network, txn_id):
+@app.task(name='windows.create', bind=True, max_retries=None, time_limit=const.VLAB_WINDOWS_CREATE_TIME_LIMIT)
+def create(self, username, machine_name, image, network, txn_id, queued_at=None, attempt=0):
     """Deploy a new instance of Windows
 
+    A user can only have ``VLAB_WINDOWS_USER_CREATE_LIMIT`` creates running at
+    once; any more go to the back of the queue, so one user's big batch
+    doesn't starve everyone else.
+
+    A create that fails for a transient reason (i.e. vCenter restarted) is
+    retried up to ``VLAB_WINDOWS_RETRIES`` times, backing off exponentially.
+
     :Returns: Dictionary
 
     :param username: The name of the user who wants to create a new Windows
@@ -57,15 +96,76 @@ def create(self, username, machine_name, image, network, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param queued_at: When the API sent the task, as a Unix timestamp
+    :type queued_at: Float
+
+    :param attempt: How many times the create has already failed for a transient reason
+    :type attempt: Integer
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
-    logger.info('Task starting')
+    task_id = self.request.id
+    store.register_create(task_id, username, machine_name)
+    if store.is_cancelled(task_id, username):
+        logger.info('Task cancelled before it started')
+        store.finish_create(task_id)
+        resp['error'] = 'Create of {} cancelled'.format(machine_name)
+        resp['params']['state'] = 'cancelled'
+        return resp
+    if not store.acquire_slot(username, task_id, const.VLAB_WINDOWS_USER_CREATE_LIMIT):
+        waited = self.request.retries * const.VLAB_WINDOWS_FAIRSHARE_DELAY
+        if waited >= const.VLAB_WINDOWS_FAIRSHARE_MAX_WAIT:
+            logger.error('Gave up waiting for a create slot after {} seconds'.format(waited))
+            store.finish_create(task_id)
+            resp['error'] = 'Gave up after waiting {} seconds for one of your other creates to finish'.format(waited)
+            return resp
+        logger.debug('User {} is at their create limit, requeuing'.format(username))
+        raise self.retry(countdown=const.VLAB_WINDOWS_FAIRSHARE_DELAY)
     try:
-        resp['content'] = vmware.create_windows(username, machine_name, image, network, logger)
-    except ValueError as doh:
-        logger.error('Task failed: {}'.format(doh))
-        resp['error'] = '{}'.format(doh)
+        if queued_at:
+            queue_wait = max(time.time() - queued_at, 0)
+            store.record_wait(username, queue_wait)
+            resp['params']['queue_wait'] = round(queue_wait, 3)
+            logger.info('Task starting, waited {:.1f} seconds in queue'.format(queue_wait))
+        else:
+            logger.info('Task starting')
+        stats = history.Stats()
+        try:
+            resp['content'] = vmware.create_windows(username, machine_name, image, network, logger,
+                                                    should_stop=lambda: store.is_cancelled(task_id, username),
+                                                    stats=stats)
+        except preflight.PreflightError as doh:
+            logger.error('Task failed preflight: {}'.format(doh))
+            resp['error'] = '{}'.format(doh)
+            resp['params']['problems'] = doh.problems
+        except ValueError as doh:
+            logger.error('Task failed: {}'.format(doh))
+            resp['error'] = '{}'.format(doh)
+        except deploy.Cancelled as doh:
+            logger.info('Task cancelled')
+            resp['error'] = '{}'.format(doh)
+            resp['params']['state'] = 'cancelled'
+        except Exception as doh:
+            if not transient.is_transient(doh):
+                raise
+            if attempt < const.VLAB_WINDOWS_RETRIES:
+                delay = transient.backoff(attempt)
+                logger.warning('Task hit a transient error, retrying in {:.0f} seconds: {}'.format(delay, doh))
+                # a new kwarg, since fair share requeues also count toward self.request.retries
+                kwargs = dict(self.request.kwargs or {}, attempt=attempt + 1)
+                raise self.retry(countdown=delay, kwargs=kwargs)
+            logger.error('Task failed after {} attempts: {}'.format(attempt + 1, doh))
+            resp['error'] = 'Failed after {} attempts: {}'.format(attempt + 1, doh)
+        resp['params'].update(stats.params())
+        if stats.info.get('read_seconds'):
+            store.incr_counters({'ova.bytes_read': stats.info['read_bytes'],
+                                 'ova.read_seconds': stats.info['read_seconds']})
+        if attempt:
+            resp['params']['attempts'] = attempt + 1
+    finally:
+        store.release_slot(task_id)
+        store.finish_create(task_id)
     logger.info('Task complete')
     return resp
 
@@ -82,6 +182,96 @@ def delete(self, username, machine_name, txn_id):
     :param machine_name: The name of the instance of Windows
     :type machine_name: String
 
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    stats = history.Stats()
+    try:
+        cancelled = vmware.delete_windows(username, machine_name, logger, stats=stats)
+    except (ValueError, locks.LockTimeout) as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        if cancelled:
+            resp['params']['cancelled'] = cancelled
+        logger.info('Task complete')
+    resp['params'].update(stats.params())
+    return resp
+
+
+@app.task(name='windows.cancel', bind=True)
+def cancel(self, username, create_task_id, txn_id):
+    """Stop an in-progress create of Windows, and destroy whatever it made so far
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who made the create
+    :type username: String
+
+    :param create_task_id: The ID of the ``windows.create`` task to stop
+    :type create_task_id: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    in_progress = store.cancel_create(username, create_task_id)
+    # A create that's still queued sees the request once it starts
+    resp['content'] = {'task-id': create_task_id, 'state': 'cancelling' if in_progress else 'pending'}
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='windows.reset', bind=True)
+def reset(self, username, machine_name, txn_id):
+    """Revert an instance of Windows to how it was when it was created
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to reset an instance of Windows
+    :type username: String
+
+    :param machine_name: The name of the instance of Windows
+    :type machine_name: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    stats = history.Stats()
+    try:
+        resp['content'] = vmware.reset_windows(username, machine_name, logger, stats=stats)
+    except (ValueError, locks.LockTimeout) as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    resp['params'].update(stats.params())
+    return resp
+
+
+@app.task(name='windows.power', bind=True)
+def power(self, username, machine_names, state, txn_id):
+    """Turn on/off/restart many instances of Windows at once
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the instances of Windows
+    :type username: String
+
+    :param machine_names: The instances of Windows to power on/off/restart. None means all of them.
+    :type machine_names: List
+
+    :param state: One of "on", "off" or "restart"
+    :type state: String
+
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
     """
@@ -89,7 +279,7 @@ def delete(self, username, machine_name, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        vmware.delete_windows(username, machine_name, logger)
+        resp['content'] = vmware.power_windows(username, machine_names, state, logger)
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -121,10 +311,193 @@ def modify_network(self, username, machine_name, new_network, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    stats = history.Stats()
     try:
-        vmware.update_network(username, machine_name, new_network)
-    except ValueError as doh:
+        vmware.update_network(username, machine_name, new_network, stats=stats)
+    except (ValueError, locks.LockTimeout) as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    resp['params'].update(stats.params())
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='windows.modify_network_batch', bind=True)
+def modify_network_batch(self, username, machine_names, new_network, txn_id):
+    """Change the network many instances of Windows are connected to
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the instances of Windows
+    :type username: String
+
+    :param machine_names: The instances of Windows to update. None means all of them.
+    :type machine_names: List
+
+    :param new_network: The name of the network to connect the instances of Windows to
+    :type new_network: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    stats = history.Stats()
+    try:
+        resp['content'] = vmware.update_network_batch(username, machine_names, new_network, logger, stats=stats)
+    except (ValueError, locks.LockTimeout) as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    resp['params'].update(stats.params())
+    return resp
+
+
+@app.task(name='windows.inventory', bind=True)
+def inventory(self, txn_id):
+    """Report on every instance of Windows across all users, with totals per user and per version
+
+    The report is written to ``VLAB_WINDOWS_REPORTS_DIR`` as it's produced, not
+    returned; the API streams it from there.
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    resp['content'] = {'rows': reports.write(self.request.id, vmware.inventory())}
     logger.info('Task complete')
     return resp
+
+
+@app.task(name='windows.reap', bind=True)
+def reap(self, txn_id, dry_run=None):
+    """Find, and optionally destroy, instances of Windows that are only taking up space
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param dry_run: Set to False to actually destroy the VMs. Defaults to ``VLAB_WINDOWS_REAP_DRY_RUN``.
+    :type dry_run: Boolean
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    if dry_run is None:
+        dry_run = const.VLAB_WINDOWS_REAP_DRY_RUN
+    resp['content'] = vmware.reap_stale(logger, dry_run)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='windows.metrics', bind=True)
+def metrics(self, txn_id):
+    """Obtain the counters the worker keeps, how fast OVAs are read off disk, and
+    how long creates wait in the queue per user
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    counters = store.counters()
+    resp['content'] = {'counters': counters,
+                       'ova_read_mbps': _read_mbps(counters),
+                       'queue_wait': store.wait_stats()}
+    return resp
+
+
+def _read_mbps(counters):
+    """The average speed OVAs have been read off disk, in MB/s
+
+    :Returns: Float or None
+
+    :param counters: What ``store.counters`` returned
+    :type counters: Dictionary
+    """
+    seconds = counters.get('ova.read_seconds')
+    if not seconds:
+        return None
+    return round(counters.get('ova.bytes_read', 0) / seconds / 1024 ** 2, 1)
+
+
+@app.task(name='windows.history', bind=True)
+def task_history(self, txn_id, tasks=None, since=None, until=None):
+    """Report the p50/p95/p99 duration of tasks, by image
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param tasks: Only report on these tasks, like ``['create', 'delete']``. Default is all of them.
+    :type tasks: List
+
+    :param since: Only report on tasks that finished after this Unix timestamp
+    :type since: Float
+
+    :param until: Only report on tasks that finished before this Unix timestamp
+    :type until: Float
+    """
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    resp['content'] = history.percentiles(tasks=tasks, since=since, until=until)
+    return resp
+
+
+@app.task(name='windows.health', bind=True)
+def health(self):
+    """Report on the dependencies only the worker can reach (images and vCenter)
+
+    :Returns: Dictionary
+    """
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    resp['content'] = vmware.check_health()
+    return resp
+
+
+@worker_ready.connect
+def _prewarm(**kwargs):
+    """Start reading the popular images into the page cache, without holding up the worker"""
+    if const.VLAB_WINDOWS_PREWARM_GB:
+        threading.Thread(target=_prewarm_images, daemon=True).start()
+
+
+def _prewarm_images():
+    """Warm the page cache; runs in a daemon thread"""
+    logger = get_task_logger(txn_id='prewarm', task_id='prewarm', loglevel=const.VLAB_WINDOWS_LOG_LEVEL.upper())
+    try:
+        warmed = vmware.prewarm_images(logger)
+    except Exception as doh:
+        # it's only an optimization, so it must never take down the worker
+        logger.error('Unable to prewarm images: {}'.format(doh))
+    else:
+        logger.info('Prewarmed {} images'.format(len(warmed)))
+
+
+@task_prerun.connect
+def _task_started(task_id=None, **kwargs):
+    """Note when a task starts, so its duration can be recorded"""
+    _started[task_id] = time.time()
+
+
+@task_postrun.connect
+def _task_finished(task_id=None, task=None, args=None, kwargs=None, retval=None, state=None, **extra):
+    """Add a task that finished to the history. This only queues the entry, so it
+    adds no latency to the task."""
+    started = _started.pop(task_id, None)
+    if started is None or state == 'RETRY' or task.name in NOT_RECORDED:
+        # i.e. a create waiting on its fair share; the attempt that runs gets recorded
+        return
+    try:
+        call_args = inspect.signature(task.run).bind_partial(*(args or ()), **(kwargs or {})).arguments
+    except TypeError:
+        call_args = {}
+    history.record(history.make_entry(task.name, task_id, call_args, retval, state, time.time() - started))
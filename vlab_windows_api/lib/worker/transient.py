@@ -0,0 +1,48 @@
+# -*- coding: UTF-8 -*-
+"""
+Tells apart failures worth retrying (a dropped connection, vCenter restarting,
+a lease that timed out) from ones that will just happen again (a bad image, a
+name that's taken), and how long to back off between attempts.
+"""
+import ssl
+import random
+import socket
+import http.client
+
+from pyVmomi import vim, vmodl
+
+from vlab_windows_api.lib import const
+
+
+TRANSIENT_ERRORS = (ConnectionError, socket.timeout, http.client.HTTPException, ssl.SSLError)
+TRANSIENT_FAULTS = (vmodl.fault.HostCommunication, vim.fault.HostConnectFault, vim.fault.NotAuthenticated,
+                    vmodl.fault.RequestCanceled, vim.fault.Timedout)
+
+
+class TransientError(RuntimeError):
+    """Raised for a failure that's likely to work if tried again"""
+    pass
+
+
+def is_transient(error):
+    """Decide if a failure is worth retrying
+
+    :Returns: Boolean
+
+    :param error: What was raised
+    :type error: Exception
+    """
+    return isinstance(error, (TransientError,) + TRANSIENT_ERRORS + TRANSIENT_FAULTS)
+
+
+def backoff(attempt):
+    """How long to wait before trying again; exponential, with jitter so a batch
+    of failed creates doesn't retry in lock step.
+
+    :Returns: Float - seconds
+
+    :param attempt: How many times it's been tried already, starting at 0
+    :type attempt: Integer
+    """
+    ceiling = min(const.VLAB_WINDOWS_RETRY_BACKOFF * 2 ** attempt, const.VLAB_WINDOWS_RETRY_MAX_BACKOFF)
+    return random.uniform(ceiling / 2, ceiling)
@@ -2,36 +2,180 @@
 """Business logic for backend worker tasks"""
 import time
 import random
+import fnmatch
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
 from celery.utils.log import get_task_logger
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vCenter, vim, virtual_machine, consume_task
 
 from vlab_windows_api.lib import const
-
-
-def show_windows(username):
+from vlab_windows_api.lib.worker import collector, deploy, history, locks, preflight, reaper, staging, store, transient
+from vlab_windows_api.lib.worker.network_cache import network_cache
+
+PRISTINE_SNAPSHOT = 'pristine'
+IP_TIMEOUT = 600
+POWER_STATES = ('on', 'off', 'restart')
+SHOW_FIELDS = ('state', 'console', 'ips', 'networks', 'moid', 'meta')
+# The VM property each field of ``show_windows`` is built from
+FIELD_PATHS = {'state': 'runtime.powerState', 'ips': 'guest.net', 'networks': 'network'}
+_HEALTH_LOCK = threading.Lock()
+_HEALTH = {'checked': 0, 'result': None}
+# How far back to look for which images are popular
+PREWARM_WINDOW = 7 * 86400
+
+
+def show_windows(username, fields=None, limit=None, cursor=None, name=None):
     """Obtain basic information about Windows
 
-    :Returns: Dictionary
+    Only the requested fields are looked up, and everything that can be is
+    fetched in bulk, so the cost scales with what's asked for rather than with
+    how many VMs the user has.
+
+    :Returns: Tuple - (Dictionary, String). The string is the cursor for the
+              next page, or None if there are no more VMs.
 
     :param username: The user requesting info about their Windows
     :type username: String
+
+    :param fields: The info to return for each VM. Defaults to ``SHOW_FIELDS``.
+    :type fields: List
+
+    :param limit: The most VMs to return.
+    :type limit: Integer
+
+    :param cursor: Only return VMs after this one; the cursor from a prior page.
+    :type cursor: String
+
+    :param name: Only return VMs whose name matches this (shell-style) pattern.
+    :type name: String
     """
+    fields = set(fields or SHOW_FIELDS)
     windows_vms = {}
     with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
                  password=const.INF_VCENTER_PASSWORD) as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'Windows':
-                windows_vms[vm.name] = info
-    return windows_vms
+        vms = windows_index(vcenter, folder)
+        names = sorted(vms.keys())
+        if name:
+            names = [x for x in names if fnmatch.fnmatchcase(x, name)]
+        if cursor:
+            names = [x for x in names if x > cursor]
+        next_cursor = None
+        if limit and len(names) > limit:
+            names = names[:limit]
+            next_cursor = names[-1]
+        # Only the VMs on this page, and only the properties the fields need
+        path_set = sorted(FIELD_PATHS[x] for x in fields if x in FIELD_PATHS)
+        page = {vms[x]['obj']._moId: vms[x] for x in names}
+        if path_set:
+            objs = [x['obj'] for x in page.values()]
+            for props in collector.retrieve_objects(vcenter, vim.VirtualMachine, objs, path_set):
+                page[props['obj']._moId].update(props)
+        if 'networks' in fields:
+            networks = _vm_networks(vcenter, username, list(page.values()))
+        for vm_name in names:
+            props = vms[vm_name]
+            info = {}
+            if 'state' in fields:
+                info['state'] = props.get('runtime.powerState')
+            if 'console' in fields:
+                # same helper get_info uses; it's the one field that can't be fetched in bulk
+                info['console'] = virtual_machine._get_vm_console_url(vcenter, props['obj'])
+            if 'ips' in fields:
+                info['ips'] = _get_ips(props)
+            if 'networks' in fields:
+                info['networks'] = networks.get(props['obj']._moId, [])
+            if 'moid' in fields:
+                info['moid'] = props['obj']._moId
+            if 'meta' in fields:
+                info['meta'] = props['meta']
+            windows_vms[vm_name] = info
+    return windows_vms, next_cursor
+
+
+def windows_index(vcenter, folder):
+    """Find every Windows VM in a folder, along with its meta data.
+
+    Only what's needed to tell which VMs are Windows is fetched; look up
+    anything else for just the VMs that need it.
+
+    :Returns: Dictionary - VM name -> properties; the VM itself is under the key ``obj``
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param folder: The folder to look in
+    :type folder: vim.Folder
+    """
+    vms = {}
+    path_set = ['name', 'config.annotation']
+    for props in collector.retrieve(vcenter, vim.VirtualMachine, path_set, root=folder):
+        try:
+            props['meta'] = ujson.loads(props.get('config.annotation', ''))
+        except (ValueError, TypeError):
+            # ValueError -> VM created, but notes not updated
+            # TypeError  -> VM failed to be created; notes are None
+            continue
+        if isinstance(props['meta'], dict) and props['meta'].get('component') == 'Windows':
+            vms[props['name']] = props
+    return vms
 
 
-def delete_windows(username, machine_name, logger):
-    """Unregister and destroy a user's Windows
+def _vm_networks(vcenter, username, vms):
+    """Map VMs to the names of the user's networks they're on
 
-    :Returns: None
+    :Returns: Dictionary - VM moId -> List of network names
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param username: The user who owns the networks
+    :type username: String
+
+    :param vms: The properties of each VM, including ``network``
+    :type vms: List
+    """
+    prefix = '{}_'.format(username)
+    unique = {}
+    for props in vms:
+        for network in props.get('network', []):
+            unique[network._moId] = network
+    names = {}
+    for props in collector.retrieve_objects(vcenter, vim.Network, list(unique.values()), ['name']):
+        names[props['obj']._moId] = props['name']
+    vm_networks = {}
+    for props in vms:
+        for network in props.get('network', []):
+            name = names.get(network._moId, '')
+            if name.startswith(prefix):
+                vm_networks.setdefault(props['obj']._moId, []).append(name.replace(prefix, '', 1))
+    return vm_networks
+
+
+def _get_ips(props):
+    """Pull the IPs out of a VM's ``guest.net`` property, minus IPv6 link-local addresses
+
+    :Returns: List
+
+    :param props: The properties of the VM
+    :type props: Dictionary
+    """
+    ips = []
+    for nic in props.get('guest.net', []):
+        ips += nic.ipAddress
+    return [x for x in ips if not x.startswith('fe80::')]
+
+
+def delete_windows(username, machine_name, logger, stats=None):
+    """Unregister and destroy a user's Windows, cancelling its create if that's still in progress
+
+    :Returns: String or None - the ID of the create task that was cancelled
+
+    :Raises: ValueError, vlab_windows_api.lib.worker.locks.LockTimeout
 
     :param username: The user who wants to delete their jumpbox
     :type username: String
@@ -41,25 +185,42 @@ def delete_windows(username, machine_name, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
-    """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'Windows':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
-        else:
-            raise ValueError('No {} named {} found'.format('windows', machine_name))
-
 
-def create_windows(username, machine_name, image, network, logger):
+    :param stats: Records how long each phase of the delete took
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+    """
+    if stats is None:
+        stats = history.Stats()
+    create_task = store.find_create(username, machine_name)
+    if create_task:
+        # The create destroys whatever it has made so far, then releases the
+        # lock; a VM that was already finished under that name is deleted below
+        logger.info('Cancelling in-progress create of {}'.format(machine_name))
+        store.cancel_create(username, create_task)
+    with locks.hold(username, [machine_name], stats=stats):
+        with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
+                     password=const.INF_VCENTER_PASSWORD) as vcenter:
+            folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+            for entity in folder.childEntity:
+                if entity.name == machine_name:
+                    info = virtual_machine.get_info(vcenter, entity, username)
+                    if info['meta']['component'] == 'Windows':
+                        stats.info['image'] = info['meta'].get('version')
+                        logger.debug('powering off VM')
+                        with stats.phase('power_off'):
+                            virtual_machine.power(entity, state='off')
+                        with stats.phase('destroy'):
+                            delete_task = entity.Destroy_Task()
+                            logger.debug('blocking while VM is being destroyed')
+                            consume_task(delete_task)
+                        break
+            else:
+                if not create_task:
+                    raise ValueError('No {} named {} found'.format('windows', machine_name))
+    return create_task
+
+
+def create_windows(username, machine_name, image, network, logger, should_stop=None, stats=None):
     """Deploy a new instance of Windows
 
     :Returns: Dictionary
@@ -76,39 +237,338 @@ def create_windows(username, machine_name, image, network, logger):
     :param network: The name of the network to connect the new Windows instance up to
     :type network: String
 
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param should_stop: Polled while the VM is created; return True to cancel the create.
+    :type should_stop: Function
+
+    :param stats: Records how long each phase of the create took, and where the VM went
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+    """
+    if should_stop is None:
+        should_stop = lambda: False
+    if stats is None:
+        stats = history.Stats()
+    # so a second create of the same name waits, then fails preflight, instead of uploading too
+    with locks.hold(username, [machine_name], stats=stats, should_stop=should_stop):
+        with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                     password=const.INF_VCENTER_PASSWORD) as vcenter:
+            image_name = convert_name(image)
+            logger.info(image_name)
+            with stats.phase('preflight'):
+                # Fail in milliseconds, not after uploading gigabytes
+                checked = preflight.check(vcenter, username, machine_name, image,
+                                          os.path.join(const.VLAB_WINDOWS_IMAGES_DIR, image_name), network)
+            ova = checked['ova']
+            try:
+                network_map = vim.OvfManager.NetworkMapping()
+                network_map.name = ova.networks[0]
+                network_map.network = checked['network']
+                the_vm = None
+                if const.VLAB_WINDOWS_STAGING_BUDGET_GB:
+                    try:
+                        with stats.phase('clone'):
+                            the_vm = staging.clone_from_stage(vcenter, ova, image, network_map,
+                                                              username, machine_name, logger, power_on=False,
+                                                              folder=checked['folder'], datastore=checked['datastore'],
+                                                              should_stop=should_stop)
+                    except staging.StageUnavailable as doh:
+                        # no VM was made, so the name is still free for the import
+                        logger.warning('Unable to use staged image, uploading OVA: {}'.format(doh))
+                stats.info['uploaded'] = 0
+                if the_vm is None:
+                    with stats.phase('upload'):
+                        try:
+                            the_vm = deploy.deploy_from_ova(vcenter, ova, [network_map], username, machine_name,
+                                                            logger, power_on=False, folder=checked['folder'],
+                                                            datastore=checked['datastore'], should_stop=should_stop)
+                        except deploy.Cancelled:
+                            # deploy_from_ova already removed the partial VM
+                            raise
+                        except Exception:
+                            # the lock is held and preflight found no VM by this name, so any VM now is ours
+                            leftover = vcenter.content.searchIndex.FindChild(entity=checked['folder'],
+                                                                              name=machine_name)
+                            if leftover is not None:
+                                _discard(leftover, logger)
+                            raise
+                    stats.info['uploaded'] = ova.size
+                    stats.info['read_bytes'] = ova.bytes_read
+                    stats.info['read_seconds'] = round(ova.read_seconds, 3)
+            finally:
+                ova.close()
+            try:
+                return _finish_create(vcenter, the_vm, username, image, logger, should_stop, stats)
+            except Exception as doh:
+                if transient.is_transient(doh):
+                    # otherwise the retry fails because the name is taken
+                    _discard(the_vm, logger)
+                raise
+
+
+def _finish_create(vcenter, the_vm, username, image, logger, should_stop, stats):
+    """Snapshot, tag and power on a newly deployed Windows
+
+    :Returns: Dictionary
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param the_vm: The new VM
+    :type the_vm: vim.VirtualMachine
+
+    :param username: The name of the user who created the VM
+    :type username: String
+
+    :param image: The image/version of Windows the VM was created from
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param should_stop: Return True to cancel the create
+    :type should_stop: Function
+
+    :param stats: Records how long each phase of the create took
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+    """
+    _check_cancelled(the_vm, should_stop, logger)
+    try:
+        stats.info['datastore'] = the_vm.datastore[0].name
+    except (IndexError, vmodl.MethodFault):
+        pass
+    meta_data = {'component' : "Windows",
+                 'created': time.time(),
+                 'version': image,
+                 'configured': False,
+                 'generation': 1,
+                }
+    try:
+        with stats.phase('snapshot'):
+            meta_data['pristine'] = take_pristine_snapshot(the_vm)
+    except (RuntimeError, vmodl.MethodFault) as doh:
+        # The VM is still usable, it just cannot be reset
+        logger.warning('Unable to snapshot {}, it cannot be reset: {}'.format(the_vm.name, doh))
+    virtual_machine.set_meta(the_vm, meta_data)
+    logger.debug("Powering on {}'s new VM {}".format(username, the_vm.name))
+    with stats.phase('power_on'):
+        virtual_machine.power(the_vm, state='on')
+    with stats.phase('ip'):
+        _wait_for_ip(the_vm, should_stop, logger)
+    info = virtual_machine.get_info(vcenter, the_vm, username)
+    return {the_vm.name: info}
+
+
+def _wait_for_ip(the_vm, should_stop, logger):
+    """Wait for a new VM to get an IP, checking between polls if the create was cancelled
+
+    :Returns: None
+
+    :Raises: RuntimeError, vlab_windows_api.lib.worker.deploy.Cancelled
+
+    :param the_vm: The new VM
+    :type the_vm: vim.VirtualMachine
+
+    :param should_stop: Return True to cancel the create
+    :type should_stop: Function
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    for _ in range(IP_TIMEOUT):
+        _check_cancelled(the_vm, should_stop, logger)
+        if any(nic.ipAddress for nic in the_vm.guest.net):
+            return
+        time.sleep(1)
+    raise RuntimeError('Unable to obtain an IP within {} seconds'.format(IP_TIMEOUT))
+
+
+def _discard(the_vm, logger):
+    """Best effort removal of a VM whose create failed partway through
+
+    :Returns: None
+
+    :param the_vm: The VM to remove
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        virtual_machine.power(the_vm, state='off')
+        deploy.destroy_partial(the_vm)
+    except Exception as doh:
+        # vCenter is likely still down; the reaper picks up orphans
+        logger.warning('Unable to remove partly created VM: {}'.format(doh))
+
+
+def _check_cancelled(the_vm, should_stop, logger):
+    """Destroy a newly made VM if the user cancelled the create
+
+    :Raises: vlab_windows_api.lib.worker.deploy.Cancelled
+    """
+    if should_stop():
+        logger.info('Create of {} cancelled, destroying it'.format(the_vm.name))
+        virtual_machine.power(the_vm, state='off')
+        deploy.destroy_partial(the_vm)
+        raise deploy.Cancelled('Create of {} cancelled'.format(the_vm.name))
+
+
+
+def reset_windows(username, machine_name, logger, stats=None):
+    """Revert a user's Windows to how it was when it was created
+
+    :Returns: Dictionary
+
+    :param username: The user who owns the VM
+    :type username: String
+
+    :param machine_name: The name of the VM to reset
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param stats: Records how long the reset waited on other changes to the VM
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+    """
+    with locks.hold(username, [machine_name], stats=stats):
+        with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
+                     password=const.INF_VCENTER_PASSWORD) as vcenter:
+            folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+            for entity in folder.childEntity:
+                if entity.name == machine_name:
+                    info = virtual_machine.get_info(vcenter, entity, username)
+                    if info['meta']['component'] == 'Windows':
+                        the_vm = entity
+                        meta_data = info['meta']
+                        break
+            else:
+                error = 'No VM named {} found'.format(machine_name)
+                raise ValueError(error)
+            snapshot = _find_snapshot(the_vm, meta_data.get('pristine'))
+            if snapshot is None:
+                error = 'Unable to reset {}; it has no pristine snapshot. Delete and recreate it instead.'.format(machine_name)
+                raise ValueError(error)
+            logger.debug('Reverting {} to snapshot {}'.format(machine_name, meta_data['pristine']))
+            consume_task(snapshot.RevertToSnapshot_Task(suppressPowerOn=True))
+            meta_data['generation'] += 1
+            meta_data['configured'] = False
+            virtual_machine.set_meta(the_vm, meta_data)
+            virtual_machine.power(the_vm, state='on')
+            info = virtual_machine.get_info(vcenter, the_vm, username)
+            return {the_vm.name: info}
+
+
+def power_windows(username, machine_names, state, logger):
+    """Turn on/off/restart many of a user's Windows at once
+
+    :Returns: Dictionary - VM name -> ``{'ok': Boolean, 'error': String}``
+
+    :param username: The user who owns the VMs
+    :type username: String
+
+    :param machine_names: The VMs to power on/off/restart. None means every Windows the user has.
+    :type machine_names: List
+
+    :param state: One of "on", "off" or "restart"
+    :type state: String
+
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+    if state not in POWER_STATES:
+        error = 'Power state must be one of {}, supplied: {}'.format(', '.join(POWER_STATES), state)
+        raise ValueError(error)
+    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
                  password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
-        logger.info(image_name)
-        try:
-            ova = Ova(os.path.join(const.VLAB_WINDOWS_IMAGES_DIR, image_name))
-        except FileNotFoundError:
-            error = "Invalid verison of Windows supplied: {}".format(image)
-            raise ValueError(error)
-        try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
+        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        vms = windows_index(vcenter, folder)
+        logger.debug('Powering {} {} VMs'.format(state, len(machine_names or vms)))
+        return _run_batch(vms, machine_names, lambda vm: _power(vm, state))
+
+
+def _power(the_vm, state):
+    """Adapts ``virtual_machine.power`` for ``_run_batch``"""
+    if not virtual_machine.power(the_vm, state=state):
+        raise RuntimeError('Timed out waiting for power {}'.format(state))
+
+
+def _run_batch(vms, machine_names, func):
+    """Call a function on many VMs at once, and wait for them all to finish.
+
+    A failure with one VM does not stop the others.
+
+    :Returns: Dictionary - VM name -> ``{'ok': Boolean, 'error': String}``
+
+    :param vms: Every VM that can be acted on, from ``windows_index``
+    :type vms: Dictionary
+
+    :param machine_names: The names of the VMs to act on. None means all of them.
+    :type machine_names: List
+
+    :param func: Called with each VM
+    :type func: Function
+    """
+    if machine_names is None:
+        machine_names = sorted(vms.keys())
+    results = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=const.VLAB_WINDOWS_BATCH_WORKERS) as executor:
+        for machine_name in machine_names:
+            if machine_name not in vms:
+                results[machine_name] = {'ok': False, 'error': 'No VM named {} found'.format(machine_name)}
+            else:
+                futures[machine_name] = executor.submit(func, vms[machine_name]['obj'])
+        for machine_name, future in futures.items():
             try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter, ova, [network_map],
-                                                     username, machine_name, logger)
-        finally:
-            ova.close()
-        meta_data = {'component' : "Windows",
-                     'created': time.time(),
-                     'version': image,
-                     'configured': False,
-                     'generation': 1,
-                    }
-        virtual_machine.set_meta(the_vm, meta_data)
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return {the_vm.name: info}
+                future.result()
+            except Exception as doh:
+                # anything one VM raises is that VM's result; the rest still get theirs
+                error = getattr(doh, 'msg', None) or '{}'.format(doh)
+                results[machine_name] = {'ok': False, 'error': error}
+            else:
+                results[machine_name] = {'ok': True, 'error': None}
+    return results
+
+
+def take_pristine_snapshot(the_vm):
+    """Snapshot a newly created, powered off VM so it can be reset later
+
+    :Returns: String - the moId of the snapshot
+
+    :param the_vm: The new VM
+    :type the_vm: vim.VirtualMachine
+    """
+    task = the_vm.CreateSnapshot_Task(name=PRISTINE_SNAPSHOT,
+                                      description='Taken right after the VM was created',
+                                      memory=False,
+                                      quiesce=False)
+    snapshot = consume_task(task)
+    return snapshot._moId
+
+
+def _find_snapshot(the_vm, mo_id):
+    """Locate one of a VM's snapshots by moId
 
+    :Returns: vim.vm.Snapshot or None
+
+    :param the_vm: The VM that has the snapshot
+    :type the_vm: vim.VirtualMachine
+
+    :param mo_id: The moId of the snapshot
+    :type mo_id: String
+    """
+    if not (mo_id and the_vm.snapshot):
+        return None
+    pending = list(the_vm.snapshot.rootSnapshotList)
+    while pending:
+        tree = pending.pop()
+        if tree.snapshot._moId == mo_id:
+            return tree.snapshot
+        pending.extend(tree.childSnapshotList)
+    return None
 
 
 def list_images():
@@ -139,7 +599,7 @@ def convert_name(name, to_version=False):
         return 'Windows-{}.ova'.format(name)
 
 
-def update_network(username, machine_name, new_network):
+def update_network(username, machine_name, new_network, stats=None):
     """Implements the VM network update
 
     :param username: The name of the user who owns the virtual machine
@@ -150,24 +610,243 @@ def update_network(username, machine_name, new_network):
 
     :param new_network: The name of the new network to connect the VM to
     :type new_network: String
+
+    :param stats: Records how long the update waited on other changes to the VM
+    :type stats: vlab_windows_api.lib.worker.history.Stats
+    """
+    with locks.hold(username, [machine_name], stats=stats):
+        with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
+                     password=const.INF_VCENTER_PASSWORD) as vcenter:
+            folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+            for entity in folder.childEntity:
+                if entity.name == machine_name:
+                    info = virtual_machine.get_info(vcenter, entity, username)
+                    if info['meta']['component'] == 'Windows':
+                        the_vm = entity
+                        break
+            else:
+                error = 'No VM named {} found'.format(machine_name)
+                raise ValueError(error)
+
+            try:
+                network = network_cache.lookup(vcenter, new_network)
+            except KeyError:
+                error = 'No such network named {}'.format(new_network)
+                raise ValueError(error)
+            try:
+                virtual_machine.change_network(the_vm, network)
+            except vmodl.fault.ManagedObjectNotFound:
+                # The network was deleted (and maybe recreated) since we cached it
+                network_cache.invalidate(new_network)
+                try:
+                    network = network_cache.lookup(vcenter, new_network)
+                except KeyError:
+                    error = 'No such network named {}'.format(new_network)
+                    raise ValueError(error)
+                virtual_machine.change_network(the_vm, network)
+
+
+def update_network_batch(username, machine_names, new_network, logger, stats=None):
+    """Connect many of a user's Windows to a network at once
+
+    :Returns: Dictionary - VM name -> ``{'ok': Boolean, 'error': String}``
+
+    :param username: The name of the user who owns the VMs
+    :type username: String
+
+    :param machine_names: The VMs to update. None means every Windows the user has.
+    :type machine_names: List
+
+    :param new_network: The name of the new network to connect the VMs to
+    :type new_network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param stats: Records how long the update waited on other changes to the VMs
+    :type stats: vlab_windows_api.lib.worker.history.Stats
     """
     with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
                  password=const.INF_VCENTER_PASSWORD) as vcenter:
         folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'Windows':
-                    the_vm = entity
-                    break
-        else:
-            error = 'No VM named {} found'.format(machine_name)
-            raise ValueError(error)
+        vms = windows_index(vcenter, folder)
+        with locks.hold(username, machine_names or list(vms.keys()), stats=stats):
+            return _update_network_batch(vcenter, vms, machine_names, new_network, logger)
+
 
+def _update_network_batch(vcenter, vms, machine_names, new_network, logger):
+    """Connect many of a user's Windows to a network, while they're locked
+
+    :Returns: Dictionary - VM name -> ``{'ok': Boolean, 'error': String}``
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vcenter.vCenter
+
+    :param vms: What ``windows_index`` returned for the user's folder
+    :type vms: Dictionary
+
+    :param machine_names: The VMs to update. None means every Windows the user has.
+    :type machine_names: List
+
+    :param new_network: The name of the new network to connect the VMs to
+    :type new_network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        network = network_cache.lookup(vcenter, new_network)
+    except KeyError:
+        error = 'No such network named {}'.format(new_network)
+        raise ValueError(error)
+    stale = []
+    def change(the_vm):
+        try:
+            virtual_machine.change_network(the_vm, network)
+        except vmodl.fault.ManagedObjectNotFound:
+            stale.append(the_vm.name)
+            raise
+    logger.debug('Moving {} VMs to {}'.format(len(machine_names or vms), new_network))
+    results = _run_batch(vms, machine_names, change)
+    if stale:
+        # The network was deleted (and maybe recreated) since we cached it
+        network_cache.invalidate(new_network)
         try:
-            network = vcenter.networks[new_network]
+            network = network_cache.lookup(vcenter, new_network)
         except KeyError:
-            error = 'No VM named {} found'.format(machine_name)
+            error = 'No such network named {}'.format(new_network)
             raise ValueError(error)
+        # ``change`` picks up the new value of ``network``
+        results.update(_run_batch(vms, list(stale), change))
+    return results
+
+
+def inventory():
+    """Produce a row for every Windows VM across all users, then the totals per
+    user and per version.
+
+    VMs are yielded a page at a time as vCenter returns them, so only the totals
+    (and the name of each user's folder) are ever held in memory. The folders are
+    fetched first, in their own traversal, so every VM row can name its user
+    right away.
+
+    :Returns: Generator of Dictionaries - each with a ``type`` of vm, user or version
+    """
+    path_set = ['name', 'parent', 'config.annotation', 'runtime.powerState',
+                'summary.storage.committed', 'summary.storage.uncommitted']
+    users = {}
+    versions = {}
+    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
+                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+        top_dir = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+        folders = {x['obj']._moId: x['name'] for x in collector.retrieve(vcenter, vim.Folder, ['name'], root=top_dir)}
+        for props in collector.retrieve(vcenter, vim.VirtualMachine, path_set, root=top_dir):
+            try:
+                meta = ujson.loads(props.get('config.annotation', ''))
+            except (ValueError, TypeError):
+                continue
+            if not (isinstance(meta, dict) and meta.get('component') == 'Windows'):
+                continue
+            # a VM in a vApp has no parent folder
+            parent = props.get('parent')
+            vm = {'type': 'vm',
+                  'user': folders.get(parent._moId) if parent else None,
+                  'name': props['name'],
+                  'version': meta.get('version'),
+                  'created': meta.get('created'),
+                  'state': props.get('runtime.powerState'),
+                  'committed': props.get('summary.storage.committed', 0),
+                  'uncommitted': props.get('summary.storage.uncommitted', 0)}
+            for totals in (users.setdefault(vm['user'], _new_totals()),
+                           versions.setdefault(vm['version'], _new_totals())):
+                totals['count'] += 1
+                totals['committed'] += vm['committed']
+                totals['uncommitted'] += vm['uncommitted']
+                if vm['state'] == 'poweredOn':
+                    totals['powered_on'] += 1
+            yield vm
+    for user, totals in users.items():
+        yield dict(totals, type='user', user=user)
+    for version, totals in versions.items():
+        yield dict(totals, type='version', version=version)
+
+
+def _new_totals():
+    """The starting point for the inventory totals"""
+    return {'count': 0, 'powered_on': 0, 'committed': 0, 'uncommitted': 0}
+
+
+def reap_stale(logger, dry_run):
+    """Find, and optionally destroy, Windows VMs that are only taking up space
+
+    :Returns: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param dry_run: Set to False to actually destroy the VMs
+    :type dry_run: Boolean
+    """
+    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
+                 password=const.INF_VCENTER_PASSWORD) as vcenter:
+        return reaper.reap(vcenter, logger, dry_run=dry_run)
+
+
+def prewarm_images(logger):
+    """Read the images that get created the most into the page cache, so the first
+    creates after the worker starts aren't waiting on the disk. Images are warmed
+    most popular first, until ``VLAB_WINDOWS_PREWARM_GB`` is used up.
+
+    :Returns: List - the images that were warmed
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    budget = const.VLAB_WINDOWS_PREWARM_GB * 1024 ** 3
+    warmed = []
+    for image in history.popular_images(since=time.time() - PREWARM_WINDOW):
+        path = os.path.join(const.VLAB_WINDOWS_IMAGES_DIR, convert_name(image))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # the image has since been removed
+            continue
+        if size > budget:
+            continue
+        logger.info('Prewarming image {} ({:.1f} GB)'.format(image, size / 1024 ** 3))
+        deploy.warm_page_cache(path)
+        budget -= size
+        warmed.append(image)
+    return warmed
+
+
+def check_health():
+    """Test that the images directory is usable, and how long it takes to log into vCenter.
+
+    The result is cached for ``VLAB_WINDOWS_HEALTH_INTERVAL`` seconds so frequent
+    health checks don't turn into a pile of vCenter logins.
+
+    :Returns: Dictionary
+    """
+    with _HEALTH_LOCK:
+        if time.time() - _HEALTH['checked'] < const.VLAB_WINDOWS_HEALTH_INTERVAL:
+            return _HEALTH['result']
+        result = {}
+        try:
+            images = os.listdir(const.VLAB_WINDOWS_IMAGES_DIR)
+        except OSError as doh:
+            result['images'] = {'ok': False, 'error': '{}'.format(doh)}
         else:
-            virtual_machine.change_network(the_vm, network)
+            result['images'] = {'ok': True, 'count': len(images)}
+        start = time.time()
+        try:
+            with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                         password=const.INF_VCENTER_PASSWORD):
+                login_ms = int((time.time() - start) * 1000)
+        except Exception as doh:
+            result['vcenter'] = {'ok': False, 'error': '{}'.format(doh)}
+        else:
+            result['vcenter'] = {'ok': True, 'login_ms': login_ms}
+        _HEALTH['checked'] = time.time()
+        _HEALTH['result'] = result
+        return result